@@ -267,11 +267,13 @@ export class MailsController {
     @Param('mailid') mailId: string,
     @Param('filename') filename: string,
     @Res() res: Response,
+    @Req() req: any,
   ): Promise<void> {
     try {
       const { fileData, attachment } = await this.mailsService.getAttachment(
         mailId,
         filename,
+        req.oauth2Client,
       );
 
       const safeFilename = encodeURIComponent(attachment.filename)
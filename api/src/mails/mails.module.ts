@@ -59,6 +59,10 @@ export class MailsModule implements NestModule {
         { path: 'mails/addAnswer', method: RequestMethod.POST },
         { path: 'mails/forward', method: RequestMethod.POST },
         { path: 'mails/thread/:id', method: RequestMethod.DELETE },
+        {
+          path: 'mails/attachment/:mailid/:filename',
+          method: RequestMethod.GET,
+        },
       );
   }
 }
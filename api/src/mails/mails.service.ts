@@ -1287,8 +1287,20 @@ export class MailsService {
   async getAttachment(
     mailId: string,
     filename: string,
+    oauth2Client: any,
   ): Promise<{ fileData: Buffer; attachment: any }> {
-    const mail = await this.emailModel.findOne({ _id: mailId }).exec();
+    if (!oauth2Client) {
+      throw new UnauthorizedException('Authentication required.');
+    }
+
+    const oauth2 = google.oauth2({ version: 'v2', auth: oauth2Client });
+    const userInfo = await oauth2.userinfo.get();
+    const deliveredTo = userInfo.data.email;
+
+    // Only the emails of the authenticated user
+    const mail = await this.emailModel
+      .findOne({ _id: mailId, deliveredTo: deliveredTo })
+      .exec();
     if (!mail) {
       throw new NotFoundException('Email not found');
     }
@@ -1300,7 +1312,15 @@ export class MailsService {
       throw new NotFoundException('Attachment not found');
     }
 
-    const fileData = Buffer.from(attachment.data, 'base64');
+    // Emails ingested with metadata-only attachments do not store their
+    // content: it is retrieved on demand by the retrieve_attachment function
+    const fileData = attachment.data
+      ? Buffer.from(attachment.data, 'base64')
+      : await this.userHelpers.retrieveAttachment(
+          deliveredTo,
+          mail.messageId,
+          attachment.attachment_id,
+        );
 
     return { fileData, attachment };
   }
@@ -226,6 +226,31 @@ export class UserHelpers {
     }
   }
 
+  async retrieveAttachment(
+    user_email: string,
+    messageId: string,
+    attachment_id: string,
+  ): Promise<Buffer> {
+    // Set to the local function (e.g. http://localhost:8086) in development
+    const retrieveAttachmentUrl: string =
+      this.configService.get<string>('RETRIEVEATTACHMENT');
+
+    // The function fetches the content from Gmail once, keeps it in the
+    // attachment blob store and streams the raw bytes back
+    const response = await axios.post(
+      retrieveAttachmentUrl,
+      { user_email, messageId, attachment_id },
+      {
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        responseType: 'arraybuffer',
+      },
+    );
+
+    return Buffer.from(response.data);
+  }
+
   async watchAchievementsCourtTerme(userId: any): Promise<any> {
     try {
       console.log('Watching achievements for user:', userId);
@@ -0,0 +1,217 @@
+import os
+import queue
+import hashlib
+import threading
+import sentry_sdk
+
+from gmail_quota import execute_gmail
+from blob_store import iter_base64_chunks
+
+
+def is_calendar_attachment(attachment):
+    """Check whether an attachment is an iCalendar invitation."""
+    return attachment.get('mimeType') in ('text/calendar', 'application/ics') or attachment.get('filename', '').lower().endswith('.ics')
+
+
+def get_attachment_data(service, user_email, message_id, attachment, cache_dir='/tmp/attachments', cache_max_bytes=256 * 1024 * 1024):
+    """
+    Get the content of an attachment, from the local cache or from the Gmail API.
+    Ingestion only stores attachment metadata: this is how the bytes are retrieved.
+
+    Args:
+        service: Authenticated Gmail API service
+        user_email: User's email address
+        message_id: Gmail message ID
+        attachment: Attachment metadata, with attachment_id
+        cache_dir: Directory of the local cache, None to disable it
+        cache_max_bytes: Size above which the oldest cached attachments are evicted
+
+    Returns:
+        Base64url encoded content of the attachment, as returned by Gmail
+    """
+    # Attachments stored before metadata-only ingestion still hold their data
+    if attachment.get('data'):
+        return attachment['data']
+
+    cache_path = None
+    if cache_dir:
+        key = hashlib.sha256(f"{user_email}:{message_id}:{attachment['attachment_id']}".encode('utf-8')).hexdigest()
+        cache_path = os.path.join(cache_dir, key)
+        try:
+            with open(cache_path, 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+
+    response = execute_gmail(
+        service.users().messages().attachments().get(userId=user_email, messageId=message_id, id=attachment['attachment_id']),
+        'messages.attachments.get',
+        user_email
+    )
+    data = response.get('data')
+
+    if cache_path and data:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Written aside then renamed, so that readers never see a partial file
+            temp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'w') as f:
+                f.write(data)
+            os.replace(temp_path, cache_path)
+            evict_cache(cache_dir, cache_max_bytes)
+        except OSError as e:
+            print(f"Error caching attachment of message {message_id}: {e}")
+
+    return data
+
+
+def evict_cache(cache_dir, max_bytes):
+    """
+    Remove the least recently written attachments until the cache fits in max_bytes.
+
+    Args:
+        cache_dir: Directory of the local cache
+        max_bytes: Maximum size of the cache
+    """
+    entries = []
+    total = 0
+    with os.scandir(cache_dir) as it:
+        for entry in it:
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+
+
+def store_attachment(service, db, store, user_email, message_id, attachment, config):
+    """
+    Make sure the content of an attachment is in the blob store, and referenced by its email.
+    Identical contents are stored once, whatever the email they come from.
+
+    Args:
+        service: Authenticated Gmail API service
+        db: Database connection
+        store: Blob store (see blob_store.get_blob_store)
+        user_email: User's email address
+        message_id: Gmail message ID
+        attachment: Attachment metadata, with attachment_id
+        config: Application configuration
+
+    Returns:
+        Reference to the blob: dictionary with sha256 and size
+    """
+    if attachment.get('sha256') and store.exists(attachment['sha256']):
+        return {'sha256': attachment['sha256'], 'size': attachment.get('size', 0)}
+
+    data = get_attachment_data(
+        service,
+        user_email,
+        message_id,
+        attachment,
+        cache_dir=config['attachment_cache_dir'],
+        cache_max_bytes=config['attachment_cache_max_bytes']
+    )
+    ref = store.put_stream(iter_base64_chunks(data or ''))
+
+    db.emails.update_one(
+        {'messageId': message_id, 'attachments.attachment_id': attachment['attachment_id']},
+        {'$set': {'attachments.$.sha256': ref['sha256'], 'attachments.$.size': ref['size']}, '$unset': {'attachments.$.data': ''}}
+    )
+    return ref
+
+
+class AttachmentPrefetcher:
+    """
+    Low-priority background worker filling the attachment cache, or the blob
+    store when one is given.
+
+    A single thread fetches the queued attachments one at a time, so prefetching
+    never competes with ingestion for more than one Gmail call. The queue is
+    bounded: attachments that do not fit are simply fetched on demand later.
+    """
+    def __init__(self, service_factory, user_email, config, db=None, store=None, max_queued=1000):
+        """
+        Args:
+            service_factory: Callable building a Gmail API service for the worker thread
+            user_email: User's email address
+            config: Application configuration
+            db: Database connection, required with store
+            store: Optional blob store the attachments are saved to
+            max_queued: Maximum number of attachments waiting to be fetched
+        """
+        self.service_factory = service_factory
+        self.user_email = user_email
+        self.config = config
+        self.db = db
+        self.store = store
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name='attachment-prefetch', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def enqueue(self, message_id, attachments):
+        """
+        Queue the attachments of a message for prefetching, dropping them if the queue is full.
+        With a blob store, the email must already be stored so that it can reference its blobs.
+        """
+        for attachment in attachments:
+            try:
+                self._queue.put_nowait((message_id, attachment))
+            except queue.Full:
+                return
+
+    def close(self, timeout=None):
+        """
+        Stop the worker once the queued attachments are fetched, or after timeout seconds.
+
+        Args:
+            timeout: Seconds to wait for the queue to drain (defaults to ATTACHMENT_PREFETCH_TIMEOUT)
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(self.config['attachment_prefetch_timeout'] if timeout is None else timeout)
+            self._thread = None
+
+    def _run(self):
+        service = None
+        while True:
+            try:
+                message_id, attachment = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._stopped.is_set():
+                    return
+                continue
+
+            try:
+                if service is None:
+                    service = self.service_factory()
+                if self.store is not None:
+                    store_attachment(service, self.db, self.store, self.user_email, message_id, attachment, self.config)
+                else:
+                    get_attachment_data(
+                        service,
+                        self.user_email,
+                        message_id,
+                        attachment,
+                        cache_dir=self.config['attachment_cache_dir'],
+                        cache_max_bytes=self.config['attachment_cache_max_bytes']
+                    )
+            except Exception as e:
+                sentry_sdk.capture_exception(e)
+                print(f"Error prefetching attachment of message {message_id}: {e}")
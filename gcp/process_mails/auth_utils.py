@@ -1,17 +1,55 @@
+import time
+import threading
+from datetime import datetime, timezone
 import requests
-import json
+import sentry_sdk
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def refresh_access_token(refresh_token, client_id, client_secret):
+TOKEN_URI = 'https://oauth2.googleapis.com/token'
+
+# Access tokens are refreshed this many seconds before they expire
+EXPIRY_MARGIN = 300
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class TokenRefreshError(Exception):
+    """The token endpoint did not return an access token."""
+
+
+def get_token_session():
+    """
+    Get the process-wide HTTP session of the token endpoint, keeping its
+    connections open between refreshes.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=frozenset(['POST']),
+            )
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=16, max_retries=retry))
+            _session = session
+        return _session
+
+
+def request_access_token(refresh_token, client_id, client_secret):
     """
-    Refresh OAuth2 access token using the refresh token.
-    
+    Exchange a refresh token for a new access token.
+
     Args:
         refresh_token: OAuth2 refresh token
         client_id: Google OAuth2 client ID
         client_secret: Google OAuth2 client secret
-        
+
     Returns:
-        Tuple of (new_access_token, new_refresh_token)
+        Response of the token endpoint: access_token, expires_in and possibly a new refresh_token
     """
     data = {
         'client_id': client_id,
@@ -19,6 +57,129 @@ def refresh_access_token(refresh_token, client_id, client_secret):
         'refresh_token': refresh_token,
         'grant_type': 'refresh_token'
     }
-    response = requests.post('https://oauth2.googleapis.com/token', data=data)
-    response_data = response.json()
-    return response_data.get('access_token'), response_data.get('refresh_token', refresh_token)
\ No newline at end of file
+    response = get_token_session().post(TOKEN_URI, data=data, timeout=(5, 30))
+    return response.json()
+
+
+class AccessTokenManager:
+    """
+    Per-process cache of the access tokens of accounts, shared by the Gmail and
+    Calendar services.
+
+    An access token is reused until EXPIRY_MARGIN seconds before it expires.
+    Tokens are saved on the account's tokens document (accessToken and
+    expiry_date, in milliseconds like the API writes it), so other instances
+    reuse them too. Refreshes are single-flight: threads needing the token of
+    an account while it is refreshed wait for that refresh instead of starting
+    their own.
+    """
+    def __init__(self, margin=EXPIRY_MARGIN):
+        """
+        Args:
+            margin: Seconds before expiry from which a token is refreshed
+        """
+        self.margin = margin
+        self._tokens = {}
+        self._refresh_tokens = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get_access_token(self, db, account_id, config, stale_token=None):
+        """
+        Get a valid access token of an account, refreshing it if needed.
+
+        Args:
+            db: Database connection
+            account_id: ID of the account
+            config: Application configuration, with the OAuth client ID and secret
+            stale_token: Access token rejected by Google, refreshed even if it has not expired
+
+        Returns:
+            Tuple of (access token, expiry as a naive UTC datetime)
+
+        Raises:
+            TokenRefreshError: If the account has no refresh token or the refresh failed
+        """
+        key = str(account_id)
+        cached = self._valid(self._tokens.get(key), stale_token)
+        if cached:
+            return cached
+
+        with self._account_lock(key):
+            # Refreshed by another thread while this one was waiting
+            cached = self._valid(self._tokens.get(key), stale_token)
+            if cached:
+                return cached
+
+            user_tokens = self._find_tokens(db, account_id) or {}
+            stored = self._stored_token(user_tokens)
+            cached = self._valid(stored, stale_token)
+            if cached:
+                self._tokens[key] = stored
+                return cached
+
+            # Remembered for refreshes made when the database is not reachable
+            refresh_token = user_tokens.get('refreshToken') or self._refresh_tokens.get(key)
+            if not refresh_token:
+                raise TokenRefreshError(f"No refresh token for account {account_id}")
+
+            response_data = request_access_token(refresh_token, config['client_id'], config['client_secret'])
+            access_token = response_data.get('access_token')
+            if not access_token:
+                raise TokenRefreshError(f"Token refresh failed for account {account_id}: {response_data.get('error', 'no access token')}")
+
+            entry = (access_token, time.time() + int(response_data.get('expires_in', 3600)))
+            self._tokens[key] = entry
+            self._refresh_tokens[key] = response_data.get('refresh_token', refresh_token)
+            self._save_tokens(db, account_id, entry, response_data.get('refresh_token', refresh_token), refresh_token)
+            return self._valid(entry)
+
+    def _valid(self, entry, stale_token=None):
+        if not entry:
+            return None
+        access_token, expires_at = entry
+        if access_token == stale_token or expires_at - self.margin <= time.time():
+            return None
+        return access_token, datetime.fromtimestamp(expires_at, timezone.utc).replace(tzinfo=None)
+
+    def _account_lock(self, key):
+        with self._lock:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+    def _stored_token(self, user_tokens):
+        try:
+            expiry_date = float(user_tokens.get('expiry_date') or 0)
+        except (TypeError, ValueError):
+            return None
+        if not user_tokens.get('accessToken') or not expiry_date:
+            return None
+        return user_tokens['accessToken'], expiry_date / 1000
+
+    def _find_tokens(self, db, account_id):
+        # Services outlive the request that built them: the database is best-effort here
+        try:
+            return db.tokens.find_one({'accountId': account_id}, {'accessToken': 1, 'expiry_date': 1, 'refreshToken': 1})
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            print(f"Error reading tokens of account {account_id}: {e}")
+            return None
+
+    def _save_tokens(self, db, account_id, entry, new_refresh_token, refresh_token):
+        fields = {'accessToken': entry[0], 'expiry_date': int(entry[1] * 1000)}
+        if new_refresh_token != refresh_token:
+            fields['refreshToken'] = new_refresh_token
+        try:
+            db.tokens.update_one({'accountId': account_id}, {'$set': fields})
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            print(f"Error saving tokens of account {account_id}: {e}")
+
+
+_token_manager = AccessTokenManager()
+
+
+def get_token_manager():
+    """Get the process-wide AccessTokenManager."""
+    return _token_manager
@@ -0,0 +1,95 @@
+import time
+from datetime import datetime
+
+from gmail_utils import iter_message_id_pages
+from sync_state import get_backfill_checkpoint, save_backfill_checkpoint, clear_backfill_checkpoint
+
+
+class BackfillProgress:
+    """
+    Progress of a resumable backfill, checkpointed in the sync_state document
+    of the account after every page of messages.
+
+    A backfill interrupted by a timeout, or stopped because its time budget is
+    spent, resumes from the last page it did not finish. Messages of that page
+    that were already stored are skipped by the "already processed" filter.
+    """
+    def __init__(self, db, user_email, job, time_budget=0, initial=None):
+        """
+        Args:
+            db: Database connection
+            user_email: Email address of the account
+            job: Name of the backfill
+            time_budget: Seconds after which the backfill stops at the next page
+                         boundary, 0 for no limit
+            initial: Fields of the checkpoint when no backfill is in progress
+        """
+        self.db = db
+        self.user_email = user_email
+        self.job = job
+        self.deadline = time.monotonic() + time_budget if time_budget else None
+        self.stopped = False
+
+        checkpoint = get_backfill_checkpoint(db, user_email, job)
+        self.resumed = checkpoint is not None
+        if checkpoint is None:
+            checkpoint = {
+                **(initial or {}),
+                'pageToken': None,
+                'pages': 0,
+                'processed': 0,
+                'startedAt': datetime.now(),
+            }
+        self.checkpoint = checkpoint
+
+        if self.resumed:
+            print(f"Resuming {job} backfill for {user_email} after {checkpoint['pages']} pages")
+
+    def get(self, key, default=None):
+        return self.checkpoint.get(key, default)
+
+    def save(self, **fields):
+        """Update the checkpoint and store it."""
+        self.checkpoint.update(fields)
+        save_backfill_checkpoint(self.db, self.user_email, self.job, self.checkpoint)
+
+    def add_processed(self, count, lost=0):
+        """Count emails stored, and emails lost, since the last checkpoint."""
+        self.checkpoint['processed'] += count
+        if lost:
+            self.checkpoint['lost'] = self.checkpoint.get('lost', 0) + lost
+
+    def out_of_time(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def iter_pages(self, service, query=None, label_ids=None):
+        """
+        Iterate over the pages of message IDs from the checkpointed page token.
+        The caller must have processed a page before asking for the next one:
+        the checkpoint moves past a page only at that point.
+
+        Args:
+            service: Authenticated Gmail API service
+            query: Optional Gmail search query
+            label_ids: Optional list of label IDs to filter on
+
+        Yields:
+            Lists of message IDs
+        """
+        page_token = self.checkpoint.get('pageToken')
+        for page_ids, next_page_token in iter_message_id_pages(service, user_id=self.user_email, query=query, label_ids=label_ids, page_token=page_token):
+            yield page_ids
+
+            self.save(
+                pageToken=next_page_token,
+                pages=self.checkpoint['pages'] + 1,
+                lastMessageId=page_ids[-1] if page_ids else self.checkpoint.get('lastMessageId'),
+            )
+            if next_page_token and self.out_of_time():
+                print(f"Time budget spent, {self.job} backfill will resume from page {self.checkpoint['pages']}")
+                self.stopped = True
+                return
+
+    def complete(self):
+        """Remove the checkpoint once the backfill is finished."""
+        clear_backfill_checkpoint(self.db, self.user_email, self.job)
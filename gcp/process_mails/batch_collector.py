@@ -0,0 +1,43 @@
+import os
+import time
+import functions_framework
+import sentry_sdk
+
+from config import load_config, init_sentry
+from db_manager import get_database
+from mistral_batch import collect_batch_jobs
+
+init_sentry()
+
+API_KEY_MISTRAL = os.environ.get('API_KEY_MISTRAL')
+
+
+@functions_framework.http
+def collect_pending_batch_jobs(request):
+    """
+    Wait for the uncollected Mistral batch jobs of every account and write their results back.
+    Synchronizations only poll their jobs once: waiting for them is left to this function,
+    which runs for at most MISTRAL_BATCH_WAIT seconds and leaves unfinished jobs for its next run.
+
+    Args:
+        request: HTTP request
+
+    Returns:
+        Dict with status, number of accounts with pending jobs and number of emails updated
+    """
+    try:
+        config = load_config()
+        db = get_database()
+
+        user_emails = db.mistral_batch_jobs.distinct('userEmail', {'collectedAt': {'$exists': False}})
+        deadline = time.monotonic() + config['mistral_batch_wait']
+        updated = 0
+        for user_email in user_emails:
+            updated += collect_batch_jobs(db, user_email, API_KEY_MISTRAL, timeout=max(0, deadline - time.monotonic()))
+
+        print(f"Collected batch jobs of {len(user_emails)} accounts, {updated} emails updated")
+        return {'status': 'success', 'accounts': len(user_emails), 'emailsUpdated': updated}
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        print(f"Error in collect_pending_batch_jobs: {str(e)}")
+        return {'status': 'error', 'message': str(e)}
@@ -1,38 +1,46 @@
 import os
+import uuid
+import threading
+from contextlib import nullcontext
 from datetime import datetime, timedelta
 import functions_framework
-import time
 import sentry_sdk
-import chromadb
+from googleapiclient.errors import HttpError
 
-from constants import CATEGORIES, PROMPT_CATEGORIES, INSTRUCTIONS_TEMPLATE, INSTRUCTIONS_WITH_CONTEXT_TEMPLATE
-from config import load_config
-from user_utils import get_user_by_email
+from constants import INSTRUCTIONS_TEMPLATE, INSTRUCTIONS_WITH_CONTEXT_TEMPLATE
+from prompt_context import default_prompt_context
+from config import load_config, init_sentry
+from user_utils import get_user_profile
 from google_utils import setup_gmail_service, setup_calendar_service
 from db_manager import MongoDBConnectionManager
-from email_processor import fetch_email
+from email_processor import prepare_email, categorize_email, route_message, ROUTE_SKIP, ROUTE_METADATA
+from gmail_quota import is_retryable_error
+from gmail_utils import batch_get_messages, list_history_changes, get_current_history_id, is_history_expired_error, is_not_found_error, MAX_BATCH_SIZE, METADATA_FIELDS, METADATA_HEADERS, DraftResolver
+from email_store import filter_unseen_message_ids, apply_label_changes, WriteBuffer, ThreadStateCache
+from sync_state import get_history_id, save_history_id, get_backfill_checkpoint, clear_backfill_checkpoint, MessageFailures, acquire_sync_lease, release_sync_lease
+from backfill import BackfillProgress
+from pipeline import Pipeline, Stage, per_worker
+from mistral_batch import MistralBatch, collect_batch_jobs
 from chromadb_utils import insert_email_to_chromadb
 from calendar_utils import get_event_invitation_status, get_event_id
+from attachments import get_attachment_data, is_calendar_attachment, AttachmentPrefetcher
+from blob_store import get_blob_store
 
 
-# Initialize Sentry for error tracking
-def init_sentry():
-    sentry_sdk.init(
-        dsn=os.environ.get('SENTRY_SDK'),
-        traces_sample_rate=1.0,
-        profiles_sample_rate=1.0,
-    )
-
 API_KEY_MISTRAL = os.environ.get('API_KEY_MISTRAL')
+
+BACKFILL_JOB = 'last_30_days'
         
 init_sentry()
 
-chroma_client = chromadb.PersistentClient(path="/tmp/chroma_db")
-
 @functions_framework.http
 def batch_last_30_days(request):
     """
     Process emails from the last 30 days for a specified user.
+    Only the changes since the previous run are processed when possible,
+    unless the request asks for a full synchronization with "mode": "full".
+    The account is synchronized under its lease, so that it is never
+    synchronized by this function and by the scheduler at the same time.
     
     Args:
         request: HTTP request containing user email
@@ -57,121 +65,448 @@ def batch_last_30_days(request):
                 print(f"No account found for email: {user_email}")
                 return {'status': 'error', 'message': 'Account not found'}, 404
             
+            lease_owner = f"http-{uuid.uuid4().hex}"
+            if not acquire_sync_lease(db, user_email, lease_owner, config['sync_lease_seconds']):
+                print(f"Account {user_email} is already being synchronized")
+                return {'status': 'error', 'message': 'Account is already being synchronized'}, 409
+
             print(f"Processing account: {user_email}")
 
-            user = get_user_by_email(user_email, db)
-            update_categories_from_user(user)
-            #user = users_collection.find_one({'email': user_email})
-            gmail_service = setup_gmail_service(db, existing_account, config)
-            if not gmail_service:
+            try:
+                result = sync_account(db, existing_account, config, days=15, full=data.get('mode') == 'full')
+            finally:
+                try:
+                    release_sync_lease(db, user_email, lease_owner)
+                except Exception as e:
+                    # The lease expires on its own: the outcome of the synchronization is still returned
+                    sentry_sdk.capture_exception(e)
+                    print(f"Error releasing the synchronization lease of {user_email}: {str(e)}")
+
+            if result['status'] == 'unauthenticated':
                 return {'status': 'error', 'message': 'Failed to authenticate'}, 401
-            
-            emails_processed = process_recent_emails(
-                gmail_service, 
-                user_email, 
-                db, 
-                existing_account,
-                config,
-                days=15
-            )
+
             return {
                 'status': 'success',
-                "email_processed": emails_processed
+                "email_processed": result['emailsProcessed'],
+                "sync_mode": result['syncMode']
             }
     except Exception as e:
         sentry_sdk.capture_exception(e)
         print(f"Error in batch_last_30_days: {str(e)}")
         return {'status': 'error', 'message': str(e)}
 
-def update_categories_from_user(user):
-    global PROMPT_CATEGORIES, CATEGORIES
+def sync_account(db, existing_account, config, days=15, full=False):
+    """
+    Synchronize the emails of one account.
+    Categories are resolved for this account only and passed down explicitly,
+    so several accounts can be synchronized concurrently in the same process.
 
-    # Extract categories and descriptions from the user's profile type information
-    new_categories = []
-    category_descriptions = []
+    Args:
+        db: Database connection
+        existing_account: Account document
+        config: Application configuration
+        days: Number of days in the past to process for a windowed backfill
+        full: Force a windowed backfill even if a historyId is stored
 
-    for category in user['profileTypeInfo']['categories']:
-        if category['disable'] == False:
-            new_categories.append(category['name'])
-            description = category.get('description', '')  # Default to empty string if no description
-            category_descriptions.append(f"{category['name']}: {description}")
+    Returns:
+        Dict with status ('success' or 'unauthenticated'), emailsProcessed and syncMode
+    """
+    user_email = existing_account['email']
 
-    # Update the CATEGORIES list
-    CATEGORIES = new_categories
+    # Cached per process: the profile type of a user rarely changes
+    profile = get_user_profile(user_email, db)
+    prompt_context = profile.prompt_context if profile else None
 
-    # Update the PROMPT_CATEGORIES string with descriptions
-    PROMPT_CATEGORIES = "\n" + "\n".join(category_descriptions) + "\n"
-    
-def process_recent_emails(gmail_service, user_email, db, existing_account, config, days=30, batch_size=10 ):
+    gmail_service = setup_gmail_service(db, existing_account, config)
+    if not gmail_service:
+        return {'status': 'unauthenticated', 'emailsProcessed': 0, 'syncMode': None}
+
+    emails_processed, sync_mode = sync_emails(
+        gmail_service,
+        user_email,
+        db,
+        existing_account,
+        config,
+        days=days,
+        full=full,
+        prompt_context=prompt_context
+    )
+
+    # Write back the summaries of the batch jobs already finished, without waiting for
+    # the others: collect_batch_jobs_entry_point waits for them
+    collect_batch_jobs(db, user_email, API_KEY_MISTRAL, timeout=0)
+
+    return {'status': 'success', 'emailsProcessed': emails_processed, 'syncMode': sync_mode}
+
+def process_recent_emails(gmail_service, user_email, db, existing_account, config, days=30, history_id=None, prompt_context=None):
     """
     Process emails from the recent past.
-    
+
+    Progress is checkpointed after every page of emails: if an invocation is
+    interrupted, or stops because BACKFILL_TIME_BUDGET is spent, the next one
+    resumes where it stopped.
+
+    With MISTRAL_BATCH_BACKFILL enabled, emails are categorized by Mistral
+    batch jobs, submitted after every page, instead of one request per email.
+
     Args:
         gmail_service: Authenticated Gmail API service
         user_email: User's email address
         db: Database connection
+        existing_account: Account document of the user
+        config: Application configuration
         days: Number of days in the past to process
-        batch_size: Number of emails to process before pausing
-        
+        history_id: Mailbox historyId read before the backfill started, kept in the checkpoint
+        prompt_context: PromptContext of the user's categories (see user_utils.get_user_profile)
+
     Returns:
-        Number of new emails processed and stored
+        Tuple of (number of new emails processed and stored, number of emails lost, see ingest_messages)
     """
-    # Calculate timestamp for query
+    # A backfill interrupted by a timeout resumes with its original query
     days_ago = int((datetime.now() - timedelta(days=days)).timestamp())
-    query = f'after:{days_ago}'
-    
-    # Fetch email IDs
-    response = gmail_service.users().messages().list(userId='me', q=query).execute()
-    messages = response.get('messages', [])
-    
-    # Track statistics
-    emails_inserted = 0
-    processed_count = 0
-    
-    for message in messages:
+    progress = BackfillProgress(
+        db,
+        user_email,
+        BACKFILL_JOB,
+        time_budget=config['backfill_time_budget'],
+        initial={'query': f'after:{days_ago}', 'historyId': history_id}
+    )
+
+    def unseen_pages():
+        # Go through every page of email IDs matching the query and skip
+        # already processed emails with one query per page, before any fetch
+        for page_ids in progress.iter_pages(gmail_service, query=progress.get('query')):
+            unseen_ids = filter_unseen_message_ids(db, page_ids)
+            print(f"Found {len(page_ids)} emails, {len(unseen_ids)} not processed yet")
+            yield unseen_ids
+
+    batch = None
+    if config['mistral_batch_backfill']:
+        categories = list((prompt_context or default_prompt_context()).categories)
+        batch = MistralBatch(db, user_email, API_KEY_MISTRAL, categories=categories, model=config['mistral_batch_model'])
+
+    # Listed messages exclude spam and trash: metadata is only worth fetching first if some labels are stored without body
+    emails_processed, _ = ingest_messages(
+        unseen_pages(),
+        user_email,
+        db,
+        existing_account,
+        config,
+        prompt_context,
+        on_page_done=progress.add_processed,
+        batch=batch,
+        metadata_first=bool(config['metadata_only_labels'])
+    )
+
+    # Emails lost by the earlier invocations of a resumed backfill are counted too
+    emails_lost = progress.get('lost', 0)
+    if not progress.stopped:
+        progress.complete()
+
+    return emails_processed, emails_lost
+
+
+def sync_new_emails(gmail_service, user_email, db, existing_account, config, history_id, prompt_context=None):
+    """
+    Process only the changes of the mailbox since the last synchronization:
+    new emails are ingested and label changes are applied to stored emails.
+
+    Args:
+        gmail_service: Authenticated Gmail API service
+        user_email: User's email address
+        db: Database connection
+        existing_account: Account document of the user
+        config: Application configuration
+        history_id: historyId the account was last synchronized up to
+        prompt_context: PromptContext of the user's categories (see user_utils.get_user_profile)
+
+    Returns:
+        Tuple of (number of new emails processed and stored, latest historyId,
+        number of emails lost, see ingest_messages)
+
+    Raises:
+        HttpError: 404 when history_id has expired
+    """
+    changes = list_history_changes(gmail_service, history_id, user_id=user_email)
+
+    unseen_ids = filter_unseen_message_ids(db, changes['added'])
+    print(f"Found {len(changes['added'])} new emails since history {history_id}, {len(unseen_ids)} not processed yet")
+
+    # History also reports messages added to spam or trash: route them on their metadata first
+    emails_processed, emails_lost = ingest_messages([unseen_ids], user_email, db, existing_account, config, prompt_context, metadata_first=True)
+
+    labels_modified = apply_label_changes(db, changes['labels_added'], changes['labels_removed'])
+    print(f"Applied label changes to {labels_modified} emails")
+
+    return emails_processed, changes['history_id'], emails_lost
+
+
+def sync_emails(gmail_service, user_email, db, existing_account, config, days=30, full=False, prompt_context=None):
+    """
+    Synchronize the mailbox of a user.
+
+    When a historyId was stored by a previous synchronization, only the changes
+    since then are processed. Otherwise, or when the historyId has expired or a
+    full synchronization is requested, the emails of the last days are processed.
+    The historyId reached is stored for the next synchronization, unless emails
+    could not be fetched or stored: the next synchronization then lists them
+    again from the previous historyId, or with a new backfill, and already
+    stored emails are skipped. Messages failing on every attempt are given up
+    after MESSAGE_MAX_ATTEMPTS synchronizations, so that they cannot hold the
+    historyId back forever.
+
+    Args:
+        gmail_service: Authenticated Gmail API service
+        user_email: User's email address
+        db: Database connection
+        existing_account: Account document of the user
+        config: Application configuration
+        days: Number of days in the past to process for a windowed backfill
+        full: Force a windowed backfill even if a historyId is stored
+        prompt_context: PromptContext of the user's categories (see user_utils.get_user_profile)
+
+    Returns:
+        Tuple of (number of new emails processed and stored, sync mode used:
+        'delta', 'backfill' or 'backfill_partial' when the backfill must be resumed)
+    """
+    if full:
+        clear_backfill_checkpoint(db, user_email, BACKFILL_JOB)
+    backfill_checkpoint = get_backfill_checkpoint(db, user_email, BACKFILL_JOB)
+    history_id = None if full else get_history_id(db, user_email)
+
+    # Deltas only start once the initial backfill is over
+    if history_id and not backfill_checkpoint:
         try:
-            # Skip already processed emails
-            if db.emails.find_one({'messageId': message['id']}):
+            emails_processed, new_history_id, emails_lost = sync_new_emails(gmail_service, user_email, db, existing_account, config, history_id, prompt_context)
+            if emails_lost:
+                print(f"{emails_lost} new emails were not stored, keeping history {history_id} to retry them")
+            else:
+                save_history_id(db, user_email, new_history_id)
+            return emails_processed, 'delta'
+        except Exception as e:
+            if not is_history_expired_error(e):
+                raise
+            print(f"History {history_id} expired, falling back to a {days} days backfill")
+
+    # Read the historyId before listing so that changes made during the backfill are caught by the next delta
+    if backfill_checkpoint:
+        new_history_id = backfill_checkpoint.get('historyId')
+    else:
+        new_history_id = get_current_history_id(gmail_service, user_id=user_email)
+
+    emails_processed, emails_lost = process_recent_emails(gmail_service, user_email, db, existing_account, config, days=days, history_id=new_history_id, prompt_context=prompt_context)
+
+    if get_backfill_checkpoint(db, user_email, BACKFILL_JOB):
+        return emails_processed, 'backfill_partial'
+
+    if emails_lost:
+        # Without a historyId, the next synchronization backfills again and retries them
+        print(f"{emails_lost} emails were not stored, not saving history {new_history_id}")
+        return emails_processed, 'backfill'
+
+    save_history_id(db, user_email, new_history_id)
+    return emails_processed, 'backfill'
+
+
+def ingest_messages(pages, user_email, db, existing_account, config, prompt_context=None, on_page_done=None, batch=None, metadata_first=False):
+    """
+    Fetch, categorize and store messages.
+
+    Emails go through a staged pipeline: Gmail fetch and decoding, then
+    categorization (thread lookup and Mistral call), then storage (MongoDB and
+    ChromaDB). Each stage has its own worker pool and stages are connected by
+    bounded queues, so different emails are fetched, categorized and stored
+    concurrently. Pages are processed one after the other: a page is fully
+    stored before the next one is requested. Gmail calls are paced by the
+    process-wide Gmail quota scheduler.
+
+    Args:
+        pages: Iterable of lists of message IDs, consumed lazily
+        user_email: User's email address
+        db: Database connection
+        existing_account: Account document of the user
+        config: Application configuration
+        prompt_context: PromptContext of the user's categories, defaults to the standard categories
+        on_page_done: Optional callable receiving the numbers of emails stored and lost for each page
+        batch: Optional MistralBatch the categorizations are deferred to, submitted after every page
+        metadata_first: Fetch messages in 'metadata' format first, and their full body only
+                        when they are neither skipped nor stored from metadata
+
+    Returns:
+        Tuple of (number of new emails processed and stored, number of emails lost:
+        messages that could not be fetched, processed or stored and are worth
+        retrying, see sync_state.MessageFailures). Messages deleted since they
+        were listed are not lost.
+    """
+    prompt_context = prompt_context or default_prompt_context()
+
+    # Draft IDs of the whole run are resolved from a single listing of the drafts
+    draft_resolver = DraftResolver(user_email)
+
+    # Thread context of the run, loaded in bulk for each fetched batch of messages
+    thread_cache = ThreadStateCache(db)
+
+    # Looked up once per worker rather than for every chunk; the service itself is shared by threads
+    get_fetch_service = per_worker(lambda: setup_gmail_service(db, existing_account, config))
+    # Looked up once per store worker rather than for every invitation
+    get_calendar_service = per_worker(lambda: setup_calendar_service(db, existing_account, config))
+
+    # Messages failing on every attempt are given up after MESSAGE_MAX_ATTEMPTS synchronizations
+    failures = MessageFailures(db, user_email, config['message_max_attempts'])
+
+    def get_messages(service, message_ids, **kwargs):
+        # Messages batch_get_messages could not fetch are missing from its result
+        errors = {}
+        messages = batch_get_messages(service, message_ids, user_id=user_email, errors=errors, **kwargs)
+        for message_id in message_ids:
+            if message_id in messages:
                 continue
-            
-            # Process email
-            email_data = fetch_email(gmail_service, user_email, message['id'], db, INSTRUCTIONS_WITH_CONTEXT_TEMPLATE, INSTRUCTIONS_TEMPLATE, PROMPT_CATEGORIES, API_KEY_MISTRAL, CATEGORIES)
-            insert_email_to_chromadb(
-                email_data['from'],
-                email_data['to'],
-                email_data['subject'],
-                email_data['date'],
-                email_data['html'],
-            )
-            
-            # Store email data
-            if email_data:
-                print(f"Processing email: {email_data['isGoogleInvitation']}")
-                if email_data.get('isGoogleInvitation') == True:
-                    calendar_service = setup_calendar_service(db, existing_account, config)
-                    status = get_event_invitation_status(calendar_service, email_data.get('attachments', [])[0])
-                    event_id = get_event_id(email_data.get('attachments', [])[0])
-                    print(f"Invitation status: {status}")
-                    email_data['invitationStatus'] = status
-                    email_data['eventId'] = event_id
-                    
-                current_time = datetime.now()
-                email_data['createdAt'] = current_time
-                email_data['updatedAt'] = current_time
-                
-                
-                db.emails.insert_one(email_data)
-                emails_inserted += 1
-            
-            # Rate limiting
-            processed_count += 1
-            if processed_count % batch_size == 0:
-                print(f"Processed {batch_size} emails, pausing for rate limiting...")
-                time.sleep(1)
-                
+            error = errors.get(message_id)
+            if is_not_found_error(error):
+                print(f"Message {message_id} was deleted since it was listed")
+            else:
+                # Other client errors would fail again: only rate limits, server and network errors are retried
+                failures.record([message_id], error, permanent=isinstance(error, HttpError) and not is_retryable_error(error))
+        return messages
+
+    def fetch_messages(service, chunk):
+        if not metadata_first:
+            return list(get_messages(service, chunk).values())
+
+        # Decide on headers and labels only, then fetch bodies for the messages that need them
+        metadata = get_messages(service, chunk, format='metadata', fields=METADATA_FIELDS, metadata_headers=METADATA_HEADERS)
+        full_ids = []
+        messages = []
+        for message_id, message in metadata.items():
+            route = route_message(message, config['skip_labels'], config['metadata_only_labels'])
+            if route == ROUTE_METADATA:
+                messages.append(message)
+            elif route != ROUTE_SKIP:
+                full_ids.append(message_id)
+        print(f"Metadata fetch: {len(full_ids)} full, {len(messages)} metadata only, {len(metadata) - len(full_ids) - len(messages)} skipped")
+
+        if full_ids:
+            messages.extend(get_messages(service, full_ids).values())
+        return messages
+
+    def fetch_stage(chunk):
+        service = get_fetch_service()
+        chunk = failures.without_given_up(chunk)
+        # Fetch messages through Gmail batch requests
+        try:
+            messages = fetch_messages(service, chunk)
         except Exception as e:
-            sentry_sdk.capture_exception(e)
-            print(f"Error processing message {message['id']}: {str(e)}")
-            continue
-    
-    return emails_inserted
\ No newline at end of file
+            # The whole batch request failed: none of its messages were fetched
+            failures.record(chunk, e)
+            raise
+        thread_cache.seed(message.get('threadId') for message in messages)
+        for message in messages:
+            try:
+                yield prepare_email(service, user_email, message['id'], message, draft_resolver, config['attachment_metadata_only'])
+            except Exception as e:
+                failures.record([message['id']], e)
+                sentry_sdk.capture_exception(e)
+                print(f"Error processing message {message['id']}: {str(e)}")
+
+    def categorize_stage(prepared):
+        with failures.recording(prepared['message']['id']):
+            return categorize_email(prepared, db, INSTRUCTIONS_WITH_CONTEXT_TEMPLATE, INSTRUCTIONS_TEMPLATE, prompt_context, API_KEY_MISTRAL, write_buffer, batch, thread_cache)
+
+    def store_stage(email_data):
+        with failures.recording(email_data['messageId']):
+            return store_email(email_data)
+
+    def store_email(email_data):
+        attachments = email_data.get('attachments', [])
+        if email_data.get('isGoogleInvitation') == True and attachments:
+            # Only the invitation itself is downloaded during ingestion
+            invitation = next((attachment for attachment in attachments if is_calendar_attachment(attachment)), attachments[0])
+            invitation = {
+                **invitation,
+                'data': get_attachment_data(
+                    get_fetch_service(),
+                    user_email,
+                    email_data['messageId'],
+                    invitation,
+                    cache_dir=config['attachment_cache_dir'],
+                    cache_max_bytes=config['attachment_cache_max_bytes']
+                )
+            }
+            status = get_event_invitation_status(get_calendar_service(), invitation)
+            event_id = get_event_id(invitation)
+            print(f"Invitation status: {status}")
+            email_data['invitationStatus'] = status
+            email_data['eventId'] = event_id
+        elif prefetcher is not None and attachments:
+            with page_attachments_lock:
+                page_attachments.append((email_data['messageId'], attachments))
+
+        current_time = datetime.now()
+        email_data['createdAt'] = current_time
+        email_data['updatedAt'] = current_time
+
+        write_buffer.add_email(email_data)
+
+        insert_email_to_chromadb(
+            email_data['from'],
+            email_data['to'],
+            email_data['subject'],
+            email_data['date'],
+            email_data['html'],
+        )
+        return email_data
+
+    pipeline = Pipeline([
+        Stage('fetch', fetch_stage, workers=config['pipeline_fetch_workers'], expand=True),
+        Stage('categorize', categorize_stage, workers=config['pipeline_categorize_workers']),
+        Stage('store', store_stage, workers=config['pipeline_store_workers']),
+    ], queue_size=config['pipeline_queue_size'])
+
+    emails_processed = 0
+
+    # Attachment contents are only fetched on demand, unless prefetching into the local cache is enabled
+    prefetcher = None
+    page_attachments = []
+    page_attachments_lock = threading.Lock()
+    if config['attachment_prefetch']:
+        prefetcher = AttachmentPrefetcher(
+            lambda: setup_gmail_service(db, existing_account, config),
+            user_email,
+            config,
+            db=db,
+            store=get_blob_store(db, config)
+        )
+
+    # Email inserts and thread upserts are written in bulk
+    with WriteBuffer(
+        db,
+        max_size=config['write_buffer_size'],
+        max_delay=config['write_buffer_delay'],
+        schema_version=config['email_schema_version']
+    ) as write_buffer, prefetcher or nullcontext():
+        for page_ids in pages:
+            page_processed = 0
+            lost_before = failures.lost
+            if page_ids:
+                chunks = (page_ids[start:start + MAX_BATCH_SIZE] for start in range(0, len(page_ids), MAX_BATCH_SIZE))
+                stats = pipeline.run(chunks)
+                write_buffer.flush()
+                # Submitted once the emails are stored, so that results can always be written back
+                if batch is not None:
+                    batch.submit()
+                # Prefetched attachments are referenced by their emails, which must be stored first
+                for message_id, attachments in page_attachments:
+                    prefetcher.enqueue(message_id, attachments)
+                page_attachments.clear()
+                print(f"Pipeline statistics: {stats}")
+                # Emails whose insert failed are not stored, although their pipeline items completed
+                not_written = write_buffer.take_failed_message_ids()
+                if not_written:
+                    failures.record(not_written, 'Email insert failed')
+                page_processed = stats['completed'] - len(not_written)
+
+            emails_processed += page_processed
+            if on_page_done:
+                on_page_done(page_processed, failures.lost - lost_before)
+
+    return emails_processed, failures.lost
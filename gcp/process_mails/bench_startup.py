@@ -0,0 +1,161 @@
+"""
+Startup benchmark of the Cloud Function entry points.
+
+Each target is measured in fresh interpreters, the way a cold start pays it:
+the time to import main, then the function module its entry point loads on
+the first request. The slowest modules of each target are reported from
+python -X importtime.
+
+Usage:
+    python bench_startup.py                         # all targets
+    python bench_startup.py last_30_days --repeat 10
+    python bench_startup.py --save startup.json     # record a baseline
+    python bench_startup.py --baseline startup.json # fail on regressions
+
+The benchmark exits with status 1 when a target takes more than --max-seconds,
+or more than --tolerance above its baseline.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# Entry point of main.py -> module it imports on its first request
+TARGETS = {
+    'last_30_days': 'batch_last_30',
+    'retrieve_email_by_labels_entry_point': 'retrieve_email_by_labels',
+    'transform_email_entry_point': 'transform_email',
+    'retrieve_calendar_events_entry_point': 'retrieve_calendar_events',
+    'sync_accounts_entry_point': 'sync_scheduler',
+    'retrieve_attachment_entry_point': 'retrieve_attachment',
+    'collect_batch_jobs_entry_point': 'batch_collector',
+    'migrations_entry_point': 'migrations',
+}
+
+SNIPPET = """
+import json, time
+start = time.perf_counter()
+import main
+loaded = time.perf_counter()
+import {module}
+end = time.perf_counter()
+print(json.dumps({{'main': loaded - start, 'total': end - start}}))
+"""
+
+
+def measure(module, cwd):
+    """
+    Import main then module in a fresh interpreter.
+
+    Returns:
+        Tuple of (dict with main and total seconds, list of (seconds, module) imports)
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', SNIPPET.format(module=module)],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        env={**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'},
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"exit code {result.returncode}")
+
+    # -X importtime lines: "import time: self [us] | cumulative | imported package".
+    # Top-level imports made by the interpreter and the snippet itself come first.
+    imports = []
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line.split('|', 2)
+            if not cumulative.strip().isdigit() or name.startswith('  '):
+                continue
+            if name.strip() == 'json':
+                imports = []
+            else:
+                imports.append((int(cumulative) / 1e6, name.strip()))
+    return json.loads(result.stdout.strip().splitlines()[-1]), imports
+
+
+def benchmark(targets, repeat, cwd):
+    """
+    Measure each target repeat times and keep its fastest run, the least noisy.
+
+    Returns:
+        Dict mapping each target to its main and total seconds and slowest top-level imports
+    """
+    results = {}
+    for target in targets:
+        module = TARGETS[target]
+        try:
+            runs = [measure(module, cwd) for _ in range(repeat)]
+        except RuntimeError as e:
+            results[target] = {'error': str(e)}
+            continue
+        timings, imports = min(runs, key=lambda run: run[0]['total'])
+        results[target] = {
+            'main': round(timings['main'], 4),
+            'total': round(timings['total'], 4),
+            'slowest': sorted(imports, reverse=True)[:5],
+        }
+    return results
+
+
+def check(results, baseline, max_seconds, tolerance):
+    """
+    List the targets failing to import, slower than max_seconds, or slower than
+    their baseline by more than tolerance.
+    """
+    failures = []
+    for target, result in results.items():
+        if 'error' in result:
+            failures.append(f"{target}: import failed ({result['error']})")
+            continue
+        if max_seconds and result['total'] > max_seconds:
+            failures.append(f"{target}: {result['total']:.3f}s exceeds {max_seconds:.3f}s")
+        reference = (baseline or {}).get(target, {}).get('total')
+        if reference and result['total'] > reference * (1 + tolerance):
+            failures.append(f"{target}: {result['total']:.3f}s is more than {tolerance:.0%} above the baseline {reference:.3f}s")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold start import time of the Cloud Function entry points")
+    parser.add_argument('targets', nargs='*', help=f"Entry points to measure, among {', '.join(TARGETS)} (default: all)")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per target, the fastest is kept")
+    parser.add_argument('--max-seconds', type=float, default=float(os.environ.get('STARTUP_MAX_SECONDS', 5.0)), help="Maximum import time of a target")
+    parser.add_argument('--baseline', help="JSON results of a previous run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed slowdown over the baseline")
+    parser.add_argument('--save', help="Write the results to this JSON file")
+    args = parser.parse_args()
+    unknown = [target for target in args.targets if target not in TARGETS]
+    if unknown:
+        parser.error(f"unknown targets: {', '.join(unknown)}")
+
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    results = benchmark(args.targets or list(TARGETS), args.repeat, cwd)
+
+    for target, result in results.items():
+        if 'error' in result:
+            print(f"{target:40} import failed: {result['error']}")
+            continue
+        print(f"{target:40} main {result['main'] * 1000:8.1f} ms   total {result['total'] * 1000:8.1f} ms")
+        for seconds, module in result['slowest']:
+            print(f"{'':42}{module:30} {seconds * 1000:8.1f} ms")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    failures = check(results, baseline, args.max_seconds, args.tolerance)
+    for failure in failures:
+        print(f"REGRESSION {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
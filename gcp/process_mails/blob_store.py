@@ -0,0 +1,191 @@
+import os
+import uuid
+import base64
+import hashlib
+from gridfs import GridFSBucket
+from pymongo.errors import DuplicateKeyError
+
+from indexes import INDEXES, ensure_indexes
+
+CHUNK_SIZE = 255 * 1024
+
+
+def iter_base64_chunks(data, chunk_size=CHUNK_SIZE):
+    """
+    Decode base64url data slice by slice, so that the decoded content is never held whole.
+
+    Args:
+        data: Base64url encoded string, as returned by the Gmail API
+        chunk_size: Approximate size of the decoded chunks
+
+    Yields:
+        Decoded bytes
+    """
+    data = data.rstrip('=')
+    # A multiple of 4 characters decodes on its own
+    step = max(4, chunk_size // 3 * 4)
+    for start in range(0, len(data), step):
+        piece = data[start:start + step]
+        yield base64.urlsafe_b64decode(piece + '=' * (-len(piece) % 4))
+
+
+class GridFSBlobStore:
+    """
+    Content-addressed blob store on GridFS.
+    Each blob is stored once, as a GridFS file named after the SHA-256 of its content:
+    a unique index on the file names keeps concurrent uploads from storing it twice.
+    """
+    def __init__(self, db, bucket_name='attachments', chunk_size=CHUNK_SIZE):
+        """
+        Args:
+            db: Database connection
+            bucket_name: Name of the GridFS bucket
+            chunk_size: Size of the GridFS chunks
+        """
+        self.bucket = GridFSBucket(db, bucket_name=bucket_name, chunk_size_bytes=chunk_size)
+        self.files = db[f'{bucket_name}.files']
+        if self.files.name in INDEXES:
+            ensure_indexes(db, [self.files.name])
+
+    def exists(self, sha256):
+        return self.files.find_one({'filename': sha256}, {'_id': 1}) is not None
+
+    def put_stream(self, chunks):
+        """
+        Store a blob written chunk by chunk, unless the same content is already stored.
+
+        Args:
+            chunks: Iterable of bytes
+
+        Returns:
+            Reference to the blob: dictionary with sha256 and size
+        """
+        digest = hashlib.sha256()
+        size = 0
+        # The hash is only known at the end: upload under a temporary name, then keep or drop the file
+        upload = self.bucket.open_upload_stream(f"pending-{uuid.uuid4().hex}")
+        try:
+            for chunk in chunks:
+                digest.update(chunk)
+                size += len(chunk)
+                upload.write(chunk)
+        except Exception:
+            upload.abort()
+            raise
+        upload.close()
+
+        sha256 = digest.hexdigest()
+        if self.exists(sha256):
+            self.bucket.delete(upload._id)
+        else:
+            try:
+                self.bucket.rename(upload._id, sha256)
+            except DuplicateKeyError:
+                # The same content was stored meanwhile by a concurrent upload
+                self.bucket.delete(upload._id)
+        return {'sha256': sha256, 'size': size}
+
+    def iter_chunks(self, sha256):
+        """
+        Read a blob chunk by chunk.
+
+        Args:
+            sha256: Hash of the blob
+
+        Yields:
+            Bytes of the blob, one GridFS chunk at a time
+        """
+        stream = self.bucket.open_download_stream_by_name(sha256)
+        try:
+            while True:
+                chunk = stream.readchunk()
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            stream.close()
+
+
+class LocalBlobStore:
+    """
+    Content-addressed blob store on the local filesystem, standing in for GridFS
+    in development. Blobs are files named after the SHA-256 of their content.
+    """
+    def __init__(self, root, chunk_size=CHUNK_SIZE):
+        """
+        Args:
+            root: Directory holding the blobs
+            chunk_size: Size of the chunks read back
+        """
+        self.root = root
+        self.chunk_size = chunk_size
+
+    def _path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def exists(self, sha256):
+        return os.path.exists(self._path(sha256))
+
+    def put_stream(self, chunks):
+        """
+        Store a blob written chunk by chunk, unless the same content is already stored.
+
+        Args:
+            chunks: Iterable of bytes
+
+        Returns:
+            Reference to the blob: dictionary with sha256 and size
+        """
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        temp_path = os.path.join(self.root, f"pending-{uuid.uuid4().hex}.tmp")
+        try:
+            with open(temp_path, 'wb') as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+
+            sha256 = digest.hexdigest()
+            path = self._path(sha256)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return {'sha256': sha256, 'size': size}
+
+    def iter_chunks(self, sha256):
+        """
+        Read a blob chunk by chunk.
+
+        Args:
+            sha256: Hash of the blob
+
+        Yields:
+            Bytes of the blob
+        """
+        with open(self._path(sha256), 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+
+def get_blob_store(db, config):
+    """
+    Build the attachment blob store selected by ATTACHMENT_STORE.
+
+    Args:
+        db: Database connection
+        config: Application configuration
+
+    Returns:
+        GridFSBlobStore, or LocalBlobStore when ATTACHMENT_STORE is 'local'
+    """
+    if config['attachment_store'] == 'local':
+        return LocalBlobStore(config['attachment_store_dir'])
+    return GridFSBlobStore(db)
@@ -0,0 +1,96 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Email fields the codec applies to
+BODY_FIELDS = ('html', 'text')
+
+
+def resolve_codec(codec):
+    """
+    Get the codec actually usable for a configured codec name.
+    zstd needs the optional zstandard package: without it, zlib is used instead.
+
+    Args:
+        codec: 'zstd', 'zlib', or an empty value to disable compression
+
+    Returns:
+        Name of the codec to use, or None
+    """
+    if codec == 'zstd' and zstandard is None:
+        print("zstandard is not installed, compressing email bodies with zlib")
+        return 'zlib'
+    return codec or None
+
+
+def compress(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if codec == 'zlib':
+        return zlib.compress(data, 6)
+    raise ValueError(f"Unknown body codec: {codec}")
+
+
+def decompress(data, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd compressed email bodies")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown body codec: {codec}")
+
+
+def encode_body_fields(email_data, codec, threshold=16384):
+    """
+    Compress the body fields of an email larger than threshold bytes.
+    Compressed fields hold bytes and are listed in bodyEncoding with their codec.
+
+    Args:
+        email_data: Email document
+        codec: Codec name returned by resolve_codec, None to leave the email as is
+        threshold: Size in bytes from which a field is compressed
+
+    Returns:
+        Email document with compressed body fields (email_data is not modified)
+    """
+    if not codec:
+        return email_data
+
+    encoded = dict(email_data)
+    encodings = dict(email_data.get('bodyEncoding', {}))
+    for field in BODY_FIELDS:
+        value = email_data.get(field)
+        if isinstance(value, str) and field not in encodings:
+            raw = value.encode('utf-8')
+            if len(raw) > threshold:
+                encoded[field] = compress(raw, codec)
+                encodings[field] = codec
+
+    if encodings:
+        encoded['bodyEncoding'] = encodings
+    return encoded
+
+
+def decode_body_fields(email):
+    """
+    Restore the body fields of an email compressed by encode_body_fields.
+
+    Args:
+        email: Email document read from the database
+
+    Returns:
+        Email document with plain string body fields (email is not modified)
+    """
+    encodings = email.get('bodyEncoding')
+    if not encodings:
+        return email
+
+    decoded = {key: value for key, value in email.items() if key != 'bodyEncoding'}
+    for field, codec in encodings.items():
+        if email.get(field) is not None:
+            decoded[field] = decompress(bytes(email[field]), codec).decode('utf-8')
+    return decoded
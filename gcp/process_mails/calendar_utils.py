@@ -1,6 +1,5 @@
 import re
 import base64
-from icalendar import Calendar
 from google_utils import setup_calendar_service
 
 def is_calendar_invitation(message):
@@ -117,6 +116,7 @@ def get_event_id(attachment_data=None):
     if attachment_data and 'data' in attachment_data:
         try:
             ics_data = base64.urlsafe_b64decode(attachment_data['data']).decode('utf-8')
+            from icalendar import Calendar
             cal = Calendar.from_ical(ics_data)
             
             for component in cal.walk():
@@ -1,10 +1,23 @@
-import chromadb
 import hashlib
+import threading
 from datetime import datetime
 from typing import Dict, Optional, Any, Union
-from bs4 import BeautifulSoup
 import re
 
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_chroma_client(db_path):
+    """
+    Get the ChromaDB client of a database path, created once per process.
+    chromadb is imported on first use: it is slow to load and only needed when storing emails.
+    """
+    with _clients_lock:
+        if db_path not in _clients:
+            import chromadb
+            _clients[db_path] = chromadb.PersistentClient(path=db_path)
+        return _clients[db_path]
+
 def insert_email_to_chromadb(
     sender_email: str,
     receiver_email: str,
@@ -34,7 +47,7 @@ def insert_email_to_chromadb(
         The ID of the inserted document
     """
     # Connect to ChromaDB
-    chroma_client = chromadb.PersistentClient(path=db_path)
+    chroma_client = get_chroma_client(db_path)
     
     # Get or create the collection
     try:
@@ -110,6 +123,7 @@ def html_to_text(html_content: str) -> str:
         Clean plain text extracted from the HTML
     """
     # Use BeautifulSoup to parse the HTML
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(html_content, 'html.parser')
     
     # Remove script and style elements that we don't want in our text
@@ -1,4 +1,30 @@
 import os
+import threading
+import sentry_sdk
+
+_sentry_initialized = False
+_sentry_lock = threading.Lock()
+
+def init_sentry():
+    """
+    Initialize Sentry for error tracking, once per process whichever function
+    module is loaded first.
+    """
+    global _sentry_initialized
+    with _sentry_lock:
+        if _sentry_initialized:
+            return
+        sentry_sdk.init(
+            dsn=os.environ.get('SENTRY_SDK'),
+            # Set traces_sample_rate to 1.0 to capture 100%
+            # of transactions for tracing.
+            traces_sample_rate=1.0,
+            # Set profiles_sample_rate to 1.0 to profile 100%
+            # of sampled transactions.
+            # We recommend adjusting this value in production.
+            profiles_sample_rate=1.0,
+        )
+        _sentry_initialized = True
 
 def load_config():
     """
@@ -13,4 +39,35 @@ def load_config():
         'api_key_mistral': os.environ.get('API_KEY_MISTRAL'),
         'mongodb_uri': os.getenv('URI_MONGODB', "mongodb://localhost:27017"),
         'database_name': os.environ.get('DATABASE_NAME'),
+        'pipeline_fetch_workers': int(os.environ.get('PIPELINE_FETCH_WORKERS', 1)),
+        'pipeline_categorize_workers': int(os.environ.get('PIPELINE_CATEGORIZE_WORKERS', 8)),
+        'pipeline_store_workers': int(os.environ.get('PIPELINE_STORE_WORKERS', 4)),
+        'pipeline_queue_size': int(os.environ.get('PIPELINE_QUEUE_SIZE', 100)),
+        'write_buffer_size': int(os.environ.get('WRITE_BUFFER_SIZE', 100)),
+        'write_buffer_delay': float(os.environ.get('WRITE_BUFFER_DELAY', 2)),
+        'email_schema_version': int(os.environ.get('EMAIL_SCHEMA_VERSION', 2)),
+        'message_max_attempts': int(os.environ.get('MESSAGE_MAX_ATTEMPTS', 3)),
+        'backfill_time_budget': float(os.environ.get('BACKFILL_TIME_BUDGET', 0)),
+        'gmail_user_quota_per_second': float(os.environ.get('GMAIL_USER_QUOTA_PER_SECOND', 250)),
+        'gmail_project_quota_per_minute': float(os.environ.get('GMAIL_PROJECT_QUOTA_PER_MINUTE', 1200000)),
+        'mistral_max_in_flight': int(os.environ.get('MISTRAL_MAX_IN_FLIGHT', 32)),
+        'mistral_max_in_flight_per_user': int(os.environ.get('MISTRAL_MAX_IN_FLIGHT_PER_USER', 8)),
+        'mistral_timeout': float(os.environ.get('MISTRAL_TIMEOUT', 60)),
+        'mistral_batch_backfill': os.environ.get('MISTRAL_BATCH_BACKFILL', 'false').lower() == 'true',
+        'mistral_batch_model': os.environ.get('MISTRAL_BATCH_MODEL', 'open-mistral-7b'),
+        'mistral_batch_wait': float(os.environ.get('MISTRAL_BATCH_WAIT', 600)),
+        'skip_labels': [label for label in os.environ.get('SKIP_LABELS', 'SPAM,TRASH').split(',') if label],
+        'metadata_only_labels': [label for label in os.environ.get('METADATA_ONLY_LABELS', '').split(',') if label],
+        'attachment_metadata_only': os.environ.get('ATTACHMENT_METADATA_ONLY', 'false').lower() == 'true',
+        'attachment_cache_dir': os.environ.get('ATTACHMENT_CACHE_DIR', '/tmp/attachments'),
+        'attachment_cache_max_bytes': int(os.environ.get('ATTACHMENT_CACHE_MAX_BYTES', 256 * 1024 * 1024)),
+        'attachment_store': os.environ.get('ATTACHMENT_STORE', 'gridfs'),
+        'attachment_store_dir': os.environ.get('ATTACHMENT_STORE_DIR', '/tmp/attachment_store'),
+        'attachment_prefetch': os.environ.get('ATTACHMENT_PREFETCH', 'false').lower() == 'true',
+        'attachment_prefetch_timeout': float(os.environ.get('ATTACHMENT_PREFETCH_TIMEOUT', 10)),
+        'sync_interval_minutes': float(os.environ.get('SYNC_INTERVAL_MINUTES', 15)),
+        'scheduler_max_accounts': int(os.environ.get('SCHEDULER_MAX_ACCOUNTS', 500)),
+        'scheduler_max_concurrency': int(os.environ.get('SCHEDULER_MAX_CONCURRENCY', 8)),
+        'scheduler_account_time_budget': float(os.environ.get('SCHEDULER_ACCOUNT_TIME_BUDGET', 300)),
+        'sync_lease_seconds': float(os.environ.get('SYNC_LEASE_SECONDS', 900)),
     }
\ No newline at end of file
@@ -1,41 +1,218 @@
 from pymongo import MongoClient
+from pymongo import monitoring
 import os
+import threading
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Track the connections of the pools of a client, to report their utilization.
+    Counters are updated from pymongo's pool events, without querying the server.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0
+        self.checked_out = 0
+        self.waiting = 0
+        self.checkout_failures = 0
+
+    def _add(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def connection_created(self, event):
+        self._add(open=1)
+
+    def connection_closed(self, event):
+        self._add(open=-1)
+
+    def connection_check_out_started(self, event):
+        self._add(waiting=1)
+
+    def connection_checked_out(self, event):
+        self._add(waiting=-1, checked_out=1)
+
+    def connection_check_out_failed(self, event):
+        self._add(waiting=-1, checkout_failures=1)
+
+    def connection_checked_in(self, event):
+        self._add(checked_out=-1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'open': self.open,
+                'checkedOut': self.checked_out,
+                'waiting': self.waiting,
+                'checkoutFailures': self.checkout_failures,
+            }
+
+
+def client_options():
+    """
+    Options of the process-wide MongoDB clients, read from environment variables.
+    Unset options keep the pymongo and server defaults.
+
+    Returns:
+        Dict of MongoClient keyword arguments
+    """
+    options = {
+        'maxPoolSize': int(os.environ.get('MONGO_MAX_POOL_SIZE', 50)),
+        'minPoolSize': int(os.environ.get('MONGO_MIN_POOL_SIZE', 0)),
+        'maxIdleTimeMS': int(os.environ.get('MONGO_MAX_IDLE_TIME_MS', 300000)),
+        'connectTimeoutMS': int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', 10000)),
+        'serverSelectionTimeoutMS': int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 10000)),
+        'appname': 'process_mails',
+    }
+    if os.environ.get('MONGO_SOCKET_TIMEOUT_MS'):
+        options['socketTimeoutMS'] = int(os.environ['MONGO_SOCKET_TIMEOUT_MS'])
+    if os.environ.get('MONGO_WRITE_CONCERN'):
+        w = os.environ['MONGO_WRITE_CONCERN']
+        options['w'] = int(w) if w.isdigit() else w
+    if os.environ.get('MONGO_READ_CONCERN'):
+        options['readConcernLevel'] = os.environ['MONGO_READ_CONCERN']
+    return options
+
+
+def get_mongo_client(uri=None):
+    """
+    Get the process-wide MongoDB client of a URI, created on first use.
+    Clients keep their connection pool open between invocations, and are
+    recreated in forked processes, where a client inherited from the parent
+    must not be used.
+
+    Args:
+        uri: MongoDB connection URI, defaults to URI_MONGODB
+
+    Returns:
+        MongoClient shared by every caller of the process
+    """
+    uri = uri or os.getenv('URI_MONGODB', "mongodb://localhost:27017")
+    with _clients_lock:
+        entry = _clients.get(uri)
+        if entry is None or entry['pid'] != os.getpid():
+            options = client_options()
+            monitor = PoolMonitor()
+            entry = {
+                'client': MongoClient(uri, event_listeners=[monitor], **options),
+                'monitor': monitor,
+                'max_pool_size': options['maxPoolSize'],
+                'pid': os.getpid(),
+            }
+            _clients[uri] = entry
+        return entry['client']
+
+
+def get_database(db_name=None, uri=None):
+    """
+    Get a database of the process-wide MongoDB client.
+    With MONGO_ENSURE_INDEXES=true, the indexes of the pipelines are created on
+    the first use of each database by the process (see indexes.py).
+
+    Args:
+        db_name: MongoDB database name, defaults to DATABASE_NAME
+        uri: MongoDB connection URI, defaults to URI_MONGODB
+
+    Returns:
+        MongoDB database instance
+    """
+    db = get_mongo_client(uri)[db_name or os.environ.get('DATABASE_NAME')]
+    if os.environ.get('MONGO_ENSURE_INDEXES', 'false').lower() == 'true':
+        # Imported here: indexes is only needed when the bootstrap is enabled
+        from indexes import ensure_indexes
+        ensure_indexes(db)
+    return db
+
+
+def pool_stats():
+    """
+    Report the utilization of the connection pools of the process, without
+    creating a client: an idle process reports no pools.
+
+    Returns:
+        List of dicts with the open and checked out connections, the operations
+        waiting for a connection, and the utilization of each client's pool
+    """
+    with _clients_lock:
+        entries = [entry for entry in _clients.values() if entry['pid'] == os.getpid()]
+
+    stats = []
+    for entry in entries:
+        snapshot = entry['monitor'].snapshot()
+        # Counters are summed over the servers of the cluster, each with its own pool
+        servers = max(len(entry['client'].nodes), 1)
+        snapshot['maxPoolSize'] = entry['max_pool_size'] * servers
+        snapshot['utilization'] = round(snapshot['checkedOut'] / snapshot['maxPoolSize'], 3) if snapshot['maxPoolSize'] else 0
+        stats.append(snapshot)
+    return stats
+
+
+def _forget_clients_after_fork():
+    # The child gets new clients; closing the parent's ones would affect the parent's sockets.
+    # The lock is replaced as another thread of the parent may have held it during the fork.
+    global _clients_lock
+    _clients_lock = threading.Lock()
+    _clients.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_clients_after_fork)
+
 
 class MongoDBConnectionManager:
     """
-    Context manager for MongoDB connections.
-    Ensures proper opening and closing of database connections.
+    Context manager giving access to a MongoDB database.
+    Connections come from the process-wide client (see get_mongo_client), which
+    stays open after the context exits so that later invocations reuse its pool.
     """
     def __init__(self, uri=None, db_name=None):
         """
         Initialize connection manager with optional URI and database name.
         If not provided, values are read from environment variables.
-        
+
         Args:
             uri: MongoDB connection URI
             db_name: MongoDB database name
         """
         self.uri = uri or os.getenv('URI_MONGODB', "mongodb://localhost:27017")
         self.db_name = db_name or os.environ.get('DATABASE_NAME')
-    
+
     def __enter__(self):
         """
-        Enter the context manager, establishing MongoDB connection.
-        
+        Enter the context manager, getting the database from the shared client.
+
         Returns:
             MongoDB database instance
         """
-        self.client = MongoClient(self.uri)
-        self.db = self.client[self.db_name]
+        self.client = get_mongo_client(self.uri)
+        self.db = get_database(self.db_name, self.uri)
         return self.db
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """
-        Exit the context manager, closing MongoDB connection.
-        
+        Exit the context manager. The shared client is left open.
+
         Args:
             exc_type: Exception type if an exception occurred
             exc_val: Exception value if an exception occurred
             exc_tb: Exception traceback if an exception occurred
         """
-        self.client.close()
\ No newline at end of file
@@ -1,16 +1,26 @@
 import sentry_sdk
-import requests
 
-from utils import decode_email_body, clean_email_text, truncate_text, count_tokens, parse_mistral_response, convert_to_iso8601_utc
+from utils import decode_email_body, clean_email_text, convert_to_iso8601_utc, pending_categorization, AI_STATUS_PENDING, strip_attachment_data
 from calendar_utils import is_calendar_invitation
+from mistral_client import get_mistral_client
+from gmail_quota import execute_gmail
+from gmail_utils import DraftResolver
+from email_store import upsert_thread
+from token_budget import budget_prompt
 
 TOKEN_LIMIT = 30000
 
-def fetch_email(service, user_email, message_id, db, INSTRUCTIONS_WITH_CONTEXT_TEMPLATE, 
-             INSTRUCTIONS_TEMPLATE, PROMPT_CATEGORIES, API_KEY_MISTRAL, CATEGORIES):
+# Decisions taken on a message from its metadata, before fetching its body
+ROUTE_SKIP = 'skip'
+ROUTE_METADATA = 'metadata'
+ROUTE_FULL = 'full'
+
+def fetch_email(service, user_email, message_id, db, INSTRUCTIONS_WITH_CONTEXT_TEMPLATE,
+             INSTRUCTIONS_TEMPLATE, prompt_context, API_KEY_MISTRAL, message=None,
+             metadata_only_attachments=False):
     """
     Fetch and process an email's details using the Gmail API.
-    
+
     Args:
         service: Authenticated Gmail API service
         user_email: User's email address
@@ -18,74 +28,207 @@ def fetch_email(service, user_email, message_id, db, INSTRUCTIONS_WITH_CONTEXT_T
         db: Database connection
         INSTRUCTIONS_WITH_CONTEXT_TEMPLATE: Template for emails with thread context
         INSTRUCTIONS_TEMPLATE: Template for new emails
-        PROMPT_CATEGORIES: Categories formatted for AI prompt
+        prompt_context: PromptContext of the user's categories
         API_KEY_MISTRAL: API key for Mistral AI
-        CATEGORIES: List of valid email categories
-        
+        message: Optional message resource already fetched (e.g. by a batch request)
+        metadata_only_attachments: Store attachment metadata without downloading the data,
+                                   see the ATTACHMENT_METADATA_ONLY setting
+
     Returns:
         Dictionary containing processed email details or None if processing failed
     """
     try:
-        # Get database collections
-        threads_collection = db.threads
-        
-        # Fetch the message from Gmail API
-        message = service.users().messages().get(userId=user_email, id=message_id, format='full').execute()
-        
-        # Extract message headers for easier access
-        headers = {header['name']: header['value'] for header in message['payload']['headers']}
-        
-        # Decode email body (HTML and text)
-        decoded_body = decode_email_body(message['payload'], service, user_email, message_id)
-        
-        # Check if this message is part of an existing thread
-        existing_thread = threads_collection.find_one({'threadId': message["threadId"]})
-        
-        # Process email category and summary
-        category_obj = process_email_categorization(
-            message, 
-            decoded_body, 
-            existing_thread, 
-            headers,
+        prepared = prepare_email(service, user_email, message_id, message,
+                                 metadata_only_attachments=metadata_only_attachments)
+
+        return categorize_email(
+            prepared,
+            db,
             INSTRUCTIONS_WITH_CONTEXT_TEMPLATE,
             INSTRUCTIONS_TEMPLATE,
-            PROMPT_CATEGORIES,
-            API_KEY_MISTRAL,
-            CATEGORIES
+            prompt_context,
+            API_KEY_MISTRAL
         )
-        
-        # Update or create thread in database
-        update_thread_in_database(
-            threads_collection,
-            message["threadId"],
-            category_obj,
-            headers.get('Delivered-To')
-        )
-        
-        # Build complete message details
-        message_details = build_message_details(
-            message, 
-            message_id, 
-            headers, 
-            decoded_body, 
-            category_obj
-        )
-        
-        # Add draft ID if message is a draft
-        if 'DRAFT' in message.get('labelIds', []):
-            add_draft_id_to_message(service, user_email, message_id, message_details)
-        
-        return message_details
-        
+
     except Exception as e:
         sentry_sdk.capture_exception(e)
         print(f"Error fetching email with ID {message_id}: {e}")
         return None
 
 
+def route_message(message, skip_labels=(), metadata_only_labels=()):
+    """
+    Decide from a format='metadata' message whether its body must be fetched.
+
+    Args:
+        message: Gmail message resource with labels and headers only
+        skip_labels: Labels of messages that are not ingested (e.g. SPAM, TRASH)
+        metadata_only_labels: Labels of messages stored from their metadata only
+
+    Returns:
+        ROUTE_SKIP, ROUTE_METADATA or ROUTE_FULL
+    """
+    label_ids = set(message.get('labelIds', []))
+    if label_ids & set(skip_labels):
+        return ROUTE_SKIP
+    if label_ids & set(metadata_only_labels) and not may_be_invitation(message):
+        return ROUTE_METADATA
+    return ROUTE_FULL
+
+
+def may_be_invitation(message):
+    """
+    Tell from a format='metadata' message whether it may be a calendar invitation,
+    whose .ics attachment is needed to resolve the event.
+
+    Metadata messages have no parts: is_calendar_invitation only sees their
+    top-level Content-Type and subject. Invitations sent as multipart/mixed with
+    an .ics part are only recognized once fetched, so every multipart/mixed
+    message is fetched in full.
+
+    Args:
+        message: Gmail message resource with labels and headers only
+
+    Returns:
+        True if the full message is needed to tell
+    """
+    mime_type = message.get('payload', {}).get('mimeType', '')
+    return mime_type.lower().startswith('multipart/mixed') or is_calendar_invitation(message)
+
+
+def prepare_email(service, user_email, message_id, message=None, draft_resolver=None, metadata_only_attachments=False):
+    """
+    Run the Gmail-bound part of email processing: fetch the message if needed,
+    decode its body and resolve its draft ID.
+
+    Args:
+        service: Authenticated Gmail API service
+        user_email: User's email address
+        message_id: Gmail message ID
+        message: Optional message resource already fetched (e.g. by a batch request),
+                 in 'full' or 'metadata' format
+        draft_resolver: Optional DraftResolver shared by the sync run
+        metadata_only_attachments: Store attachment metadata without downloading the data,
+                                   see the ATTACHMENT_METADATA_ONLY setting
+
+    Returns:
+        Dictionary with user_email, message, headers, decoded_body and, for drafts, draftId
+    """
+    # Fetch the message from Gmail API unless it was already fetched
+    if message is None:
+        message = execute_gmail(
+            service.users().messages().get(userId=user_email, id=message_id, format='full'),
+            'messages.get',
+            user_email
+        )
+
+    # A format='metadata' message has headers but no body to decode
+    metadata_only = 'body' not in message['payload'] and 'parts' not in message['payload']
+
+    prepared = {
+        'user_email': user_email,
+        'message': message,
+        # Extract message headers for easier access
+        'headers': {header['name']: header['value'] for header in message['payload']['headers']},
+        # Decode email body (HTML and text)
+        'decoded_body': (
+            {"text": "", "html": "", "attachments": []} if metadata_only
+            else decode_email_body(message['payload'], service, user_email, message_id, metadata_only_attachments)
+        ),
+    }
+    if metadata_only:
+        prepared['bodyFormat'] = ROUTE_METADATA
+
+    # Add draft ID if message is a draft
+    if 'DRAFT' in message.get('labelIds', []):
+        add_draft_id_to_message(service, user_email, message_id, prepared, draft_resolver)
+
+    return prepared
+
+
+def categorize_email(prepared, db, INSTRUCTIONS_WITH_CONTEXT_TEMPLATE, INSTRUCTIONS_TEMPLATE,
+                     prompt_context, API_KEY_MISTRAL, write_buffer=None, batch=None, thread_cache=None):
+    """
+    Run the Gmail-independent part of email processing: categorize and summarize
+    the email, update its thread and build the message details.
+
+    Args:
+        prepared: Dictionary returned by prepare_email
+        db: Database connection
+        INSTRUCTIONS_WITH_CONTEXT_TEMPLATE: Template for emails with thread context
+        INSTRUCTIONS_TEMPLATE: Template for new emails
+        prompt_context: PromptContext of the user's categories
+        API_KEY_MISTRAL: API key for Mistral AI
+        write_buffer: Optional WriteBuffer receiving the thread upsert instead of writing it directly
+        batch: Optional MistralBatch the Mistral call is deferred to; the thread is then
+               updated when the batch results are written back
+        thread_cache: Optional ThreadStateCache of the run, serving the thread context
+                      and recording the thread updates
+
+    Returns:
+        Dictionary containing processed email details
+    """
+    message = prepared['message']
+    headers = prepared['headers']
+    decoded_body = prepared['decoded_body']
+
+    # Check if this message is part of an existing thread
+    if thread_cache is not None:
+        existing_thread = thread_cache.get(message["threadId"])
+    else:
+        existing_thread = db.threads.find_one({'threadId': message["threadId"]})
+
+    # Process email category and summary
+    category_obj = process_email_categorization(
+        message,
+        decoded_body,
+        existing_thread,
+        headers,
+        INSTRUCTIONS_WITH_CONTEXT_TEMPLATE,
+        INSTRUCTIONS_TEMPLATE,
+        prompt_context,
+        API_KEY_MISTRAL,
+        prepared.get('user_email'),
+        batch
+    )
+
+    # Update or create thread in database; a deferred categorization updates it on write-back
+    if category_obj.get('pending'):
+        print(f"Categorization of {message['id']} deferred to a batch job")
+    else:
+        fields = thread_fields(category_obj['summary'], category_obj['category'])
+        if write_buffer is not None:
+            write_buffer.upsert_thread(message["threadId"], fields, headers.get('Delivered-To'))
+        else:
+            upsert_thread(db, message["threadId"], fields, headers.get('Delivered-To'))
+        if thread_cache is not None:
+            thread_cache.update(message["threadId"], fields)
+
+    # Build complete message details
+    message_details = build_message_details(
+        message,
+        message['id'],
+        headers,
+        decoded_body,
+        category_obj
+    )
+
+    if 'draftId' in prepared:
+        message_details['draftId'] = prepared['draftId']
+
+    # Lets readers know the body was not fetched
+    if 'bodyFormat' in prepared:
+        message_details['bodyFormat'] = prepared['bodyFormat']
+
+    if category_obj.get('pending'):
+        message_details['aiStatus'] = AI_STATUS_PENDING
+
+    return message_details
+
+
 def process_email_categorization(message, decoded_body, existing_thread, headers,
                                INSTRUCTIONS_WITH_CONTEXT_TEMPLATE, INSTRUCTIONS_TEMPLATE,
-                               PROMPT_CATEGORIES, API_KEY_MISTRAL, CATEGORIES):
+                               prompt_context, API_KEY_MISTRAL, user_email=None, batch=None):
     """
     Process email to determine category and summary.
     
@@ -96,9 +239,10 @@ def process_email_categorization(message, decoded_body, existing_thread, headers
         headers: Email headers dictionary
         INSTRUCTIONS_WITH_CONTEXT_TEMPLATE: Template for emails with thread context
         INSTRUCTIONS_TEMPLATE: Template for new emails
-        PROMPT_CATEGORIES: Categories formatted for AI prompt
+        prompt_context: PromptContext of the user's categories
         API_KEY_MISTRAL: API key for Mistral AI
-        CATEGORIES: List of valid email categories
+        user_email: Optional user email, used for the per-user Mistral request limit
+        batch: Optional MistralBatch collecting the prompt instead of calling Mistral now
         
     Returns:
         Dictionary with category, summary and text
@@ -124,22 +268,24 @@ def process_email_categorization(message, decoded_body, existing_thread, headers
         }
         
     # Prepare Mistral API prompt based on whether thread exists
-    prompt = prepare_mistral_prompt(
+    prompt, token_count = prepare_mistral_prompt(
         email_text, 
         headers, 
         existing_thread, 
         INSTRUCTIONS_WITH_CONTEXT_TEMPLATE, 
         INSTRUCTIONS_TEMPLATE, 
-        PROMPT_CATEGORIES
+        prompt_context.prompt_categories
     )
     
     # Check token count
-    token_count = count_tokens(prompt)
     print(f"Token count: {token_count}")
 
     # Process with Mistral API if within token limit
     if token_count <= TOKEN_LIMIT:
-        return call_mistral_api(prompt, API_KEY_MISTRAL, CATEGORIES)
+        if batch is not None:
+            batch.add(message['id'], prompt)
+            return pending_categorization()
+        return call_mistral_api(prompt, API_KEY_MISTRAL, prompt_context, user_email)
     else:
         print("Error: Token count exceeds the limit even after truncation.")
         return {
@@ -153,7 +299,7 @@ def prepare_mistral_prompt(email_text, headers, existing_thread,
                           INSTRUCTIONS_WITH_CONTEXT_TEMPLATE, INSTRUCTIONS_TEMPLATE, 
                           PROMPT_CATEGORIES):
     """
-    Prepare the prompt for Mistral API.
+    Prepare the prompt for Mistral API, with the email text truncated to 5000 tokens.
     
     Args:
         email_text: Email text content
@@ -164,10 +310,10 @@ def prepare_mistral_prompt(email_text, headers, existing_thread,
         PROMPT_CATEGORIES: Categories formatted for AI prompt
         
     Returns:
-        Formatted prompt string
+        Tuple of (formatted prompt string, number of tokens of the prompt)
     """
-    # Clean and truncate the email text
-    cleaned_text = truncate_text(clean_email_text(email_text), 5000)
+    # Cleaned here, truncated while the prompt is budgeted
+    cleaned_text = clean_email_text(email_text)
     
     # Get sender and subject from headers
     sender = headers.get('From', 'Unknown Sender')
@@ -182,101 +328,62 @@ def prepare_mistral_prompt(email_text, headers, existing_thread,
             else existing_thread.get('generatedCategory', '')
         )
         
-        return INSTRUCTIONS_WITH_CONTEXT_TEMPLATE.format(
+        return budget_prompt(
+            INSTRUCTIONS_WITH_CONTEXT_TEMPLATE,
+            cleaned_text,
+            5000,
             sender=sender,
             subject=subject,
             past_thread_summary=existing_thread['summary'],
             past_thread_category=thread_category,
-            text=cleaned_text,
             PROMPT_CATEGORIES=PROMPT_CATEGORIES
         )
     else:
         # For new threads, use the basic template
-        return INSTRUCTIONS_TEMPLATE.format(
+        return budget_prompt(
+            INSTRUCTIONS_TEMPLATE,
+            cleaned_text,
+            5000,
             sender=sender,
             subject=subject,
-            text=cleaned_text,
             PROMPT_CATEGORIES=PROMPT_CATEGORIES
         )
 
 
-def call_mistral_api(prompt, API_KEY_MISTRAL, CATEGORIES):
+def call_mistral_api(prompt, API_KEY_MISTRAL, prompt_context, user_email=None):
     """
     Call Mistral API to categorize and summarize email.
-    
+    Goes through the shared Mistral client, which reuses connections and
+    limits the number of requests in flight.
+
     Args:
         prompt: Formatted prompt string
         API_KEY_MISTRAL: API key for Mistral
-        CATEGORIES: List of valid categories
-        
+        prompt_context: PromptContext of the valid categories
+        user_email: Optional user email, used for the per-user request limit
+
     Returns:
         Dictionary with category, summary and text
     """
-    try:
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {API_KEY_MISTRAL}"
-        }
-        data = {
-            "model": "open-mistral-7b",
-            "messages": [{"role": "user", "content": prompt}],
-        }
-        
-        response = requests.post("https://api.mistral.ai/v1/chat/completions", 
-                               json=data, headers=headers)
-        
-        # Process the response
-        mistral_response = response.json()
-        return parse_mistral_response(
-            mistral_response["choices"][0]["message"]["content"], 
-            CATEGORIES
-        )
-    except Exception as e:
-        print(f"Error calling Mistral API: {e}")
-        return {
-            "category": "Other",
-            "summary": "Error processing with AI.",
-            "text": f"Error: {str(e)}"
-        }
+    return get_mistral_client(API_KEY_MISTRAL).categorize(prompt, prompt_context, user=user_email)
 
 
-def update_thread_in_database(threads_collection, thread_id, category_obj, delivered_to):
+def thread_fields(summary, category):
     """
-    Update or create thread in database.
-    
+    Fields set on a thread each time one of its emails is processed.
+
     Args:
-        threads_collection: Database collection for threads
-        thread_id: Gmail thread ID
-        category_obj: Object containing category and summary
-        delivered_to: Email's Delivered-To header value
+        summary: Summary of the latest email of the thread
+        category: Generated category of the thread
+
+    Returns:
+        Dictionary of thread fields
     """
-    # Check if thread exists
-    existing_thread = threads_collection.find_one({'threadId': thread_id})
-    
-    if existing_thread:
-        # Update existing thread
-        threads_collection.update_one(
-            {'threadId': thread_id},
-            {'$set': {
-                'summary': category_obj['summary'],
-                "userCategory": "",
-                "generatedCategory": category_obj['category'],
-            }}
-        )
-    else:
-        # Create new thread
-        new_thread = {
-            'threadId': thread_id,
-            'summary': category_obj['summary'],
-            "userCategory": "",
-            "generatedCategory": category_obj['category'],
-        }
-        
-        # Add delivered_to if available
-        if delivered_to:
-            new_thread['deliveredTo'] = delivered_to
-            
-        threads_collection.insert_one(new_thread)
+    return {
+        'summary': summary,
+        "userCategory": "",
+        "generatedCategory": category,
+    }
 
 
 def build_message_details(message, message_id, headers, decoded_body, category_obj):
@@ -315,7 +422,7 @@ def build_message_details(message, message_id, headers, decoded_body, category_o
         "generatedCategory": category_obj.get('category', "Other"),
         "mistralOutputText": category_obj.get("text", ""),
         "attachments": decoded_body.get("attachments", []),
-        "payload": message.get('payload', {}),
+        "payload": strip_attachment_data(message.get('payload', {})),
     }
     
     # Add optional fields if present
@@ -330,26 +437,22 @@ def build_message_details(message, message_id, headers, decoded_body, category_o
     return message_details
 
 
-def add_draft_id_to_message(service, user_email, message_id, message_details):
+def add_draft_id_to_message(service, user_email, message_id, message_details, draft_resolver=None):
     """
-    Add draft ID to message details if message is a draft.
+    Add draft ID to message details (or prepared message) if message is a draft.
     
     Args:
         service: Authenticated Gmail API service
         user_email: User's email address
         message_id: Gmail message ID
         message_details: Message details dictionary to update
+        draft_resolver: Optional DraftResolver shared by the sync run; without it
+                        the drafts of the user are listed for this message only
     """
     try:
-        # Fetch drafts and find the matching draftId
-        drafts = service.users().drafts().list(userId=user_email).execute().get('drafts', [])
-        
-        for draft in drafts:
-            draft_details = service.users().drafts().get(userId=user_email, id=draft['id']).execute()
-            
-            if draft_details['message']['id'] == message_id:
-                message_details['draftId'] = draft['id']
-                break
+        draft_id = (draft_resolver or DraftResolver(user_email)).get_draft_id(service, message_id)
+        if draft_id:
+            message_details['draftId'] = draft_id
     except Exception as e:
         print(f"Error adding draft ID: {e}")
-        # Continue without adding draftId
\ No newline at end of file
+        # Continue without adding draftId
@@ -0,0 +1,49 @@
+# Version of the documents written to the emails collection:
+#   1: payload holds the whole Gmail MIME tree, base64 bodies included
+#   2: payload is slimmed to the message headers and the part structure,
+#      bodies are only stored decoded in html, text and attachments
+EMAIL_SCHEMA_VERSION = 2
+
+
+def compact_payload(payload, top_level=True):
+    """
+    Slim a Gmail message payload to its headers and part structure.
+
+    Args:
+        payload: Gmail message payload, or one of its parts
+        top_level: Whether payload is the message payload, whose headers are kept
+
+    Returns:
+        Payload without body data nor part headers
+    """
+    if not payload:
+        return payload
+
+    body = payload.get('body', {})
+    compact = {
+        'partId': payload.get('partId', ''),
+        'mimeType': payload.get('mimeType', ''),
+        'filename': payload.get('filename', ''),
+        'body': {key: body[key] for key in ('size', 'attachmentId') if key in body},
+    }
+    if top_level:
+        compact['headers'] = payload.get('headers', [])
+    if 'parts' in payload:
+        compact['parts'] = [compact_payload(part, top_level=False) for part in payload['parts']]
+    return compact
+
+
+def to_stored_email(email_data, version=EMAIL_SCHEMA_VERSION):
+    """
+    Shape an email document for the given schema version before it is written.
+
+    Args:
+        email_data: Email details built by the processing functions
+        version: Schema version to write
+
+    Returns:
+        Email document tagged with its schemaVersion
+    """
+    if version >= 2 and 'payload' in email_data:
+        email_data = {**email_data, 'payload': compact_payload(email_data['payload'])}
+    return {**email_data, 'schemaVersion': version}
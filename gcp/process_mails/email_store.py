@@ -0,0 +1,372 @@
+import threading
+import time
+import sentry_sdk
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from email_schema import EMAIL_SCHEMA_VERSION, to_stored_email
+from body_codec import encode_body_fields
+from indexes import ensure_indexes, DUPLICATE_KEY
+
+# Thread fields read to build the prompt context of an email
+THREAD_STATE_FIELDS = {'_id': 0, 'threadId': 1, 'summary': 1, 'userCategory': 1, 'generatedCategory': 1}
+
+
+def ensure_message_id_index(db):
+    """
+    Make sure emails.messageId has a unique index, once per database and process.
+
+    Args:
+        db: Database connection
+    """
+    ensure_indexes(db, ['emails'])
+
+
+def ensure_thread_id_index(db):
+    """
+    Make sure threads.threadId has a unique index, once per database and process.
+    With it, concurrent upserts of a new thread cannot create it twice.
+
+    Args:
+        db: Database connection
+    """
+    ensure_indexes(db, ['threads'])
+
+
+def upsert_thread(db, thread_id, fields, delivered_to=None):
+    """
+    Update a thread, creating it if needed, with a single atomic upsert.
+
+    Args:
+        db: Database connection
+        thread_id: Gmail thread ID
+        fields: Fields to set on the thread
+        delivered_to: Delivered-To header, only stored when the thread is created
+    """
+    update = {'$set': fields}
+    if delivered_to:
+        update['$setOnInsert'] = {'deliveredTo': delivered_to}
+    db.threads.update_one({'threadId': thread_id}, update, upsert=True)
+
+
+def filter_unseen_message_ids(db, message_ids):
+    """
+    Keep only the message IDs that are not stored in the emails collection yet.
+    The whole list is resolved with a single $in query; projecting on messageId
+    only lets MongoDB answer it from the messageId index without reading documents.
+
+    Args:
+        db: Database connection
+        message_ids: List of Gmail message IDs
+
+    Returns:
+        List of unseen message IDs, in their original order
+    """
+    if not message_ids:
+        return []
+
+    ensure_message_id_index(db)
+
+    cursor = db.emails.find(
+        {'messageId': {'$in': list(message_ids)}},
+        {'_id': 0, 'messageId': 1}
+    )
+    seen = {document['messageId'] for document in cursor}
+
+    return [message_id for message_id in message_ids if message_id not in seen]
+
+
+class ThreadStateCache:
+    """
+    Per-run cache of the thread fields used as prompt context (summary and
+    categories), so that emails do not each read their thread.
+
+    Threads are loaded in bulk with seed, one $in query for a whole batch of
+    messages; threads missing from the database are cached as None. Writes
+    made during the run are applied to the cache with update, so the next
+    email of a thread sees its latest summary even before buffered writes
+    are flushed.
+    """
+    def __init__(self, db):
+        """
+        Args:
+            db: Database connection
+        """
+        self.db = db
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def seed(self, thread_ids):
+        """
+        Load the threads not cached yet with a single query.
+
+        Args:
+            thread_ids: Iterable of Gmail thread IDs
+        """
+        with self._lock:
+            missing = {thread_id for thread_id in thread_ids if thread_id and thread_id not in self._threads}
+        if not missing:
+            return
+
+        ensure_thread_id_index(self.db)
+        found = {
+            thread['threadId']: thread
+            for thread in self.db.threads.find({'threadId': {'$in': list(missing)}}, THREAD_STATE_FIELDS)
+        }
+        with self._lock:
+            for thread_id in missing:
+                # A concurrent update is more recent than what was just read
+                self._threads.setdefault(thread_id, found.get(thread_id))
+
+    def get(self, thread_id):
+        """
+        Get the cached state of a thread, reading it if it was not seeded.
+
+        Args:
+            thread_id: Gmail thread ID
+
+        Returns:
+            Thread document, or None if the thread does not exist
+        """
+        with self._lock:
+            if thread_id in self._threads:
+                return self._threads[thread_id]
+        self.seed([thread_id])
+        with self._lock:
+            return self._threads.get(thread_id)
+
+    def update(self, thread_id, fields):
+        """
+        Record fields written to a thread during the run.
+
+        Args:
+            thread_id: Gmail thread ID
+            fields: Fields set on the thread
+        """
+        with self._lock:
+            self._threads[thread_id] = {**(self._threads.get(thread_id) or {'threadId': thread_id}), **fields}
+
+
+class WriteBuffer:
+    """
+    Collect email inserts and thread upserts and write them with unordered
+    bulk_write calls, when the buffer holds max_size operations or when
+    max_delay seconds have passed since the last flush.
+
+    Writes are upserts keyed on messageId and threadId, so flushing the same
+    operations twice is harmless. Operations on the same key are coalesced
+    until the next flush, which also means thread summaries written by a
+    buffered upsert are only visible to readers once flushed.
+
+    Emails whose insert fails are not retried: their message IDs are kept
+    until take_failed_message_ids is called, so that callers do not consider
+    them stored. When a flush fails altogether, its operations are put back
+    in the buffer for the next flush.
+
+    Use as a context manager so pending operations are flushed on exit.
+    """
+    def __init__(self, db, max_size=100, max_delay=2.0, schema_version=EMAIL_SCHEMA_VERSION, body_codec=None, body_codec_threshold=16384):
+        """
+        Args:
+            db: Database connection
+            max_size: Number of buffered operations triggering a flush
+            max_delay: Maximum number of seconds an operation stays buffered
+            schema_version: Version of the email documents written (see email_schema)
+            body_codec: Codec compressing large html and text fields (see body_codec), None to store them raw.
+                        The syncs leave it off: the API and the thread context read the fields raw
+            body_codec_threshold: Size in bytes from which a body field is compressed
+        """
+        self.db = db
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.schema_version = schema_version
+        self.body_codec = body_codec
+        self.body_codec_threshold = body_codec_threshold
+        self.flushed_emails = 0
+        self.flushed_threads = 0
+
+        self._emails = {}
+        self._threads = {}
+        self._failed_message_ids = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._stopped = threading.Event()
+        self._timer = None
+
+    def __enter__(self):
+        self._timer = threading.Thread(target=self._flush_periodically, name='write-buffer', daemon=True)
+        self._timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_email(self, email_data):
+        """
+        Buffer the insertion of an email. An email already stored is left untouched.
+        The document is written in the schema version of the buffer, with its
+        large body fields compressed when a body codec is set.
+
+        Args:
+            email_data: Email document, with a messageId field
+        """
+        email_data = to_stored_email(email_data, self.schema_version)
+        email_data = encode_body_fields(email_data, self.body_codec, self.body_codec_threshold)
+        with self._lock:
+            self._emails[email_data['messageId']] = email_data
+        self._flush_if_needed()
+
+    def upsert_thread(self, thread_id, fields, delivered_to=None):
+        """
+        Buffer the update of a thread, creating it if needed.
+
+        Args:
+            thread_id: Gmail thread ID
+            fields: Fields to set on the thread
+            delivered_to: Delivered-To header, only stored when the thread is created
+        """
+        with self._lock:
+            pending = self._threads.get(thread_id)
+            if pending:
+                pending['fields'].update(fields)
+                pending['delivered_to'] = pending['delivered_to'] or delivered_to
+            else:
+                self._threads[thread_id] = {'fields': dict(fields), 'delivered_to': delivered_to}
+        self._flush_if_needed()
+
+    def flush(self):
+        """
+        Write every buffered operation to the database.
+        """
+        with self._flush_lock:
+            with self._lock:
+                emails, self._emails = self._emails, {}
+                threads, self._threads = self._threads, {}
+                self._last_flush = time.monotonic()
+
+            try:
+                if threads:
+                    ensure_thread_id_index(self.db)
+                    operations = []
+                    for thread_id, pending in threads.items():
+                        update = {'$set': pending['fields']}
+                        if pending['delivered_to']:
+                            update['$setOnInsert'] = {'deliveredTo': pending['delivered_to']}
+                        operations.append(UpdateOne({'threadId': thread_id}, update, upsert=True))
+                    self._bulk_write(self.db.threads, operations)
+                    self.flushed_threads += len(operations)
+                    threads = {}
+
+                if emails:
+                    ensure_message_id_index(self.db)
+                    message_ids = list(emails)
+                    operations = [
+                        UpdateOne({'messageId': message_id}, {'$setOnInsert': emails[message_id]}, upsert=True)
+                        for message_id in message_ids
+                    ]
+                    errors = self._bulk_write(self.db.emails, operations)
+                    # A duplicate key means the email was stored meanwhile by a concurrent sync
+                    failed = [message_ids[error['index']] for error in errors if error.get('code') != DUPLICATE_KEY]
+                    if failed:
+                        with self._lock:
+                            self._failed_message_ids.extend(failed)
+                    self.flushed_emails += len(operations) - len(failed)
+            except Exception:
+                # Nothing tells which operations went through: write them again on the next flush
+                self._restore(emails, threads)
+                raise
+
+    def take_failed_message_ids(self):
+        """
+        Get the message IDs of the emails whose insert failed since the last call.
+
+        Returns:
+            List of message IDs
+        """
+        with self._lock:
+            failed, self._failed_message_ids = self._failed_message_ids, []
+        return failed
+
+    def _restore(self, emails, threads):
+        with self._lock:
+            # Operations buffered since the flush started are more recent
+            for message_id, email_data in emails.items():
+                self._emails.setdefault(message_id, email_data)
+            for thread_id, pending in threads.items():
+                newer = self._threads.get(thread_id)
+                if newer:
+                    newer['fields'] = {**pending['fields'], **newer['fields']}
+                    newer['delivered_to'] = newer['delivered_to'] or pending['delivered_to']
+                else:
+                    self._threads[thread_id] = pending
+
+    def close(self):
+        """
+        Stop the periodic flush and write the remaining operations.
+        """
+        self._stopped.set()
+        if self._timer is not None:
+            self._timer.join()
+            self._timer = None
+        self.flush()
+
+    def _pending_count(self):
+        with self._lock:
+            return len(self._emails) + len(self._threads)
+
+    def _flush_if_needed(self):
+        with self._lock:
+            pending = len(self._emails) + len(self._threads)
+            expired = time.monotonic() - self._last_flush >= self.max_delay
+        if pending >= self.max_size or (pending and expired):
+            self.flush()
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.max_delay):
+            try:
+                if self._pending_count():
+                    self.flush()
+            except Exception as e:
+                sentry_sdk.capture_exception(e)
+                print(f"Error flushing write buffer: {e}")
+
+    def _bulk_write(self, collection, operations):
+        # Returns the write errors, whose index is the position of the failed operation
+        try:
+            collection.bulk_write(operations, ordered=False)
+            return []
+        except BulkWriteError as e:
+            # Unordered writes: the other operations went through
+            sentry_sdk.capture_exception(e)
+            errors = e.details.get('writeErrors', [])
+            print(f"Error writing {len(errors)} operations to {collection.name}: {errors[:3]}")
+            return errors
+
+
+def apply_label_changes(db, labels_added, labels_removed):
+    """
+    Apply Gmail label changes to the stored emails with a single bulk write.
+    Emails that are not stored are ignored.
+
+    Args:
+        db: Database connection
+        labels_added: Dict mapping message ID to the labels to add
+        labels_removed: Dict mapping message ID to the labels to remove
+
+    Returns:
+        Number of emails modified
+    """
+    operations = []
+    for message_id, label_ids in labels_added.items():
+        if label_ids:
+            operations.append(UpdateOne({'messageId': message_id}, {'$addToSet': {'labelIds': {'$each': list(label_ids)}}}))
+    for message_id, label_ids in labels_removed.items():
+        if label_ids:
+            operations.append(UpdateOne({'messageId': message_id}, {'$pull': {'labelIds': {'$in': list(label_ids)}}}))
+
+    if not operations:
+        return 0
+
+    result = db.emails.bulk_write(operations, ordered=False)
+    return result.modified_count
@@ -0,0 +1,222 @@
+import time
+import random
+import threading
+from googleapiclient.errors import HttpError
+
+from config import load_config
+
+# Quota units charged by Gmail for each API method
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    'getProfile': 1,
+    'labels.list': 1,
+    'history.list': 2,
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.attachments.get': 5,
+    'drafts.list': 5,
+    'drafts.get': 5,
+}
+DEFAULT_QUOTA_UNITS = 5
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def is_retryable_error(exception):
+    """
+    Check whether a Gmail API error is transient and worth retrying.
+
+    Args:
+        exception: Exception raised by a Gmail API call
+
+    Returns:
+        True for rate limit and server errors, False otherwise
+    """
+    if not isinstance(exception, HttpError):
+        return False
+
+    status = exception.resp.status
+    if status in RETRYABLE_STATUS_CODES:
+        return True
+    if status == 403:
+        return any(reason in _error_content(exception) for reason in RATE_LIMIT_REASONS)
+    return False
+
+
+def is_project_rate_limit_error(exception):
+    """Check whether a Gmail API error is the project-wide rate limit rather than the per-user one."""
+    if not isinstance(exception, HttpError):
+        return False
+    content = _error_content(exception)
+    return 'rateLimitExceeded' in content and 'userRateLimitExceeded' not in content
+
+
+def _error_content(exception):
+    content = exception.content
+    return content.decode('utf-8', 'ignore') if isinstance(content, bytes) else str(content)
+
+
+def backoff_delay(attempt, base=1.0, cap=32.0):
+    """Exponential backoff delay with jitter for the given retry attempt."""
+    return min(cap, base * (2 ** attempt)) + random.uniform(0, 1)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at a constant rate.
+    A request larger than the bucket capacity is allowed, it simply waits until
+    the bucket has been refilled for its whole cost.
+    """
+    def __init__(self, rate, capacity=None):
+        """
+        Args:
+            rate: Units added to the bucket per second
+            capacity: Maximum number of units the bucket holds (defaults to one second of rate)
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, units):
+        """
+        Take units from the bucket.
+
+        Returns:
+            Number of seconds the caller must wait before using them
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= units
+            return max(-self._tokens / self.rate, self._paused_until - now, 0)
+
+    def pause(self, seconds):
+        """Hold every request of the bucket for the given number of seconds."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class GmailQuotaScheduler:
+    """
+    Schedule Gmail API calls within the per-user and per-project quotas.
+
+    Each call reserves its quota units from the bucket of its user and from the
+    project bucket, and waits as long as needed. Rate limit errors pause the
+    bucket of the user (or the project bucket) with exponential backoff, so every
+    worker of the process slows down, not only the one that got the error.
+
+    The project bucket only accounts for the calls of this process: when several
+    instances run, the project quota should be divided between them.
+    """
+    def __init__(self, user_units_per_second=250, project_units_per_minute=1200000, max_retries=5):
+        """
+        Args:
+            user_units_per_second: Quota units allowed per user and per second
+            project_units_per_minute: Quota units allowed for the project per minute
+            max_retries: Retries of a call failing with a transient error
+        """
+        self.user_units_per_second = user_units_per_second
+        self.max_retries = max_retries
+        self._project_bucket = TokenBucket(project_units_per_minute / 60)
+        self._user_buckets = {}
+        self._lock = threading.Lock()
+
+    def _user_bucket(self, user):
+        with self._lock:
+            if user not in self._user_buckets:
+                self._user_buckets[user] = TokenBucket(self.user_units_per_second)
+            return self._user_buckets[user]
+
+    def acquire(self, method, user, count=1):
+        """
+        Wait until count calls of a method can be made for a user.
+
+        Args:
+            method: Gmail API method name (e.g. 'messages.get')
+            user: User the calls are made for
+            count: Number of calls, e.g. the size of a batch request
+        """
+        units = QUOTA_UNITS.get(method, DEFAULT_QUOTA_UNITS) * count
+        wait = max(self._user_bucket(user).reserve(units), self._project_bucket.reserve(units))
+        if wait > 0:
+            time.sleep(wait)
+
+    def backoff(self, user, attempt, error=None):
+        """
+        Pause the calls of a user (or of the whole project) after a rate limit error.
+
+        Args:
+            user: User whose call failed
+            attempt: Number of the failed attempt, starting at 0
+            error: Error received, used to tell project and user rate limits apart
+        """
+        delay = backoff_delay(attempt)
+        if is_project_rate_limit_error(error):
+            self._project_bucket.pause(delay)
+        else:
+            self._user_bucket(user).pause(delay)
+        time.sleep(delay)
+
+    def execute(self, request, method, user):
+        """
+        Execute a Gmail API request within the quotas, retrying transient errors.
+
+        Args:
+            request: Gmail API request (HttpRequest)
+            method: Gmail API method name
+            user: User the request is made for
+
+        Returns:
+            The API response
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(method, user)
+            try:
+                return request.execute()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable_error(e):
+                    raise
+                print(f"Gmail {method} failed for {user} ({e}), retrying")
+                self.backoff(user, attempt, e)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_gmail_scheduler():
+    """
+    Get the process-wide Gmail quota scheduler, configured from the environment.
+
+    Returns:
+        GmailQuotaScheduler shared by every Gmail call of the process
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            config = load_config()
+            _scheduler = GmailQuotaScheduler(
+                user_units_per_second=config['gmail_user_quota_per_second'],
+                project_units_per_minute=config['gmail_project_quota_per_minute'],
+            )
+        return _scheduler
+
+
+def execute_gmail(request, method, user):
+    """
+    Execute a Gmail API request through the process-wide quota scheduler.
+
+    Args:
+        request: Gmail API request (HttpRequest)
+        method: Gmail API method name (e.g. 'messages.get')
+        user: User the request is made for
+
+    Returns:
+        The API response
+    """
+    return get_gmail_scheduler().execute(request, method, user)
@@ -0,0 +1,313 @@
+import time
+import threading
+import sentry_sdk
+from googleapiclient.errors import HttpError
+
+from gmail_quota import get_gmail_scheduler, execute_gmail, is_retryable_error
+
+# Gmail rejects batch requests holding more than 100 calls
+MAX_BATCH_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+# Headers and fields requested by a format='metadata' fetch: enough to route a
+# message (skip, draft, invitation) and to store it without its body
+METADATA_HEADERS = ['From', 'To', 'Cc', 'Bcc', 'Subject', 'Date', 'Delivered-To', 'Content-Type']
+METADATA_FIELDS = 'id,threadId,labelIds,snippet,sizeEstimate,internalDate,payload/mimeType,payload/headers'
+
+
+def iter_message_id_pages(service, user_id='me', query=None, label_ids=None, page_token=None, page_size=MAX_PAGE_SIZE):
+    """
+    Iterate over every page of a Gmail messages.list call.
+
+    Args:
+        service: Authenticated Gmail API service
+        user_id: Gmail user ID ('me' for the authorized account)
+        query: Optional Gmail search query (e.g. 'after:1700000000')
+        label_ids: Optional list of label IDs to filter on
+        page_token: Optional page token to start from
+        page_size: Number of IDs requested per page
+
+    Yields:
+        Tuple of (list of message IDs, token of the next page or None)
+    """
+    while True:
+        params = {
+            'userId': user_id,
+            'maxResults': page_size,
+            'fields': 'messages/id,nextPageToken',
+        }
+        if query:
+            params['q'] = query
+        if label_ids:
+            params['labelIds'] = label_ids
+        if page_token:
+            params['pageToken'] = page_token
+
+        response = execute_gmail(service.users().messages().list(**params), 'messages.list', user_id)
+        page_token = response.get('nextPageToken')
+
+        yield [message['id'] for message in response.get('messages', [])], page_token
+
+        if not page_token:
+            break
+
+
+def batch_get_messages(service, message_ids, user_id='me', format='full', fields=None, metadata_headers=None, max_retries=3, errors=None):
+    """
+    Fetch up to MAX_BATCH_SIZE messages in a single Gmail batch HTTP request.
+    The quota of every sub-request is reserved from the Gmail quota scheduler,
+    and sub-requests failing with a transient error are retried with exponential backoff.
+
+    Args:
+        service: Authenticated Gmail API service
+        message_ids: List of message IDs (at most MAX_BATCH_SIZE)
+        user_id: Gmail user ID
+        format: Message format requested from the API
+        fields: Optional partial response field mask
+        metadata_headers: Headers returned with format='metadata' (all headers when None)
+        max_retries: Number of retries for failing sub-requests
+        errors: Optional dict receiving the error of each message that could not be fetched
+
+    Returns:
+        Dict mapping message ID to the message resource, for messages fetched successfully
+    """
+    if len(message_ids) > MAX_BATCH_SIZE:
+        raise ValueError(f"A Gmail batch holds at most {MAX_BATCH_SIZE} requests, got {len(message_ids)}")
+
+    scheduler = get_gmail_scheduler()
+    messages = {}
+    pending = list(message_ids)
+
+    for attempt in range(max_retries + 1):
+        failed = {}
+
+        def handle_response(request_id, response, exception):
+            if exception is not None:
+                failed[request_id] = exception
+            else:
+                messages[request_id] = response
+
+        batch = service.new_batch_http_request(callback=handle_response)
+        for message_id in pending:
+            params = {'userId': user_id, 'id': message_id, 'format': format}
+            if fields:
+                params['fields'] = fields
+            if metadata_headers:
+                params['metadataHeaders'] = metadata_headers
+            batch.add(service.users().messages().get(**params), request_id=message_id)
+
+        scheduler.acquire('messages.get', user_id, count=len(pending))
+        try:
+            batch.execute()
+        except Exception as e:
+            # The whole batch failed: retry every pending request on network or transient API errors
+            retryable = is_retryable_error(e) or not isinstance(e, HttpError)
+            if attempt >= max_retries or not retryable:
+                raise
+            print(f"Batch request failed ({e}), retrying {len(pending)} messages")
+            scheduler.backoff(user_id, attempt, e)
+            continue
+
+        pending = [message_id for message_id, error in failed.items() if is_retryable_error(error)]
+        for message_id, error in failed.items():
+            if message_id not in pending:
+                print(f"Error fetching message {message_id}: {error}")
+                if errors is not None:
+                    errors[message_id] = error
+
+        if not pending:
+            break
+        if attempt < max_retries:
+            print(f"Retrying {len(pending)} rate limited messages")
+            scheduler.backoff(user_id, attempt, failed[pending[0]])
+    else:
+        for message_id in pending:
+            error = failed.get(message_id)
+            sentry_sdk.capture_exception(error)
+            print(f"Giving up on message {message_id} after {max_retries} retries: {error}")
+            if errors is not None:
+                errors[message_id] = error
+
+    return messages
+
+
+def get_current_history_id(service, user_id='me'):
+    """
+    Get the latest historyId of a Gmail mailbox.
+
+    Args:
+        service: Authenticated Gmail API service
+        user_id: Gmail user ID
+
+    Returns:
+        The mailbox historyId
+    """
+    return execute_gmail(service.users().getProfile(userId=user_id, fields='historyId'), 'getProfile', user_id)['historyId']
+
+
+def is_history_expired_error(exception):
+    """
+    Check whether a history.list error means the start historyId is too old.
+    Gmail keeps history records for about a week and answers 404 past that.
+    """
+    return isinstance(exception, HttpError) and exception.resp.status == 404
+
+
+def is_not_found_error(exception):
+    """
+    Check whether a messages.get error means the message does not exist anymore,
+    such as a message deleted or a draft sent since it was listed.
+    """
+    return isinstance(exception, HttpError) and exception.resp.status == 404
+
+
+def list_history_changes(service, start_history_id, user_id='me'):
+    """
+    Collect the changes of a Gmail mailbox since a historyId.
+
+    Args:
+        service: Authenticated Gmail API service
+        start_history_id: historyId to read changes from
+        user_id: Gmail user ID
+
+    Returns:
+        Dictionary with:
+            added: IDs of messages added since start_history_id, in order
+            labels_added: Dict mapping message ID to the set of labels added
+            labels_removed: Dict mapping message ID to the set of labels removed
+            history_id: Latest historyId of the mailbox
+
+    Raises:
+        HttpError: 404 when start_history_id has expired (see is_history_expired_error)
+    """
+    added = {}
+    labels_added = {}
+    labels_removed = {}
+    history_id = start_history_id
+    page_token = None
+
+    while True:
+        params = {
+            'userId': user_id,
+            'startHistoryId': start_history_id,
+            'historyTypes': ['messageAdded', 'labelAdded', 'labelRemoved'],
+            'maxResults': MAX_PAGE_SIZE,
+        }
+        if page_token:
+            params['pageToken'] = page_token
+
+        response = execute_gmail(service.users().history().list(**params), 'history.list', user_id)
+        history_id = response.get('historyId', history_id)
+
+        # Records are in chronological order: a later change wins over an earlier one
+        for record in response.get('history', []):
+            for item in record.get('messagesAdded', []):
+                added[item['message']['id']] = True
+            for item in record.get('labelsAdded', []):
+                message_id = item['message']['id']
+                for label_id in item.get('labelIds', []):
+                    labels_added.setdefault(message_id, set()).add(label_id)
+                    labels_removed.get(message_id, set()).discard(label_id)
+            for item in record.get('labelsRemoved', []):
+                message_id = item['message']['id']
+                for label_id in item.get('labelIds', []):
+                    labels_removed.setdefault(message_id, set()).add(label_id)
+                    labels_added.get(message_id, set()).discard(label_id)
+
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+
+    return {
+        'added': list(added),
+        'labels_added': labels_added,
+        'labels_removed': labels_removed,
+        'history_id': history_id,
+    }
+
+
+class DraftResolver:
+    """
+    Resolve the draft ID of draft messages from a message ID -> draft ID map
+    built once per sync run, instead of listing and getting every draft for
+    each draft message.
+
+    drafts.list already returns the message ID of each draft: the map is built
+    from its pages with a minimal fields mask. Drafts listed without their
+    message ID are resolved with a batch of drafts.get calls.
+    """
+    def __init__(self, user_id='me', max_age=60):
+        """
+        Args:
+            user_id: Gmail user ID
+            max_age: Seconds after which a draft missing from the map triggers a rebuild
+        """
+        self.user_id = user_id
+        self.max_age = max_age
+        self._draft_ids = None
+        self._built_at = 0
+        self._lock = threading.Lock()
+
+    def get_draft_id(self, service, message_id):
+        """
+        Get the ID of the draft holding a message.
+
+        Args:
+            service: Authenticated Gmail API service of the calling thread
+            message_id: Gmail message ID of the draft message
+
+        Returns:
+            The draft ID, or None if the message is not a draft
+        """
+        with self._lock:
+            stale = time.monotonic() - self._built_at > self.max_age
+            if self._draft_ids is None or (message_id not in self._draft_ids and stale):
+                self._draft_ids = self._build_map(service)
+                self._built_at = time.monotonic()
+            return self._draft_ids.get(message_id)
+
+    def _build_map(self, service):
+        draft_ids = {}
+        unresolved = []
+        page_token = None
+
+        while True:
+            params = {'userId': self.user_id, 'maxResults': MAX_PAGE_SIZE, 'fields': 'drafts(id,message/id),nextPageToken'}
+            if page_token:
+                params['pageToken'] = page_token
+            response = execute_gmail(service.users().drafts().list(**params), 'drafts.list', self.user_id)
+
+            for draft in response.get('drafts', []):
+                if draft.get('message', {}).get('id'):
+                    draft_ids[draft['message']['id']] = draft['id']
+                else:
+                    unresolved.append(draft['id'])
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+
+        for start in range(0, len(unresolved), MAX_BATCH_SIZE):
+            draft_ids.update(self._batch_get_message_ids(service, unresolved[start:start + MAX_BATCH_SIZE]))
+
+        print(f"Resolved {len(draft_ids)} drafts for {self.user_id}")
+        return draft_ids
+
+    def _batch_get_message_ids(self, service, draft_ids):
+        message_to_draft = {}
+
+        def handle_response(request_id, response, exception):
+            if exception is not None:
+                print(f"Error fetching draft {request_id}: {exception}")
+            else:
+                message_to_draft[response['message']['id']] = request_id
+
+        batch = service.new_batch_http_request(callback=handle_response)
+        for draft_id in draft_ids:
+            batch.add(
+                service.users().drafts().get(userId=self.user_id, id=draft_id, format='minimal', fields='id,message/id'),
+                request_id=draft_id
+            )
+        get_gmail_scheduler().acquire('drafts.get', self.user_id, count=len(draft_ids))
+        batch.execute()
+        return message_to_draft
@@ -1,55 +1,132 @@
+import threading
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
 
-from auth_utils import refresh_access_token
+from auth_utils import get_token_manager, TokenRefreshError
 
-def setup_gmail_service(db, existing_account, config):
-    user_tokens = db.tokens.find_one({'accountId': existing_account['_id']})
+GMAIL_SCOPES = ["https://www.googleapis.com/auth/gmail.readonly"]
+CALENDAR_SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
+
+# Built services of the process: (api, version, account ID) -> (credential key, service)
+_services = {}
+_services_lock = threading.Lock()
+
+class GzipAuthorizedHttp(AuthorizedHttp):
+    """
+    Authorized HTTP client asking Google APIs for gzip-compressed responses.
+    Google only compresses responses when the User-Agent contains "gzip": the
+    API client sets it on single requests but not on batch requests.
+    """
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        headers = dict(headers or {})
+        headers['accept-encoding'] = 'gzip'
+        user_agent = headers.get('user-agent', '')
+        if 'gzip' not in user_agent:
+            headers['user-agent'] = f"{user_agent} (gzip)".strip()
+        return super().request(uri, method, body=body, headers=headers, **kwargs)
+
+def thread_local_request_builder(credentials):
+    """
+    Build the requestBuilder of a service shared by several threads.
+    httplib2 connections are not thread-safe: each thread executes the requests
+    it creates with its own authorized HTTP client.
+
+    Args:
+        credentials: Google credentials of the service
+
+    Returns:
+        Callable creating an HttpRequest on the HTTP client of the calling thread
+    """
+    from googleapiclient.http import HttpRequest
+    local = threading.local()
+
+    def build_request(http, *args, **kwargs):
+        if not hasattr(local, 'http'):
+            local.http = GzipAuthorizedHttp(credentials)
+        return HttpRequest(local.http, *args, **kwargs)
+
+    return build_request
+
+def get_google_service(api, version, account_id, credential_key, make_credentials):
+    """
+    Get a Google API service, built once per process for an account and credential.
+    Services are built from the discovery documents bundled with the API client,
+    without fetching them, and can be shared by threads (see thread_local_request_builder).
+
+    Args:
+        api: API name, e.g. 'gmail'
+        version: API version, e.g. 'v1'
+        account_id: ID of the account the service acts for
+        credential_key: Value identifying the credential (e.g. the refresh token):
+                        a different one rebuilds the service
+        make_credentials: Callable returning the credentials, only called to build the service
+
+    Returns:
+        Google API service
+    """
+    key = (api, version, str(account_id))
+    with _services_lock:
+        cached = _services.get(key)
+    if cached and cached[0] == credential_key:
+        return cached[1]
+
+    # Imported here: loading the API client is only paid by the functions calling Google APIs
+    from googleapiclient.discovery import build
+    credentials = make_credentials()
+    service = build(
+        api,
+        version,
+        http=GzipAuthorizedHttp(credentials),
+        requestBuilder=thread_local_request_builder(credentials),
+        static_discovery=True,
+        cache_discovery=False,
+    )
+    with _services_lock:
+        _services[key] = (credential_key, service)
+    return service
+
+def setup_service(db, existing_account, config, api, version, scopes):
+    """
+    Get an authorized Google API service for an account.
+    Access tokens come from the process-wide AccessTokenManager, shared by the
+    Gmail and Calendar services: they are only refreshed when about to expire,
+    or when Google rejects them.
+
+    Args:
+        db: Database connection
+        existing_account: Account document
+        config: Application configuration
+        api: API name
+        version: API version
+        scopes: OAuth scopes of the credentials
+
+    Returns:
+        Google API service, or None if the account has no tokens or they cannot be refreshed
+    """
+    account_id = existing_account['_id']
+    user_tokens = db.tokens.find_one({'accountId': account_id}, {'refreshToken': 1})
     if not user_tokens:
         return None
-    
-    access_token = user_tokens.get('accessToken')
-    refresh_token = user_tokens.get('refreshToken')
-
-    access_token, new_refresh_token = refresh_access_token(refresh_token, config['client_id'], config['client_secret'])
-    
-    if new_refresh_token != refresh_token:
-        db.tokens.update_one({'accountId': existing_account['_id']}, {'$set': {'refreshToken': new_refresh_token}})
-            
-    token_data = {
-        "token": access_token,  # Your access token
-        "refresh_token": refresh_token,  # Your refresh token
-        "token_uri": "https://oauth2.googleapis.com/token",  # Token URI for Google
-        "client_id": config['client_id'],  # Your OAuth2 client ID
-        "client_secret": config['client_secret'],  # Your OAuth2 client secret
-        "scopes": ["https://www.googleapis.com/auth/gmail.readonly"],
-    }
-    credentials = Credentials(**token_data)    
-    gmail = build('gmail', 'v1', credentials=credentials)
-    return gmail
 
-def setup_calendar_service(db, existing_account, config):
-    user_tokens = db.tokens.find_one({'accountId': existing_account['_id']})
-    if not user_tokens:
+    token_manager = get_token_manager()
+
+    def make_credentials():
+        access_token, expiry = token_manager.get_access_token(db, account_id, config)
+        credentials = Credentials(token=access_token, expiry=expiry, scopes=scopes)
+        # google-auth refreshes through the manager, when the token expires or is rejected
+        credentials.refresh_handler = lambda request, scopes=None: token_manager.get_access_token(
+            db, account_id, config, stale_token=credentials.token
+        )
+        return credentials
+
+    try:
+        return get_google_service(api, version, account_id, user_tokens.get('refreshToken'), make_credentials)
+    except TokenRefreshError as e:
+        print(f"Failed to authenticate account {account_id}: {e}")
         return None
-    
-    access_token = user_tokens.get('accessToken')
-    refresh_token = user_tokens.get('refreshToken')
-    
-    access_token, new_refresh_token = refresh_access_token(refresh_token, config['client_id'], config['client_secret'])
-    
-    if new_refresh_token != refresh_token:
-        db.tokens.update_one({'accountId': existing_account['_id']}, {'$set': {'refreshToken': new_refresh_token}})
-            
-    token_data = {
-        "token": access_token,  # Your access token
-        "refresh_token": refresh_token,  # Your refresh token
-        "token_uri": "https://oauth2.googleapis.com/token",  # Token URI for Google
-        "client_id": config['client_id'],  # Your OAuth2 client ID
-        "client_secret": config['client_secret'],  # Your OAuth2 client secret
-        "scopes": ["https://www.googleapis.com/auth/calendar.readonly"],
-    }
-    credentials = Credentials(**token_data)    
-    gmail = build('calendar', 'v3', credentials=credentials)
-    return gmail
-    
\ No newline at end of file
+
+def setup_gmail_service(db, existing_account, config):
+    return setup_service(db, existing_account, config, 'gmail', 'v1', GMAIL_SCOPES)
+
+def setup_calendar_service(db, existing_account, config):
+    return setup_service(db, existing_account, config, 'calendar', 'v3', CALENDAR_SCOPES)
@@ -0,0 +1,231 @@
+"""
+Index bootstrap and query plan verification.
+
+Creates the indexes the pipelines rely on, and checks with explain() that
+their queries are answered from an index rather than by a collection scan.
+
+Usage:
+    python indexes.py                # create the indexes, then verify the query plans
+    python indexes.py --verify-only  # only verify the query plans
+"""
+import sys
+import argparse
+import threading
+import sentry_sdk
+from bson import ObjectId
+from pymongo.errors import OperationFailure
+
+# Server error codes of create_index
+DUPLICATE_KEY = 11000
+INDEX_OPTIONS_CONFLICT = 85
+INDEX_KEY_SPECS_CONFLICT = 86
+
+# Indexes of each collection. Unique indexes with a fallback name are replaced by
+# a plain index when existing duplicates prevent them, so that lookups stay
+# indexed meanwhile; those without one must be unique and fail instead. The plain
+# index an earlier version created on the same keys ('replaces') is dropped first.
+INDEXES = {
+    'emails': [
+        # Emails are upserted on their messageId: concurrent syncs of an account cannot store one twice
+        {'keys': [('messageId', 1)], 'name': 'messageId_unique_1', 'unique': True, 'fallback': 'messageId_nonunique_1',
+         'replaces': 'messageId_1'},
+        # Emails of the threads whose summary a batch job writes back
+        {'keys': [('threadId', 1)], 'name': 'threadId_1'},
+    ],
+    'threads': [
+        # Concurrent upserts of a new thread cannot create it twice
+        {'keys': [('threadId', 1)], 'name': 'threadId_1', 'unique': True, 'fallback': 'threadId_nonunique_1'},
+    ],
+    'accounts': [
+        # Unique per user only, see the accounts schema of the API
+        {'keys': [('email', 1)], 'name': 'email_1'},
+    ],
+    'tokens': [
+        {'keys': [('accountId', 1)], 'name': 'accountId_1'},
+    ],
+    'calendar_events': [
+        {'keys': [('event_id', 1), ('calendar_id', 1), ('user_email', 1)], 'name': 'event_id_1_calendar_id_1_user_email_1',
+         'unique': True, 'fallback': 'event_id_1_calendar_id_1_user_email_nonunique_1'},
+    ],
+    'profiletypes': [
+        {'keys': [('categories', 1)], 'name': 'categories_1'},
+    ],
+    'sync_state': [
+        # Keeps the upsert of acquire_sync_lease from creating a duplicate state
+        {'keys': [('email', 1)], 'name': 'email_1', 'unique': True},
+    ],
+    'mistral_batch_jobs': [
+        {'keys': [('userEmail', 1), ('createdAt', 1)], 'name': 'userEmail_1_createdAt_1'},
+    ],
+    'message_failures': [
+        {'keys': [('email', 1), ('messageId', 1)], 'name': 'email_1_messageId_1', 'unique': True},
+    ],
+    'attachments.files': [
+        # Blobs of the attachment store are named after their content: concurrent uploads cannot store one twice
+        {'keys': [('filename', 1)], 'name': 'filename_unique_1', 'unique': True, 'fallback': 'filename_nonunique_1'},
+    ],
+}
+
+_ensured = set()
+_ensured_lock = threading.Lock()
+
+
+class QueryPlanError(Exception):
+    """A pipeline query is answered by a collection scan."""
+
+
+def ensure_collection_indexes(db, collection):
+    """
+    Create the indexes of a collection. Creating an existing index does nothing.
+
+    Args:
+        db: Database connection
+        collection: Collection name, a key of INDEXES
+
+    Returns:
+        List of the names of the indexes in place
+    """
+    names = []
+    for index in INDEXES[collection]:
+        if index.get('replaces') and index['replaces'] in db[collection].index_information():
+            print(f"Replacing the index {collection}.{index['replaces']} with {index['name']}")
+            db[collection].drop_index(index['replaces'])
+        try:
+            names.append(db[collection].create_index(index['keys'], name=index['name'], unique=index.get('unique', False)))
+        except OperationFailure as e:
+            if e.code == DUPLICATE_KEY and index.get('fallback'):
+                sentry_sdk.capture_exception(e)
+                print(f"Duplicates prevent the unique index {collection}.{index['name']}, creating a plain index: {e}")
+                names.append(db[collection].create_index(index['keys'], name=index['fallback']))
+            elif e.code in (INDEX_OPTIONS_CONFLICT, INDEX_KEY_SPECS_CONFLICT):
+                # The same keys are already indexed under another name or with other options
+                print(f"Keeping the existing index on {collection} {index['keys']}: {e}")
+                names.append(index['name'])
+            else:
+                raise
+    return names
+
+
+def ensure_indexes(db, collections=None):
+    """
+    Create the indexes of the given collections, once per database and process.
+    Safe to call from every entry point: later calls return immediately.
+
+    Args:
+        db: Database connection
+        collections: Collection names, all the collections of INDEXES by default
+
+    Returns:
+        Dict mapping each collection whose indexes were ensured to its index names
+    """
+    ensured = {}
+    for collection in collections or INDEXES:
+        key = (db.name, collection)
+        with _ensured_lock:
+            if key in _ensured:
+                continue
+            ensured[collection] = ensure_collection_indexes(db, collection)
+            _ensured.add(key)
+    return ensured
+
+
+def pipeline_queries():
+    """
+    Representative queries of the pipelines, one per lookup the indexes serve.
+
+    Returns:
+        List of (description, collection, filter, sort) tuples
+    """
+    return [
+        ('unseen message IDs', 'emails', {'messageId': {'$in': ['message-1', 'message-2']}}, None),
+        ('emails of threads', 'emails', {'threadId': {'$in': ['thread-1', 'thread-2']}}, None),
+        ('thread state', 'threads', {'threadId': {'$in': ['thread-1', 'thread-2']}}, None),
+        ('account by email', 'accounts', {'email': 'user@example.com'}, None),
+        ('account tokens', 'tokens', {'accountId': ObjectId()}, None),
+        ('stored calendar event', 'calendar_events', {'event_id': 'event-1', 'calendar_id': 'primary', 'user_email': 'user@example.com'}, None),
+        ('profile type by categories', 'profiletypes', {'categories': ['Work', 'Personal']}, None),
+        ('sync state', 'sync_state', {'email': 'user@example.com'}, None),
+        ('pending batch jobs', 'mistral_batch_jobs', {'userEmail': 'user@example.com', 'collectedAt': {'$exists': False}}, [('createdAt', 1)]),
+    ]
+
+
+def plan_stages(plan):
+    """
+    List the stages of an explain() plan, including nested input stages.
+
+    Args:
+        plan: winningPlan of an explain() output, or one of its stages
+
+    Returns:
+        List of stage names
+    """
+    if not isinstance(plan, dict):
+        return []
+    # Plans of the slot-based engine wrap the classic plan in queryPlan
+    if 'queryPlan' in plan:
+        return plan_stages(plan['queryPlan'])
+
+    stages = [plan['stage']] if 'stage' in plan else []
+    if 'inputStage' in plan:
+        stages.extend(plan_stages(plan['inputStage']))
+    for input_stage in plan.get('inputStages', []):
+        stages.extend(plan_stages(input_stage))
+    return stages
+
+
+def verify_query_plans(db, queries=None):
+    """
+    Run explain() on the pipeline queries and fail if any is a collection scan.
+
+    Args:
+        db: Database connection
+        queries: (description, collection, filter, sort) tuples, pipeline_queries() by default
+
+    Returns:
+        Dict mapping each query description to the stages of its winning plan
+
+    Raises:
+        QueryPlanError: If at least one query falls back to a COLLSCAN
+    """
+    plans = {}
+    scans = []
+    for description, collection, query, sort in queries or pipeline_queries():
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = cursor.explain()
+        stages = plan_stages(explain.get('queryPlanner', {}).get('winningPlan', {}))
+        plans[description] = stages
+        if 'COLLSCAN' in stages:
+            scans.append(f"{description} ({collection} {query})")
+
+    if scans:
+        raise QueryPlanError(f"Queries answered by a collection scan: {'; '.join(scans)}")
+    return plans
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create the MongoDB indexes of the pipelines and verify their query plans")
+    parser.add_argument('--verify-only', action='store_true', help="Do not create indexes, only verify the query plans")
+    args = parser.parse_args()
+
+    # Imported here so that importing this module does not open a client
+    from db_manager import get_database
+    db = get_database()
+
+    if not args.verify_only:
+        for collection, names in ensure_indexes(db).items():
+            print(f"{collection}: {', '.join(names)}")
+
+    try:
+        plans = verify_query_plans(db)
+    except QueryPlanError as e:
+        print(f"ERROR {e}")
+        sys.exit(1)
+
+    for description, stages in plans.items():
+        print(f"{description:30} {' <- '.join(stages)}")
+
+
+if __name__ == '__main__':
+    main()
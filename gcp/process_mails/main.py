@@ -1,17 +1,21 @@
+import sys
 from datetime import datetime
 
-from batch_last_30 import batch_last_30_days
-from retrieve_email_by_labels import retrieve_email_by_labels
-from transform_email import transform_email
-from retrieve_calendar_events import batch_calendar_events
+# Function modules are imported by their entry point on its first request:
+# a cold start only loads the dependencies of the function being deployed,
+# and health checks load none (see bench_startup.py)
 
 def health_check(request):
     if request.method == 'GET' and request.args.get('health') == 'check':
-        return {
+        result = {
             "status": "healthy",
             "function": "batch_last_30_days",
             "timestamp": datetime.now() 
-        }, 200
+        }
+        # Utilization of the MongoDB pools, once a function has used the database
+        if 'db_manager' in sys.modules:
+            result["mongoPools"] = sys.modules['db_manager'].pool_stats()
+        return result, 200
     else: 
         return False
 
@@ -22,6 +26,7 @@ def last_30_days(request):
         return health_check_result
     else:
         print("Request method:", request.method)
+        from batch_last_30 import batch_last_30_days
         return batch_last_30_days(request)
 
 def retrieve_email_by_labels_entry_point(request):
@@ -30,6 +35,7 @@ def retrieve_email_by_labels_entry_point(request):
     if health_check_result != False:
         return health_check_result
     else:
+        from retrieve_email_by_labels import retrieve_email_by_labels
         return retrieve_email_by_labels(request)
     
 
@@ -39,6 +45,7 @@ def transform_email_entry_point(request):
     if health_check_result != False:
         return health_check_result
     else:
+        from transform_email import transform_email
         return transform_email(request)
     
 def retrieve_calendar_events_entry_point(request):
@@ -47,4 +54,41 @@ def retrieve_calendar_events_entry_point(request):
     if health_check_result != False:
         return health_check_result
     else:
-        return batch_calendar_events(request)
\ No newline at end of file
+        from retrieve_calendar_events import batch_calendar_events
+        return batch_calendar_events(request)
+    
+def sync_accounts_entry_point(request):
+    health_check_result = health_check(request)
+    
+    if health_check_result != False:
+        return health_check_result
+    else:
+        from sync_scheduler import sync_due_accounts
+        return sync_due_accounts(request)
+    
+def retrieve_attachment_entry_point(request):
+    health_check_result = health_check(request)
+    
+    if health_check_result != False:
+        return health_check_result
+    else:
+        from retrieve_attachment import retrieve_attachment
+        return retrieve_attachment(request)
+    
+def collect_batch_jobs_entry_point(request):
+    health_check_result = health_check(request)
+    
+    if health_check_result != False:
+        return health_check_result
+    else:
+        from batch_collector import collect_pending_batch_jobs
+        return collect_pending_batch_jobs(request)
+    
+def migrations_entry_point(request):
+    health_check_result = health_check(request)
+    
+    if health_check_result != False:
+        return health_check_result
+    else:
+        from migrations import run_migration
+        return run_migration(request)
\ No newline at end of file
@@ -0,0 +1,147 @@
+import functions_framework
+import sentry_sdk
+from pymongo import UpdateOne
+
+from config import load_config, init_sentry
+from db_manager import MongoDBConnectionManager
+from blob_store import get_blob_store, iter_base64_chunks
+from utils import strip_attachment_data
+from email_schema import EMAIL_SCHEMA_VERSION, compact_payload
+
+init_sentry()
+
+
+def migrate_attachments(db, config, batch_size=100, limit=0):
+    """
+    Move the attachment contents stored inside emails to the blob store.
+    Attachments are replaced by references (sha256 and size), and attachment
+    contents are removed from payloads. Identical contents are stored once.
+    Emails are rewritten in place: only run it once ATTACHMENT_METADATA_ONLY is
+    enabled, the API then reading attachment contents from the blob store.
+
+    Args:
+        db: Database connection
+        config: Application configuration
+        batch_size: Number of emails rewritten per bulk write
+        limit: Maximum number of emails migrated, 0 for all
+
+    Returns:
+        Number of emails migrated
+    """
+    store = get_blob_store(db, config)
+    cursor = db.emails.find(
+        {'attachments.data': {'$exists': True}},
+        {'_id': 1, 'attachments': 1, 'payload': 1},
+        limit=limit
+    ).batch_size(batch_size)
+
+    migrated = 0
+    operations = []
+    for email in cursor:
+        attachments = []
+        for attachment in email.get('attachments', []):
+            if attachment.get('data'):
+                ref = store.put_stream(iter_base64_chunks(attachment['data']))
+                attachment = {**{key: value for key, value in attachment.items() if key != 'data'}, **ref}
+            attachments.append(attachment)
+
+        operations.append(UpdateOne(
+            {'_id': email['_id']},
+            {'$set': {'attachments': attachments, 'payload': strip_attachment_data(email.get('payload', {}))}}
+        ))
+        if len(operations) >= batch_size:
+            db.emails.bulk_write(operations, ordered=False)
+            migrated += len(operations)
+            operations = []
+
+    if operations:
+        db.emails.bulk_write(operations, ordered=False)
+        migrated += len(operations)
+
+    return migrated
+
+
+def migrate_compact_schema(db, config, batch_size=100, limit=0):
+    """
+    Rewrite emails stored in an older schema version to the current one:
+    payloads are slimmed to headers and part structure (see email_schema).
+
+    Args:
+        db: Database connection
+        config: Application configuration
+        batch_size: Number of emails rewritten per bulk write
+        limit: Maximum number of emails migrated, 0 for all
+
+    Returns:
+        Number of emails migrated
+    """
+    cursor = db.emails.find(
+        {'$or': [{'schemaVersion': {'$exists': False}}, {'schemaVersion': {'$lt': EMAIL_SCHEMA_VERSION}}]},
+        {'_id': 1, 'payload': 1},
+        limit=limit
+    ).batch_size(batch_size)
+
+    migrated = 0
+    operations = []
+    for email in cursor:
+        operations.append(UpdateOne(
+            {'_id': email['_id']},
+            {'$set': {'payload': compact_payload(email.get('payload', {})), 'schemaVersion': EMAIL_SCHEMA_VERSION}}
+        ))
+        if len(operations) >= batch_size:
+            db.emails.bulk_write(operations, ordered=False)
+            migrated += len(operations)
+            operations = []
+
+    if operations:
+        db.emails.bulk_write(operations, ordered=False)
+        migrated += len(operations)
+
+    return migrated
+
+
+MIGRATIONS = {
+    'attachments': migrate_attachments,
+    'compact_schema': migrate_compact_schema,
+}
+
+
+@functions_framework.http
+def run_migration(request):
+    """
+    Run a data migration on the emails collection.
+    Migrations are idempotent and can be called repeatedly with a limit until
+    they report no more migrated documents.
+
+    Args:
+        request: HTTP request containing the migration name, and optionally batch_size and limit
+
+    Returns:
+        Dict with status and number of migrated documents
+    """
+    try:
+        config = load_config()
+        data = request.get_json()
+        name = data.get('migration', "")
+
+        if name not in MIGRATIONS:
+            return {'status': 'error', 'message': f"Unknown migration: {name}"}, 400
+
+        # Removing the inline attachment data cannot be undone
+        if name == 'attachments' and not config['attachment_metadata_only']:
+            return {'status': 'error', 'message': "The attachments migration requires ATTACHMENT_METADATA_ONLY=true"}, 400
+
+        with MongoDBConnectionManager() as db:
+            migrated = MIGRATIONS[name](
+                db,
+                config,
+                batch_size=int(data.get('batch_size', 100)),
+                limit=int(data.get('limit', 0))
+            )
+
+        print(f"Migration {name}: {migrated} documents migrated")
+        return {'status': 'success', 'migration': name, 'migrated': migrated}
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        print(f"Error in run_migration: {str(e)}")
+        return {'status': 'error', 'message': str(e)}
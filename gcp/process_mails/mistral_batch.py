@@ -0,0 +1,464 @@
+import json
+import threading
+import time
+from datetime import datetime
+from io import BytesIO
+import sentry_sdk
+from pymongo import UpdateOne
+
+from mistral_client import DEFAULT_MODEL, get_mistral_client
+from email_processor import thread_fields
+from utils import parse_mistral_response, AI_STATUS_PENDING
+from prompt_context import categories_prompt_context
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+ACTIVE_STATUSES = ("QUEUED", "RUNNING")
+# Status recorded on jobs given up after failing to be collected max_attempts times
+UNCOLLECTABLE_STATUS = "UNCOLLECTABLE"
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_batch_client(api_key):
+    """
+    Get the process-wide Mistral SDK client for an API key, creating it on first use.
+
+    Args:
+        api_key: Mistral API key
+
+    Returns:
+        Mistral client instance
+    """
+    with _clients_lock:
+        if api_key not in _clients:
+            # The SDK is only loaded by the functions running batch jobs
+            from mistralai import Mistral
+            _clients[api_key] = Mistral(api_key=api_key)
+        return _clients[api_key]
+
+
+def prepare_email_batch(client, prompts):
+    """
+    Prepare and upload a batch file for email processing.
+
+    Args:
+        client (Mistral): The Mistral client instance.
+        prompts (list): List of (custom ID, prompt) tuples, the custom ID being the Gmail message ID.
+
+    Returns:
+        File: The uploaded input file object.
+    """
+    buffer = BytesIO()
+    for custom_id, prompt in prompts:
+        request = {
+            "custom_id": custom_id,
+            "body": {
+                "messages": [
+                    {
+                        "role": "user",
+                        "content": prompt
+                    }
+                ]
+            }
+        }
+        buffer.write(json.dumps(request).encode("utf-8"))
+        buffer.write("\n".encode("utf-8"))
+    from mistralai import File
+    return client.files.upload(file=File(file_name="emails_batch.jsonl", content=buffer.getvalue()), purpose="batch")
+
+
+def create_batch_job(client, input_file, model=DEFAULT_MODEL):
+    """
+    Create a batch job for the provided input file.
+
+    Args:
+        client (Mistral): The Mistral client instance.
+        input_file (File): The input file object.
+        model (str): The model to use for the batch job.
+
+    Returns:
+        BatchJob: The created batch job object.
+    """
+    return client.batch.jobs.create(
+        input_files=[input_file.id],
+        model=model,
+        endpoint=BATCH_ENDPOINT,
+        metadata={"job_type": "email_categorization"}
+    )
+
+
+def run_batch_job(client, job_id, timeout=600, initial_delay=2.0, max_delay=60.0):
+    """
+    Wait for a batch job to finish, polling with exponential backoff.
+
+    Args:
+        client (Mistral): The Mistral client instance.
+        job_id (str): The ID of the batch job.
+        timeout (float): Seconds to wait at most; the job may still be running when returned.
+        initial_delay (float): Seconds before the second poll.
+        max_delay (float): Maximum number of seconds between two polls.
+
+    Returns:
+        BatchJob: The batch job object, as of the last poll.
+    """
+    deadline = time.monotonic() + timeout
+    delay = initial_delay
+
+    while True:
+        batch_job = client.batch.jobs.get(job_id=job_id)
+        if batch_job.status not in ACTIVE_STATUSES:
+            print(f"Batch job {batch_job.id} completed with status: {batch_job.status}")
+            return batch_job
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            print(f"Batch job {batch_job.id} still {batch_job.status}, collecting it later")
+            return batch_job
+
+        # Avoid division by zero
+        if batch_job.total_requests > 0:
+            percent_done = round(
+                (batch_job.succeeded_requests + batch_job.failed_requests) / batch_job.total_requests * 100, 2
+            )
+            print(f"Batch job {batch_job.id}: {percent_done}% done")
+
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+
+def iter_output_lines(client, file_id):
+    """
+    Stream a JSONL file from the Mistral server, one parsed line at a time.
+    The file is never held in memory nor written to disk.
+
+    Args:
+        client (Mistral): The Mistral client instance.
+        file_id (str): The ID of the file to download.
+
+    Yields:
+        dict: Parsed JSONL lines.
+    """
+    output_file = client.files.download(file_id=file_id)
+    pending = b""
+    for chunk in output_file.stream:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if pending.strip():
+        yield json.loads(pending)
+
+
+def parse_batch_result(result, categories):
+    """
+    Turn a line of a batch output file into a category object.
+
+    Args:
+        result: Parsed output line
+        categories: List of valid categories, None when only the summary is used
+
+    Returns:
+        Dictionary with category, summary and text
+    """
+    response = result.get("response") or {}
+    if response.get("status_code") != 200:
+        error = result.get("error") or response.get("body")
+        print(f"Batch request {result.get('custom_id')} failed: {error}")
+        return {
+            "category": "Other",
+            "summary": "Error processing with AI.",
+            "text": f"Error: {error}"
+        }
+    content = response["body"]["choices"][0]["message"]["content"]
+    return parse_mistral_response(content, categories_prompt_context(categories or ['Other']))
+
+
+def failed_results(message_ids, error):
+    """Category objects stored for emails whose deferred categorization failed."""
+    return {
+        message_id: {
+            "category": "Other",
+            "summary": "Error processing with AI.",
+            "text": f"Error: {error}"
+        }
+        for message_id in message_ids
+    }
+
+
+def newest_summarized_dates(db, thread_ids):
+    """
+    Get the date of the newest email of each thread whose summary is not pending.
+
+    Args:
+        db: Database connection
+        thread_ids: List of Gmail thread IDs
+
+    Returns:
+        Dict mapping thread ID to the ISO 8601 date of its newest summarized email
+    """
+    if not thread_ids:
+        return {}
+    return {
+        thread['_id']: thread['date']
+        for thread in db.emails.aggregate([
+            {'$match': {'threadId': {'$in': list(thread_ids)}, 'aiStatus': {'$ne': AI_STATUS_PENDING}}},
+            {'$group': {'_id': '$threadId', 'date': {'$max': '$date'}}},
+        ])
+    }
+
+
+def write_back_results(db, results, categories):
+    """
+    Store the results of deferred categorizations on their emails and threads.
+    A thread only takes the summary of the latest email of the results if no
+    newer email of the thread was summarized meanwhile, e.g. by a delta sync.
+
+    Args:
+        db: Database connection
+        results: Dict mapping message ID to its category object
+        categories: List of valid categories, None to keep the category already
+                    stored on the email (e.g. the label of a labels backfill)
+
+    Returns:
+        Number of emails updated
+    """
+    if not results:
+        return 0
+
+    emails = {
+        email['messageId']: email
+        for email in db.emails.find(
+            {'messageId': {'$in': list(results)}},
+            {'_id': 0, 'messageId': 1, 'threadId': 1, 'date': 1, 'deliveredTo': 1, 'generatedCategory': 1}
+        )
+    }
+
+    current_time = datetime.now()
+    email_operations = []
+    latest_by_thread = {}
+
+    for message_id, category_obj in results.items():
+        email = emails.get(message_id)
+        if not email:
+            continue
+
+        category = email.get('generatedCategory', 'Other')
+        fields = {
+            'summary': category_obj['summary'],
+            'mistralOutputText': category_obj['text'],
+            'updatedAt': current_time,
+        }
+        if categories is not None:
+            category = category_obj['category']
+            fields['generatedCategory'] = category
+        email_operations.append(UpdateOne({'messageId': message_id}, {'$set': fields, '$unset': {'aiStatus': ''}}))
+
+        # A thread keeps the summary of its latest email
+        thread_id = email.get('threadId')
+        date = email.get('date') or ''
+        if thread_id and (thread_id not in latest_by_thread or date >= latest_by_thread[thread_id]['date']):
+            latest_by_thread[thread_id] = {
+                'date': date,
+                'summary': category_obj['summary'],
+                'category': category,
+                'delivered_to': email.get('deliveredTo'),
+            }
+
+    # Read before the emails of the results stop being pending
+    newest_dates = newest_summarized_dates(db, list(latest_by_thread))
+
+    thread_operations = []
+    for thread_id, latest in latest_by_thread.items():
+        if (newest_dates.get(thread_id) or '') > latest['date']:
+            continue
+        update = {'$set': thread_fields(latest['summary'], latest['category'])}
+        if latest['delivered_to']:
+            update['$setOnInsert'] = {'deliveredTo': latest['delivered_to']}
+        thread_operations.append(UpdateOne({'threadId': thread_id}, update, upsert=True))
+
+    if email_operations:
+        db.emails.bulk_write(email_operations, ordered=False)
+    if thread_operations:
+        db.threads.bulk_write(thread_operations, ordered=False)
+
+    return len(email_operations)
+
+
+class MistralBatch:
+    """
+    Collect the prompts of a backfill and submit them as Mistral batch jobs.
+
+    Emails whose prompt is deferred are stored with aiStatus "pending" and no
+    summary; collect_batch_jobs writes the results back once the job is done.
+    Submitted jobs are recorded in the mistral_batch_jobs collection, so a job
+    still running when an invocation ends is collected by the next one.
+    """
+    def __init__(self, db, user_email, api_key, categories=None, model=DEFAULT_MODEL):
+        """
+        Args:
+            db: Database connection
+            user_email: Email address of the account
+            api_key: Mistral API key
+            categories: List of valid categories, None when only the summary is used
+            model: Model used for the batch jobs
+        """
+        self.db = db
+        self.user_email = user_email
+        self.api_key = api_key
+        self.categories = categories
+        self.model = model
+        self._prompts = []
+        self._lock = threading.Lock()
+
+    def add(self, message_id, prompt):
+        """Defer the categorization of an email to the next batch job."""
+        with self._lock:
+            self._prompts.append((message_id, prompt))
+
+    def submit(self):
+        """
+        Submit the collected prompts as one batch job.
+        The emails must be stored before: if the job cannot be created, the
+        prompts are categorized synchronously and written back right away.
+
+        Returns:
+            ID of the batch job, or None if nothing was submitted
+        """
+        with self._lock:
+            prompts, self._prompts = self._prompts, []
+        if not prompts:
+            return None
+
+        try:
+            client = get_batch_client(self.api_key)
+            input_file = prepare_email_batch(client, prompts)
+            batch_job = create_batch_job(client, input_file, self.model)
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            print(f"Error submitting Mistral batch job, categorizing {len(prompts)} emails synchronously: {e}")
+            category_objs = get_mistral_client(self.api_key).categorize_many(
+                [prompt for _, prompt in prompts],
+                categories_prompt_context(self.categories or ['Other']),
+                user=self.user_email
+            )
+            write_back_results(self.db, dict(zip([message_id for message_id, _ in prompts], category_objs)), self.categories)
+            return None
+
+        current_time = datetime.now()
+        self.db.mistral_batch_jobs.insert_one({
+            'jobId': batch_job.id,
+            'userEmail': self.user_email,
+            'status': batch_job.status,
+            'categories': self.categories,
+            'messageIds': [message_id for message_id, _ in prompts],
+            'createdAt': current_time,
+            'updatedAt': current_time,
+        })
+        print(f"Submitted batch job {batch_job.id} with {len(prompts)} emails")
+        return batch_job.id
+
+
+def collect_batch_jobs(db, user_email, api_key, timeout=600, chunk_size=100, max_attempts=5):
+    """
+    Wait for the uncollected batch jobs of an account and write their results back.
+    Jobs still running after timeout are left for a later call. A job failing
+    to be collected max_attempts times (e.g. deleted on the Mistral side) is
+    given up: its emails are written back as failed categorizations.
+
+    Args:
+        db: Database connection
+        user_email: Email address of the account
+        api_key: Mistral API key
+        timeout: Seconds to wait at most for all the jobs
+        chunk_size: Number of results written back per bulk write
+        max_attempts: Number of failed collections after which a job is given up
+
+    Returns:
+        Number of emails updated
+    """
+    client = get_batch_client(api_key)
+    deadline = time.monotonic() + timeout
+    updated = 0
+
+    jobs = list(db.mistral_batch_jobs.find({'userEmail': user_email, 'collectedAt': {'$exists': False}}).sort('createdAt', 1))
+    for job in jobs:
+        try:
+            batch_job = run_batch_job(client, job['jobId'], timeout=max(0, deadline - time.monotonic()))
+            if batch_job.status in ACTIVE_STATUSES:
+                db.mistral_batch_jobs.update_one({'_id': job['_id']}, {'$set': {'status': batch_job.status, 'updatedAt': datetime.now()}})
+                continue
+
+            categories = job.get('categories')
+            remaining = set(job['messageIds'])
+            results = {}
+
+            if batch_job.output_file:
+                for result in iter_output_lines(client, batch_job.output_file):
+                    message_id = result.get('custom_id')
+                    if message_id not in remaining:
+                        continue
+                    remaining.discard(message_id)
+                    results[message_id] = parse_batch_result(result, categories)
+                    if len(results) >= chunk_size:
+                        updated += write_back_results(db, results, categories)
+                        results = {}
+
+            # Requests missing from the output failed, or the whole job did
+            results.update(failed_results(remaining, f"batch job {batch_job.status}"))
+            updated += write_back_results(db, results, categories)
+
+            current_time = datetime.now()
+            db.mistral_batch_jobs.update_one(
+                {'_id': job['_id']},
+                {'$set': {'status': batch_job.status, 'collectedAt': current_time, 'updatedAt': current_time}}
+            )
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            print(f"Error collecting batch job {job['jobId']}: {e}")
+            try:
+                updated += record_collect_failure(db, job, e, max_attempts)
+            except Exception as e:
+                sentry_sdk.capture_exception(e)
+                print(f"Error recording the failed collection of batch job {job['jobId']}: {e}")
+
+    return updated
+
+
+def record_collect_failure(db, job, error, max_attempts):
+    """
+    Count a failed collection of a batch job, and give the job up after max_attempts.
+
+    Args:
+        db: Database connection
+        job: mistral_batch_jobs document
+        error: Exception raised while collecting the job
+        max_attempts: Number of failed collections after which the job is given up
+
+    Returns:
+        Number of emails updated
+    """
+    attempts = job.get('collectAttempts', 0) + 1
+    current_time = datetime.now()
+    if attempts < max_attempts:
+        db.mistral_batch_jobs.update_one(
+            {'_id': job['_id']},
+            {'$set': {'collectAttempts': attempts, 'collectError': str(error), 'updatedAt': current_time}}
+        )
+        return 0
+
+    print(f"Giving up on batch job {job['jobId']} after {attempts} failed collections")
+    # The emails would otherwise stay pending forever
+    updated = write_back_results(db, failed_results(job['messageIds'], f"batch job not collected: {error}"), job.get('categories'))
+    db.mistral_batch_jobs.update_one(
+        {'_id': job['_id']},
+        {'$set': {
+            'status': UNCOLLECTABLE_STATUS,
+            'collectAttempts': attempts,
+            'collectError': str(error),
+            'collectedAt': current_time,
+            'updatedAt': current_time,
+        }}
+    )
+    return updated
@@ -0,0 +1,171 @@
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import sentry_sdk
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import load_config
+from utils import parse_mistral_response
+
+MISTRAL_CHAT_COMPLETIONS_URL = "https://api.mistral.ai/v1/chat/completions"
+DEFAULT_MODEL = "open-mistral-7b"
+
+
+class MistralClient:
+    """
+    Thread-safe Mistral chat completion client.
+    Keeps a pool of persistent HTTPS connections and caps the number of
+    requests in flight, both globally and for each user.
+    """
+    def __init__(self, api_key, model=DEFAULT_MODEL, max_in_flight=32, max_in_flight_per_user=8,
+                 connect_timeout=5, read_timeout=60, max_retries=3):
+        """
+        Args:
+            api_key: Mistral API key
+            model: Model used for chat completions
+            max_in_flight: Maximum number of concurrent requests for the whole process
+            max_in_flight_per_user: Maximum number of concurrent requests for one user
+            connect_timeout: Seconds to wait for a connection
+            read_timeout: Seconds to wait for the model to answer
+            max_retries: Retries on connection errors, rate limiting (429) and unavailability (503)
+        """
+        self.model = model
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_user = max_in_flight_per_user
+        self.timeout = (connect_timeout, read_timeout)
+
+        # Completions are not idempotent: only retry requests the server did not process.
+        # A read error or a 5xx other than 503 may follow a completed, billed request.
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            other=0,
+            status=max_retries,
+            backoff_factor=1,
+            status_forcelist=[429, 503],
+            allowed_methods=frozenset(['POST']),
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        })
+
+        self._global_slots = threading.BoundedSemaphore(max_in_flight)
+        # Semaphores of users with requests in flight only: they are dropped once unused
+        self._user_slots = weakref.WeakValueDictionary()
+        self._user_slots_lock = threading.Lock()
+
+    def _slots_for_user(self, user):
+        with self._user_slots_lock:
+            slots = self._user_slots.get(user)
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.max_in_flight_per_user)
+                self._user_slots[user] = slots
+            return slots
+
+    def complete(self, prompt, user=None):
+        """
+        Send a single-message chat completion request.
+
+        Args:
+            prompt: Prompt sent as the user message
+            user: Optional user the request is made for, used for the per-user limit
+
+        Returns:
+            Content of the model answer
+        """
+        data = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+        }
+
+        # Take the per-user slot first so that a busy user does not hold global slots while waiting
+        user_slots = self._slots_for_user(user) if user else None
+        if user_slots:
+            user_slots.acquire()
+        try:
+            with self._global_slots:
+                response = self.session.post(MISTRAL_CHAT_COMPLETIONS_URL, json=data, timeout=self.timeout)
+        finally:
+            if user_slots:
+                user_slots.release()
+
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"]
+
+    def categorize(self, prompt, prompt_context, user=None):
+        """
+        Categorize and summarize an email.
+
+        Args:
+            prompt: Formatted prompt string
+            prompt_context: PromptContext of the valid categories
+            user: Optional user the request is made for
+
+        Returns:
+            Dictionary with category, summary and text
+        """
+        try:
+            return parse_mistral_response(self.complete(prompt, user), prompt_context)
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            print(f"Error calling Mistral API: {e}")
+            return {
+                "category": "Other",
+                "summary": "Error processing with AI.",
+                "text": f"Error: {str(e)}"
+            }
+
+    def categorize_many(self, prompts, prompt_context, user=None):
+        """
+        Categorize and summarize several emails concurrently.
+
+        Args:
+            prompts: List of formatted prompt strings
+            prompt_context: PromptContext of the valid categories
+            user: Optional user the requests are made for
+
+        Returns:
+            List of dictionaries with category, summary and text, in the order of prompts
+        """
+        if not prompts:
+            return []
+
+        workers = min(len(prompts), self.max_in_flight_per_user if user else self.max_in_flight)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda prompt: self.categorize(prompt, prompt_context, user), prompts))
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_mistral_client(api_key):
+    """
+    Get the process-wide Mistral client for an API key, creating it on first use.
+    Limits and timeouts are read from the configuration.
+
+    Args:
+        api_key: Mistral API key
+
+    Returns:
+        MistralClient instance shared by every caller of the process
+    """
+    with _clients_lock:
+        if api_key not in _clients:
+            config = load_config()
+            _clients[api_key] = MistralClient(
+                api_key,
+                max_in_flight=config['mistral_max_in_flight'],
+                max_in_flight_per_user=config['mistral_max_in_flight_per_user'],
+                read_timeout=config['mistral_timeout'],
+            )
+        return _clients[api_key]
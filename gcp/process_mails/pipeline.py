@@ -0,0 +1,192 @@
+import queue
+import threading
+from contextlib import nullcontext
+import sentry_sdk
+
+DEFAULT_QUEUE_SIZE = 100
+
+# Sentinel pushed through the queues once the source is exhausted
+_DONE = object()
+
+
+class Stage:
+    """
+    A pipeline stage: a handler run by a pool of worker threads.
+    """
+    def __init__(self, name, handler, workers=1, queue_size=None, limiter=None, expand=False):
+        """
+        Args:
+            name: Stage name, used in logs and statistics
+            handler: Callable receiving one item and returning the item for the next stage.
+                     Returning None drops the item.
+            workers: Number of worker threads running the handler
+            queue_size: Capacity of the bounded queue feeding this stage
+            limiter: Optional threading.Semaphore shared with other stages or pipelines
+                     to cap the number of concurrent handler calls, including the
+                     iteration of the results of expand stages
+            expand: If True, the handler returns an iterable and each element is
+                    passed on to the next stage
+        """
+        if workers < 1:
+            raise ValueError(f"Stage {name} needs at least one worker")
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.limiter = limiter
+        self.expand = expand
+
+
+class Pipeline:
+    """
+    Run items through a sequence of stages connected by bounded queues.
+    Each stage has its own worker pool, so network calls, LLM calls and
+    database writes for different items overlap. Bounded queues block the
+    upstream stages when a downstream stage falls behind, which keeps memory
+    usage flat whatever the number of items.
+    """
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE):
+        """
+        Args:
+            stages: List of Stage objects, in processing order
+            queue_size: Default capacity of the queues between stages
+        """
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items):
+        """
+        Feed items to the first stage and wait for every stage to drain.
+
+        Args:
+            items: Iterable of input items, consumed lazily
+
+        Returns:
+            Dict with the number of items leaving the last stage ('completed')
+            and per-stage 'processed', 'dropped' and 'failed' counters
+        """
+        queues = [queue.Queue(maxsize=stage.queue_size or self.queue_size) for stage in self.stages]
+        stats = {
+            'completed': 0,
+            'stages': {stage.name: {'processed': 0, 'dropped': 0, 'failed': 0} for stage in self.stages},
+        }
+        stats_lock = threading.Lock()
+        threads = []
+
+        for index, stage in enumerate(self.stages):
+            input_queue = queues[index]
+            output_queue = queues[index + 1] if index + 1 < len(queues) else None
+            finished = {'workers': 0}
+
+            for worker_index in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(stage, input_queue, output_queue, stats, stats_lock, finished),
+                    name=f"{stage.name}-{worker_index}",
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        source_error = None
+        try:
+            for item in items:
+                queues[0].put(item)
+        except Exception as e:
+            source_error = e
+        finally:
+            queues[0].put(_DONE)
+
+        for thread in threads:
+            thread.join()
+
+        if source_error is not None:
+            raise source_error
+
+        return stats
+
+    def _work(self, stage, input_queue, output_queue, stats, stats_lock, finished):
+        """
+        Worker loop: process items until the end-of-stream sentinel is received.
+        The last worker of a stage to stop forwards the sentinel downstream.
+        """
+        stage_stats = stats['stages'][stage.name]
+
+        while True:
+            item = input_queue.get()
+            if item is _DONE:
+                # Let the sibling workers see the sentinel too
+                input_queue.put(_DONE)
+                with stats_lock:
+                    finished['workers'] += 1
+                    last_worker = finished['workers'] == stage.workers
+                if last_worker and output_queue is not None:
+                    output_queue.put(_DONE)
+                return
+
+            try:
+                emitted = 0
+                for output in self._outputs(stage, item):
+                    if output is None:
+                        continue
+                    emitted += 1
+                    if output_queue is not None:
+                        output_queue.put(output)
+
+                with stats_lock:
+                    stage_stats['processed'] += 1
+                    if not emitted:
+                        stage_stats['dropped'] += 1
+                    if output_queue is None:
+                        stats['completed'] += emitted
+            except Exception as e:
+                sentry_sdk.capture_exception(e)
+                print(f"Error in pipeline stage {stage.name}: {e}")
+                with stats_lock:
+                    stage_stats['failed'] += 1
+
+
+    def _outputs(self, stage, item):
+        """
+        Yield the outputs of the handler for an item. The limiter is held while
+        the handler runs and, for expand stages, while each output is produced,
+        but not while outputs wait for room in the next queue: a stage blocked
+        downstream does not keep the slots of stages sharing its limiter.
+        """
+        limiter = stage.limiter if stage.limiter is not None else nullcontext()
+        with limiter:
+            result = stage.handler(item)
+        if not stage.expand:
+            yield result
+            return
+
+        outputs = iter(result or [])
+        while True:
+            with limiter:
+                output = next(outputs, _DONE)
+            if output is _DONE:
+                return
+            yield output
+
+
+def per_worker(factory):
+    """
+    Wrap a factory so that each worker thread lazily gets its own instance.
+    Useful for objects that are not thread-safe, or costly to look up for every item.
+
+    Args:
+        factory: Callable creating a new instance
+
+    Returns:
+        Callable returning the instance of the calling thread
+    """
+    local = threading.local()
+
+    def get():
+        if not hasattr(local, 'value'):
+            local.value = factory()
+        return local.value
+
+    return get
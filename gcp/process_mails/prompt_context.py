@@ -0,0 +1,181 @@
+import re
+import string
+import threading
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+
+from constants import CATEGORIES, PROMPT_CATEGORIES
+
+# Number of profile type versions whose context is kept
+MAX_CONTEXTS = 256
+
+_contexts = OrderedDict()
+_contexts_lock = threading.Lock()
+
+
+def normalize_string(s):
+    """
+    Normalizes a given string for consistent comparison.
+
+    This function transforms the input string into a standardized format by:
+    - Converting all characters to lowercase.
+    - Removing punctuation marks.
+    - Stripping leading and trailing whitespace.
+
+    These normalization steps help in achieving uniformity in text data, which is
+    particularly useful for comparison or searching tasks where case and punctuation
+    variations might otherwise lead to mismatches.
+
+    Parameters:
+    s (str): The input string to be normalized.
+
+    Returns:
+    str: The normalized string, ready for consistent comparison or analysis.
+    """
+    # Lowercase the string
+    s = s.lower()
+    # Remove punctuation
+    s = s.translate(str.maketrans('', '', string.punctuation))
+    # Strip leading and trailing whitespace
+    s = s.strip()
+    return s
+
+
+class PromptContext(namedtuple('PromptContext', ['prompt_categories', 'categories', 'patterns', 'part_patterns'])):
+    """
+    Categories of the prompts of a user: the category block of the prompt
+    templates, the valid category names, a compiled pattern per category and
+    the patterns of the parts of slash-separated names (e.g. "Promotions" for
+    "Notifications/Promotions").
+    Contexts are immutable, so one context is shared by every thread
+    categorizing the emails of users with the same profile type.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, prompt_categories, categories):
+        """
+        Build a context, compiling the pattern of each category once.
+
+        Args:
+            prompt_categories: Categories formatted for the AI prompt
+            categories: Valid category names
+
+        Returns:
+            PromptContext
+        """
+        def compile_pattern(name):
+            return re.compile(r'\b' + re.escape(normalize_string(name)) + r'\b', re.IGNORECASE)
+
+        categories = tuple(categories)
+        patterns = tuple(compile_pattern(category) for category in categories)
+        part_patterns = tuple(
+            (category, compile_pattern(part))
+            for category in categories if '/' in category
+            for part in category.split('/') if normalize_string(part)
+        )
+        return cls(prompt_categories, categories, patterns, part_patterns)
+
+    def match(self, text):
+        """
+        Find the first category contained in a text, matching whole words case-insensitively.
+        A text containing no full category name matches the first category with
+        a part in it, as Mistral sometimes answers with half of a slash-separated name.
+
+        Args:
+            text: Text to search, such as the category returned by Mistral
+
+        Returns:
+            The first matching category, or None if no category is found
+        """
+        normalized_text = normalize_string(text)
+        for category, pattern in zip(self.categories, self.patterns):
+            if pattern.search(normalized_text):
+                return category
+        for category, pattern in self.part_patterns:
+            if pattern.search(normalized_text):
+                return category
+        return None
+
+
+def build_profile_type_context(profile_type):
+    """
+    Build the context of a profile type from its enabled categories.
+
+    Args:
+        profile_type: Profile type document, with its categories
+
+    Returns:
+        PromptContext
+    """
+    categories = []
+    category_descriptions = []
+
+    for category in profile_type['categories']:
+        if category['disable'] == False:
+            categories.append(category['name'])
+            description = category.get('description', '')  # Default to empty string if no description
+            category_descriptions.append(f"{category['name']}: {description}")
+
+    # Format the categories with their descriptions for the prompt
+    prompt_categories = "\n" + "\n".join(category_descriptions) + "\n"
+
+    return PromptContext.build(prompt_categories, categories)
+
+
+def get_prompt_context(profile_type):
+    """
+    Get the context of a profile type, memoized by profile type version: a
+    context is built again only once the profile type has been updated.
+    Profile types without updatedAt or __v have no version and are not memoized.
+
+    Args:
+        profile_type: Profile type document, with its categories
+
+    Returns:
+        PromptContext
+    """
+    version = (profile_type.get('updatedAt'), profile_type.get('__v'))
+    if version == (None, None):
+        return build_profile_type_context(profile_type)
+
+    key = (profile_type.get('_id'), version)
+    with _contexts_lock:
+        context = _contexts.get(key)
+        if context is not None:
+            _contexts.move_to_end(key)
+            return context
+
+    context = build_profile_type_context(profile_type)
+    with _contexts_lock:
+        _contexts[key] = context
+        while len(_contexts) > MAX_CONTEXTS:
+            _contexts.popitem(last=False)
+    return context
+
+
+@lru_cache(maxsize=64)
+def _categories_context(categories):
+    return PromptContext.build('', categories)
+
+
+def categories_prompt_context(categories):
+    """
+    Get a context matching a list of categories, without category block
+    (e.g. to parse the results of a batch job, which records its categories).
+
+    Args:
+        categories: Valid category names
+
+    Returns:
+        PromptContext
+    """
+    return _categories_context(tuple(categories))
+
+
+_default_context = PromptContext.build(PROMPT_CATEGORIES, CATEGORIES)
+
+
+def default_prompt_context():
+    """Get the context of the standard categories, used for users without a profile type."""
+    return _default_context
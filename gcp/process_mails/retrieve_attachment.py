@@ -0,0 +1,71 @@
+import functions_framework
+import sentry_sdk
+from flask import Response
+
+from config import load_config, init_sentry
+from google_utils import setup_gmail_service
+from db_manager import get_database
+from attachments import store_attachment
+from blob_store import get_blob_store
+
+init_sentry()
+
+
+@functions_framework.http
+def retrieve_attachment(request):
+    """
+    Retrieve the content of an email attachment.
+    Emails only store attachment metadata: the content is fetched from Gmail on
+    demand, saved to the content-addressed blob store, and streamed from it.
+
+    Args:
+        request: HTTP request containing user_email, messageId and attachment_id
+
+    Returns:
+        Streamed response with the raw content of the attachment
+    """
+    try:
+        config = load_config()
+        data = request.get_json()
+
+        user_email = data.get('user_email', "")
+        message_id = data.get('messageId', "")
+        attachment_id = data.get('attachment_id', "")
+
+        db = get_database()
+        existing_account = db.accounts.find_one({'email': user_email})
+
+        # Check if account exists
+        if not existing_account:
+            print(f"No account found for email: {user_email}")
+            return {'status': 'error', 'message': 'Account not found'}, 404
+
+        # Only the emails of the account: another account cannot read them through its own token
+        email = db.emails.find_one({'messageId': message_id, 'deliveredTo': user_email}, {'_id': 0, 'attachments': 1})
+        attachment = next(
+            (attachment for attachment in (email or {}).get('attachments', []) if attachment.get('attachment_id') == attachment_id),
+            None
+        )
+        if not attachment:
+            return {'status': 'error', 'message': 'Attachment not found'}, 404
+
+        gmail_service = setup_gmail_service(db, existing_account, config)
+        if not gmail_service:
+            return {'status': 'error', 'message': 'Failed to authenticate'}, 401
+
+        store = get_blob_store(db, config)
+        ref = store_attachment(gmail_service, db, store, user_email, message_id, attachment, config)
+
+        # The process-wide client stays open while GridFS streams the blob chunk by chunk
+        return Response(
+            store.iter_chunks(ref['sha256']),
+            mimetype=attachment.get('mimeType') or 'application/octet-stream',
+            headers={
+                'Content-Length': str(ref['size']),
+                'Content-Disposition': f"attachment; filename=\"{attachment.get('filename') or 'attachment'}\"",
+            }
+        )
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        print(f"Error in retrieve_attachment: {str(e)}")
+        return {'status': 'error', 'message': str(e)}, 500
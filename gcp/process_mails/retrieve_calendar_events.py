@@ -2,28 +2,17 @@ import os
 from datetime import datetime, timedelta
 import functions_framework
 import sentry_sdk
-import chromadb
 
-from config import load_config
+from config import load_config, init_sentry
 from user_utils import get_user_by_email
 from google_utils import setup_calendar_service
 from db_manager import MongoDBConnectionManager
 # from chromadb_utils import insert_calendar_event_to_chromadb
 
-# Initialize Sentry for error tracking
-def init_sentry():
-    sentry_sdk.init(
-        dsn=os.environ.get('SENTRY_SDK'),
-        traces_sample_rate=1.0,
-        profiles_sample_rate=1.0,
-    )
-
 API_KEY_MISTRAL = os.environ.get('API_KEY_MISTRAL')
         
 init_sentry()
 
-chroma_client = chromadb.PersistentClient(path="/tmp/chroma_db")
-
 def fetch_calendar_events(service, user_email, days=30, days_ahead=30):
     """
     Fetch calendar events from Google Calendar for a specified time period.
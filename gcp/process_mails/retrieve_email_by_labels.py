@@ -1,18 +1,21 @@
 import os
 import pymongo
-from pymongo import MongoClient
 from datetime import datetime, timedelta
 import functions_framework
 import sentry_sdk
-import json
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from flask import jsonify, make_response
-from mistralai import File,Mistral
-from io import BytesIO
-import time
-import tempfile
 from utils import fetch_email_without_category
+from config import load_config, init_sentry
+from google.oauth2.credentials import Credentials
+from google_utils import get_google_service
+from db_manager import get_database
+from gmail_utils import batch_get_messages, MAX_BATCH_SIZE, DraftResolver
+from gmail_quota import execute_gmail
+from email_store import filter_unseen_message_ids, WriteBuffer, ThreadStateCache
+from pipeline import Pipeline, Stage
+from backfill import BackfillProgress
+from mistral_batch import MistralBatch, collect_batch_jobs
+from user_utils import get_user_cache
 from bson import ObjectId
 
 INSTRUCTIONS_TEMPLATE = """
@@ -64,33 +67,17 @@ summary of past email threads:
 
 API_KEY_MISTRAL = os.environ.get('API_KEY_MISTRAL')
 
-sentry_sdk.init(
-    dsn=os.environ.get('SENTRY_SDK'),
-    # Set traces_sample_rate to 1.0 to capture 100%
-    # of transactions for tracing.
-    traces_sample_rate=1.0,
-    # Set profiles_sample_rate to 1.0 to profile 100%
-    # of sampled transactions.
-    # We recommend adjusting this value in production.
-    profiles_sample_rate=1.0,
-)
-
-if (os.environ.get('URI_MONGODB')):
-    mongo_db_url = os.environ.get('URI_MONGODB')
-else:
-    mongo_db_url = "mongodb://localhost:27017"
-    
-    
+init_sentry()
+
 ALLOWED_ORIGINS = {'http://localhost:3030'}
 
-client = Mistral(api_key=os.environ.get('API_KEY_MISTRAL'))
+BACKFILL_JOB = 'labels'
 
 @functions_framework.http
 def retrieve_email_by_labels(request):
     try:
-        client = MongoClient(mongo_db_url)
-        # db = client.melifydev # Connect to the database
-        db = client[os.environ.get('DATABASE_NAME')] # Connect to the database
+        # Database of the process-wide client, whose pool is reused across invocations
+        db = get_database()
         print("Connected to the database successfully!")
     except pymongo.errors.ConnectionFailure as e:
         print("Could not connect to MongoDB:", e)
@@ -110,6 +97,7 @@ def retrieve_email_by_labels(request):
             response.headers['Access-Control-Max-Age'] = '3600'
             return response
         
+        config = load_config()
         data = request.get_json()
         user_email = data.get('user_email', "")
         
@@ -131,13 +119,11 @@ def retrieve_email_by_labels(request):
                 
         service = get_gmail_service(tokens_collection, existing_account['_id'])
         
-        labels = get_user_labels(service)
+        labels = get_user_labels(service, user_email)
         
         if not labels:
             return jsonify({'status': 'warning', 'message': 'No labels found for this user.'}), 200
         
-        emails_by_label = {}
-        
         profiletype_obj = {
             'description': "description",
             'categories': [
@@ -169,18 +155,62 @@ def retrieve_email_by_labels(request):
         # Update the user's profiletype reference
         users_collection.update_one(
             {'_id': user['_id']},
-            {'$set': {'profileType': ObjectId(profiletype_id)}}
-        )    
+            # updatedAt lets the instances polling for user changes see the new profile type
+            {'$set': {'profileType': ObjectId(profiletype_id), 'updatedAt': datetime.now()}}
+        )
+        # Without waiting for the change stream, so that this instance syncs with the new categories
+        get_user_cache().invalidate(db_name=db.name, user_id=user['_id'])
+        # Labels already retrieved by an interrupted run are skipped,
+        # and the label it stopped on resumes from its last page
+        progress = BackfillProgress(
+            db,
+            user_email,
+            BACKFILL_JOB,
+            time_budget=config['backfill_time_budget'],
+            initial={'completedLabels': [], 'labelId': None}
+        )
+
+        # Summaries are deferred to Mistral batch jobs; the label is the category
+        batch = None
+        if config['mistral_batch_backfill']:
+            batch = MistralBatch(db, user_email, API_KEY_MISTRAL, categories=None, model=config['mistral_batch_model'])
+
+        # Draft IDs of the whole run are resolved from a single listing of the drafts
+        draft_resolver = DraftResolver(user_email)
+
         for label in labels:
             label_id = label['id']
-            label_name = label['name']
-            
-            emails = get_emails_by_label(service, label_id)
-            emails_by_label[label_name] = emails
-
-            message_ids = [msg["id"] for msg in emails]
-            retrieve_emails(service, message_ids, db, label, user_email)
-            
+
+            if label_id in progress.get('completedLabels'):
+                continue
+            if progress.get('labelId') != label_id:
+                progress.save(labelId=label_id, pageToken=None)
+
+            retrieve_emails(
+                service,
+                progress.iter_pages(service, label_ids=[label_id]),
+                db,
+                label,
+                user_email,
+                config,
+                on_page_done=progress.add_processed,
+                batch=batch,
+                draft_resolver=draft_resolver
+            )
+
+            if progress.stopped:
+                collect_batch_jobs(db, user_email, API_KEY_MISTRAL, timeout=config['mistral_batch_wait'])
+                return jsonify({
+                    'status': 'partial',
+                    'message': 'time budget spent, call again to resume',
+                    'processed': progress.get('processed')
+                }), 200
+
+            progress.save(completedLabels=progress.get('completedLabels') + [label_id], labelId=None, pageToken=None)
+
+        progress.complete()
+        collect_batch_jobs(db, user_email, API_KEY_MISTRAL, timeout=config['mistral_batch_wait'])
+
         if origin in ALLOWED_ORIGINS:
                 response.headers['Access-Control-Allow-Origin'] = origin
         # categorized = categorize_emails(emails_details)
@@ -203,23 +233,23 @@ def get_gmail_service(tokens_collection, accountId):
     token_data = tokens_collection.find_one({"accountId": accountId})
     access_token = token_data['accessToken']
 
-    # Use the access token to authenticate Gmail API
-    creds = Credentials(token=access_token)
-    service = build('gmail', 'v1', credentials=creds)
-    return service
+    # Use the access token to authenticate Gmail API; the service is built once per token.
+    # Cached apart from the refresh-token service of setup_gmail_service, so that neither evicts the other
+    return get_google_service('gmail', 'v1', f"{accountId}:access_token", access_token, lambda: Credentials(token=access_token))
 
-def get_user_labels(service):
+def get_user_labels(service, user_email='me'):
     """
     Retrieve user-created labels from the Gmail API.
     
     Args:
-        service: The Gmail API service object.
+        service: The Gmail API service object, shared by the worker threads.
+        user_email: User's email address, used for quota accounting.
 
     Returns:
         A list of user-created labels.
     """
     # Call the Gmail API to retrieve labels
-    results = service.users().labels().list(userId='me').execute()
+    results = execute_gmail(service.users().labels().list(userId='me'), 'labels.list', user_email)
     labels = results.get('labels', [])
     
     # Filter labels to include only those with type 'user'
@@ -227,189 +257,87 @@ def get_user_labels(service):
     
     return user_labels
 
-def get_emails_by_label(service, label_id):
-    """
-    Retrieve emails for a given label ID from the Gmail API.
-    
-    Args:
-        service: The Gmail API service object.
-        label_id: The ID of the label to filter emails.
-
-    Returns:
-        A list of emails associated with the label.
-    """
-    messages = []
-    response = service.users().messages().list(userId='me', labelIds=[label_id]).execute()
-
-    if 'messages' in response:
-        messages.extend(response['messages'])
-
-    # Handle pagination if necessary
-    while 'nextPageToken' in response:
-        response = service.users().messages().list(
-            userId='me', labelIds=[label_id], pageToken=response['nextPageToken']
-        ).execute()
-        if 'messages' in response:
-            messages.extend(response['messages'])
-
-    return messages
-
-def retrieve_emails(service, message_ids, db, label, user_email):
-    emails_collection = db['emails']
-
-    # Function to process each message in the batch request
-    def handle_message_request(request_id, response, exception):
-        current_time = datetime.now()
-        if exception is not None:
-            print(f"Error fetching message {request_id}: {exception}")
-        else:
-            existing_email = emails_collection.find_one({"messageId": response['id']})
-            if existing_email:
-                print(f"Email with ID {response['id']} already exists in the database. Skipping fetch and insertion.")
-            else:
-                # print(f"Message {response} fetched successfully")
-                email_detail = fetch_email_without_category(service, user_email, response['id'], response, db, INSTRUCTIONS_WITH_CONTEXT_TEMPLATE, INSTRUCTIONS_TEMPLATE, API_KEY_MISTRAL, label['name'])
-            
-                if email_detail:
-                    email_detail['createdAt'] = current_time
-                    email_detail['updatedAt'] = current_time
-                    # Insert the fetched email into the 'emails' collection
-                    insert_result = emails_collection.insert_one(email_detail)
-                    
-                    if insert_result.acknowledged:
-                        print(f"New email with ID {message_id} added to the database.")
-                    else:
-                        print(f"Failed to insert email with ID {message_id}.")
-
-    # Create a batch request
-    batch = service.new_batch_http_request()
-
-    # Add each message retrieval request to the batch
-    for message_id in message_ids:
-        batch.add(service.users().messages().get(userId="me", id=message_id, format="full"), callback=handle_message_request)
-
-
-    # Execute the batch request
-    batch.execute()
-
-def prepare_email_batch(client, emails):
-    """
-    Prepare and upload a batch file for email processing.
-
-    Args:
-        client (Mistral): The Mistral client instance.
-        emails (list): List of email details to process.
-
-    Returns:
-        File: The uploaded input file object.
+def retrieve_emails(service, pages, db, label, user_email, config, on_page_done=None, batch=None, draft_resolver=None):
     """
-    buffer = BytesIO()
-    for idx, email in enumerate(emails):
-        request = {
-            "custom_id": str(idx),
-            "body": {
-                "max_tokens": 500,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": f"Categorize this email: {email['body']}. Subject: {email['subject']}."
-                    }
-                ]
-            }
-        }
-        buffer.write(json.dumps(request).encode("utf-8"))
-        buffer.write("\n".encode("utf-8"))
-    return client.files.upload(file=File(file_name="emails_batch.jsonl", content=buffer.getvalue()), purpose="batch")
+    Fetch, summarize and store the given messages of a label.
 
-def run_batch_job(client, input_file, model="mistral-small-latest"):
-    """
-    Run a batch job using the provided input file and model.
+    Messages go through a staged pipeline: Gmail batch fetch, then processing
+    (decoding, Mistral summary, thread update), then storage. Each stage has its
+    own worker pool and stages are connected by bounded queues. Pages are
+    processed one after the other: a page is fully stored before the next one
+    is requested.
 
     Args:
-        client (Mistral): The Mistral client instance.
-        input_file (File): The input file object.
-        model (str): The model to use for the batch job.
-
-    Returns:
-        BatchJob: The completed batch job object.
-    """
-    batch_job = client.batch.jobs.create(
-        input_files=[input_file.id],
-        model=model,
-        endpoint="/v1/chat/completions",
-        metadata={"job_type": "email_categorization"}
-    )
-
-    while batch_job.status in ["QUEUED", "RUNNING"]:
-        batch_job = client.batch.jobs.get(job_id=batch_job.id)
-        
-        # Avoid division by zero
-        if batch_job.total_requests > 0:
-            percent_done = round(
-                (batch_job.succeeded_requests + batch_job.failed_requests) / batch_job.total_requests * 100, 2
-            )
-        else:
-            percent_done = 0
-
-        time.sleep(1)
-
-    print(f"Batch job {batch_job.id} completed with status: {batch_job.status}")
-    return batch_job
-
-def download_file(client, file_id, output_path):
-    """
-    Download a file from the Mistral server.
-
-    Args:
-        client (Mistral): The Mistral client instance.
-        file_id (str): The ID of the file to download.
-        output_path (str): The path where the file will be saved.
-    """
-    if file_id is not None:
-        print(f"Downloading file to {output_path}")
-        output_file = client.files.download(file_id=file_id)
-        with open(output_path, "w") as f:
-            for chunk in output_file.stream:
-                f.write(chunk.decode("utf-8"))
-        print(f"Downloaded file to {output_path}")
-        
-def categorize_emails(emails, model="codestral-latest"):
-    """
-    Main function to categorize emails using Mistral batch API.
-
-    Args:
-        emails (list): List of email details to categorize.
-        model (str): Model name to use.
+        service: The Gmail API service object.
+        pages: Iterable of lists of IDs of the messages to retrieve.
+        db: Database connection.
+        label: Gmail label the messages belong to.
+        user_email: User's email address.
+        config: Application configuration.
+        on_page_done: Optional callable receiving the number of emails stored for each page.
+        batch: Optional MistralBatch the summaries are deferred to, submitted after every page.
+        draft_resolver: Optional DraftResolver shared by the run.
 
     Returns:
-        list: List of emails with their respective categories.
+        Number of emails inserted.
     """
-    input_file = prepare_email_batch(client, emails)
-    print(f"Uploaded batch file: {input_file}")
-
-    batch_job = run_batch_job(client, input_file, model)
-    print(f"Batch job completed in {batch_job.completed_at - batch_job.created_at} seconds")
-    
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".jsonl") as temp_file:
-        output_path = temp_file.name
-        
-    try:
-        # Download results to temporary file
-        download_file(client, batch_job.output_file, output_path)
-        categorized_emails = []
-
-        # Process the downloaded file
-        with open(output_path, "r") as f:
-            for line in f:
-                result = json.loads(line)  # Parse JSONL line
-                custom_id = int(result["custom_id"])
-                category = result["response"]['body']['choices'][0]['message']['content']
-                emails[custom_id]["category"] = category
-                categorized_emails.append(emails[custom_id])
-
-        return categorized_emails
-    finally:
-        # Remove the temporary file
-        if os.path.exists(output_path):
-            os.remove(output_path)
-        print(f"Temporary file removed at {output_path}")
\ No newline at end of file
+    # Thread context of the run, loaded in bulk for each fetched batch of messages
+    thread_cache = ThreadStateCache(db)
+
+    def fetch_stage(chunk):
+        # Skip emails already in the database with a single query, before fetching them
+        unseen_ids = filter_unseen_message_ids(db, chunk)
+        if len(unseen_ids) < len(chunk):
+            print(f"{len(chunk) - len(unseen_ids)} emails already exist in the database. Skipping fetch and insertion.")
+        if not unseen_ids:
+            return
+
+        messages = batch_get_messages(service, unseen_ids, user_id=user_email)
+        thread_cache.seed(message.get('threadId') for message in messages.values())
+        for message_id in unseen_ids:
+            if message_id in messages:
+                yield messages[message_id]
+
+    def process_stage(message):
+        return fetch_email_without_category(service, user_email, message['id'], message, db, INSTRUCTIONS_WITH_CONTEXT_TEMPLATE, INSTRUCTIONS_TEMPLATE, API_KEY_MISTRAL, label['name'], write_buffer, batch, draft_resolver, thread_cache)
+
+    def store_stage(email_detail):
+        current_time = datetime.now()
+        email_detail['createdAt'] = current_time
+        email_detail['updatedAt'] = current_time
+        # Queue the fetched email for insertion into the 'emails' collection
+        write_buffer.add_email(email_detail)
+        return email_detail
+
+    pipeline = Pipeline([
+        Stage('fetch', fetch_stage, workers=config['pipeline_fetch_workers'], expand=True),
+        Stage('process', process_stage, workers=config['pipeline_categorize_workers']),
+        Stage('store', store_stage, workers=config['pipeline_store_workers']),
+    ], queue_size=config['pipeline_queue_size'])
+
+    emails_inserted = 0
+
+    # Email inserts and thread upserts are written in bulk
+    with WriteBuffer(
+        db,
+        max_size=config['write_buffer_size'],
+        max_delay=config['write_buffer_delay'],
+        schema_version=config['email_schema_version']
+    ) as write_buffer:
+        for message_ids in pages:
+            page_inserted = 0
+            if message_ids:
+                chunks = (message_ids[start:start + MAX_BATCH_SIZE] for start in range(0, len(message_ids), MAX_BATCH_SIZE))
+                stats = pipeline.run(chunks)
+                write_buffer.flush()
+                # Submitted once the emails are stored, so that results can always be written back
+                if batch is not None:
+                    batch.submit()
+                print(f"Pipeline statistics for label {label['name']}: {stats}")
+                page_inserted = stats['completed'] - len(write_buffer.take_failed_message_ids())
+
+            emails_inserted += page_inserted
+            if on_page_done:
+                on_page_done(page_inserted)
+
+    return emails_inserted
@@ -0,0 +1,144 @@
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import functions_framework
+import sentry_sdk
+
+from config import load_config
+from db_manager import MongoDBConnectionManager
+from batch_last_30 import sync_account
+from sync_state import acquire_sync_lease, release_sync_lease, record_sync_attempt
+
+
+def find_due_accounts(db, interval_minutes, limit):
+    """
+    Find the accounts due for a synchronization.
+    Accounts never attempted come first, then the ones attempted the longest ago.
+    Accounts are selected and sorted by the database: only the due ones are loaded.
+
+    Args:
+        db: Database connection
+        interval_minutes: Minimum number of minutes between two synchronization attempts of an account
+        limit: Maximum number of accounts returned
+
+    Returns:
+        List of account documents
+    """
+    threshold = datetime.now() - timedelta(minutes=interval_minutes)
+    pipeline = [
+        {'$lookup': {'from': 'sync_state', 'localField': 'email', 'foreignField': 'email', 'as': 'syncState'}},
+        # States written before attempts were recorded only have lastSyncAt
+        {'$addFields': {'lastAttemptAt': {'$ifNull': [
+            {'$arrayElemAt': ['$syncState.lastAttemptAt', 0]},
+            {'$arrayElemAt': ['$syncState.lastSyncAt', 0]},
+        ]}}},
+        {'$match': {'$or': [{'lastAttemptAt': None}, {'lastAttemptAt': {'$lt': threshold}}]}},
+        {'$sort': {'lastAttemptAt': 1, '_id': 1}},
+        {'$limit': limit},
+        {'$project': {'syncState': 0, 'lastAttemptAt': 0}},
+    ]
+    return list(db.accounts.aggregate(pipeline))
+
+
+def run_account_sync(db, account, config, run_id, full=False):
+    """
+    Synchronize one account under its lease and report the outcome.
+    Errors are caught so that one account cannot stop the others.
+
+    Args:
+        db: Database connection
+        account: Account document
+        config: Application configuration, with the time budget of the account
+        run_id: Identifier of the scheduler run, used as lease owner
+        full: Force a windowed backfill
+
+    Returns:
+        Dictionary describing the synchronization of the account
+    """
+    user_email = account['email']
+    result = {'email': user_email, 'status': 'skipped', 'emailsProcessed': 0, 'syncMode': None}
+    started = time.monotonic()
+
+    if not acquire_sync_lease(db, user_email, run_id, config['sync_lease_seconds']):
+        print(f"Account {user_email} is already being synchronized, skipping")
+        return result
+
+    try:
+        result.update(sync_account(db, account, config, full=full))
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        print(f"Error synchronizing {user_email}: {str(e)}")
+        result.update({'status': 'error', 'error': str(e)})
+    finally:
+        try:
+            record_sync_attempt(db, user_email)
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            print(f"Error recording the synchronization attempt of {user_email}: {str(e)}")
+        try:
+            release_sync_lease(db, user_email, run_id)
+        except Exception as e:
+            # The lease expires on its own: the outcome of the synchronization is still reported
+            sentry_sdk.capture_exception(e)
+            print(f"Error releasing the synchronization lease of {user_email}: {str(e)}")
+
+    result['duration'] = round(time.monotonic() - started, 3)
+    return result
+
+
+@functions_framework.http
+def sync_due_accounts(request):
+    """
+    Synchronize every account due for a synchronization, several at a time.
+
+    Each account runs in its own worker with a time budget, so a large mailbox
+    resumes from its checkpoint on the next run instead of holding a worker.
+    The run and the result of every account are stored in the sync_runs collection.
+
+    Args:
+        request: HTTP request, optionally holding "mode": "full" and "limit"
+
+    Returns:
+        Dict with status and run summary
+    """
+    try:
+        config = load_config()
+        data = request.get_json(silent=True) or {}
+
+        # Each account gets the same time budget: a single mailbox cannot starve the others
+        account_config = dict(config, backfill_time_budget=config['scheduler_account_time_budget'])
+        limit = int(data.get('limit', config['scheduler_max_accounts']))
+        full = data.get('mode') == 'full'
+        run_id = uuid.uuid4().hex
+
+        with MongoDBConnectionManager() as db:
+            accounts = find_due_accounts(db, config['sync_interval_minutes'], limit)
+            started_at = datetime.now()
+            print(f"Sync run {run_id}: {len(accounts)} accounts due")
+
+            with ThreadPoolExecutor(max_workers=max(1, config['scheduler_max_concurrency'])) as executor:
+                results = list(executor.map(
+                    lambda account: run_account_sync(db, account, account_config, run_id, full),
+                    accounts
+                ))
+
+            counts = {}
+            for result in results:
+                counts[result['status']] = counts.get(result['status'], 0) + 1
+
+            db.sync_runs.insert_one({
+                'runId': run_id,
+                'startedAt': started_at,
+                'finishedAt': datetime.now(),
+                'accountsDue': len(accounts),
+                'counts': counts,
+                'emailsProcessed': sum(result['emailsProcessed'] for result in results),
+                'accounts': results,
+            })
+
+            return {'status': 'success', 'run_id': run_id, 'accounts': len(accounts), 'counts': counts}
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        print(f"Error in sync_due_accounts: {str(e)}")
+        return {'status': 'error', 'message': str(e)}
@@ -0,0 +1,284 @@
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from indexes import ensure_indexes
+
+
+
+def ensure_sync_state_index(db):
+    """
+    Make sure sync_state holds one document per account, once per database and process.
+    The unique index is what keeps the upsert of acquire_sync_lease from creating a duplicate state.
+
+    Args:
+        db: Database connection
+    """
+    ensure_indexes(db, ['sync_state'])
+
+
+def get_sync_state(db, user_email):
+    """
+    Get the synchronization state of an account.
+
+    Args:
+        db: Database connection
+        user_email: Email address of the account
+
+    Returns:
+        The sync_state document of the account, or None if it was never synchronized
+    """
+    return db.sync_state.find_one({'email': user_email})
+
+
+def update_sync_state(db, user_email, fields):
+    """
+    Set fields on the synchronization state of an account, creating it if needed.
+
+    Args:
+        db: Database connection
+        user_email: Email address of the account
+        fields: Dictionary of fields to set (dotted paths allowed)
+    """
+    current_time = datetime.now()
+    db.sync_state.update_one(
+        {'email': user_email},
+        {
+            '$set': {**fields, 'updatedAt': current_time},
+            '$setOnInsert': {'createdAt': current_time},
+        },
+        upsert=True
+    )
+
+
+def get_history_id(db, user_email):
+    """
+    Get the Gmail historyId the account was last synchronized up to.
+
+    Args:
+        db: Database connection
+        user_email: Email address of the account
+
+    Returns:
+        The stored historyId, or None
+    """
+    state = get_sync_state(db, user_email)
+    return state.get('historyId') if state else None
+
+
+def save_history_id(db, user_email, history_id):
+    """
+    Store the Gmail historyId the account is synchronized up to.
+
+    Args:
+        db: Database connection
+        user_email: Email address of the account
+        history_id: Gmail historyId
+    """
+    update_sync_state(db, user_email, {'historyId': str(history_id), 'lastSyncAt': datetime.now()})
+
+
+def record_sync_attempt(db, user_email):
+    """
+    Store when the synchronization of an account was last attempted, whatever
+    its outcome. The scheduler picks accounts on it, so that failing accounts
+    wait their turn like the others.
+
+    Args:
+        db: Database connection
+        user_email: Email address of the account
+    """
+    update_sync_state(db, user_email, {'lastAttemptAt': datetime.now()})
+
+
+def get_backfill_checkpoint(db, user_email, job):
+    """
+    Get the checkpoint of an unfinished backfill.
+
+    Args:
+        db: Database connection
+        user_email: Email address of the account
+        job: Name of the backfill (e.g. 'last_30_days')
+
+    Returns:
+        The checkpoint dictionary, or None if no backfill of this kind is in progress
+    """
+    state = get_sync_state(db, user_email)
+    return state.get('backfills', {}).get(job) if state else None
+
+
+def save_backfill_checkpoint(db, user_email, job, checkpoint):
+    """
+    Store the checkpoint of a backfill in progress.
+
+    Args:
+        db: Database connection
+        user_email: Email address of the account
+        job: Name of the backfill
+        checkpoint: Dictionary describing the progress of the backfill
+    """
+    update_sync_state(db, user_email, {f'backfills.{job}': checkpoint})
+
+
+def clear_backfill_checkpoint(db, user_email, job):
+    """
+    Remove the checkpoint of a backfill, once finished or to restart it from scratch.
+
+    Args:
+        db: Database connection
+        user_email: Email address of the account
+        job: Name of the backfill
+    """
+    db.sync_state.update_one(
+        {'email': user_email},
+        {'$unset': {f'backfills.{job}': ''}, '$set': {'updatedAt': datetime.now()}}
+    )
+
+
+def acquire_sync_lease(db, user_email, owner, lease_seconds):
+    """
+    Take the synchronization lease of an account, so that a single run syncs it at a time.
+    The lease expires on its own if its owner dies without releasing it.
+
+    Args:
+        db: Database connection
+        user_email: Email address of the account
+        owner: Identifier of the run taking the lease
+        lease_seconds: Number of seconds the lease is held before it expires
+
+    Returns:
+        True if the lease was taken, False if another run holds it
+    """
+    ensure_sync_state_index(db)
+
+    now = datetime.now()
+    try:
+        state = db.sync_state.find_one_and_update(
+            {
+                'email': user_email,
+                '$or': [{'leaseUntil': {'$exists': False}}, {'leaseUntil': None}, {'leaseUntil': {'$lt': now}}],
+            },
+            {
+                '$set': {'leaseOwner': owner, 'leaseUntil': now + timedelta(seconds=lease_seconds), 'updatedAt': now},
+                '$setOnInsert': {'createdAt': now},
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # The state exists and its lease is held: the upsert tried to create a second one
+        return False
+    return state is not None and state.get('leaseOwner') == owner
+
+
+def release_sync_lease(db, user_email, owner):
+    """
+    Release the synchronization lease of an account, if still held by owner.
+
+    Args:
+        db: Database connection
+        user_email: Email address of the account
+        owner: Identifier of the run holding the lease
+    """
+    db.sync_state.update_one(
+        {'email': user_email, 'leaseOwner': owner},
+        {'$set': {'leaseUntil': None, 'updatedAt': datetime.now()}, '$unset': {'leaseOwner': ''}}
+    )
+
+
+class MessageFailures:
+    """
+    Failures of the messages of an account that a synchronization could not store.
+
+    Every failing message is recorded in the message_failures collection with
+    its number of failed attempts. A message is lost, and retried by the next
+    synchronization, until it has failed max_attempts times; it is then given
+    up, and skipped by later synchronizations, so that one message failing on
+    every attempt does not hold the historyId of its account back forever.
+    """
+    def __init__(self, db, user_email, max_attempts=3):
+        """
+        Args:
+            db: Database connection
+            user_email: Email address of the account
+            max_attempts: Number of failed attempts after which a message is given up
+        """
+        self.db = db
+        self.user_email = user_email
+        self.max_attempts = max_attempts
+        self.lost = 0
+        self._lock = threading.Lock()
+
+    def without_given_up(self, message_ids):
+        """
+        Drop the messages given up by earlier attempts.
+
+        Args:
+            message_ids: List of Gmail message IDs
+
+        Returns:
+            List of the message IDs still worth fetching, in their original order
+        """
+        if not message_ids:
+            return []
+        ensure_indexes(self.db, ['message_failures'])
+        given_up = {
+            failure['messageId']
+            for failure in self.db.message_failures.find(
+                {'email': self.user_email, 'messageId': {'$in': list(message_ids)}, 'attempts': {'$gte': self.max_attempts}},
+                {'_id': 0, 'messageId': 1}
+            )
+        }
+        return [message_id for message_id in message_ids if message_id not in given_up]
+
+    def record(self, message_ids, error, permanent=False):
+        """
+        Record a failed attempt for messages.
+
+        Args:
+            message_ids: Iterable of Gmail message IDs
+            error: Exception or description of the failure
+            permanent: The failure cannot go away on retry: give the messages up at once
+
+        Returns:
+            Number of messages lost, that is still to be retried
+        """
+        ensure_indexes(self.db, ['message_failures'])
+        now = datetime.now()
+        lost = 0
+        for message_id in message_ids:
+            update = {'$set': {'error': str(error)[:500], 'updatedAt': now}, '$setOnInsert': {'createdAt': now}}
+            if permanent:
+                update['$set']['attempts'] = self.max_attempts
+            else:
+                update['$inc'] = {'attempts': 1}
+            failure = self.db.message_failures.find_one_and_update(
+                {'email': self.user_email, 'messageId': message_id},
+                update,
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            if failure['attempts'] < self.max_attempts:
+                lost += 1
+            else:
+                print(f"Giving up on message {message_id} after {failure['attempts']} failed attempts: {error}")
+
+        with self._lock:
+            self.lost += lost
+        return lost
+
+    @contextmanager
+    def recording(self, message_id):
+        """
+        Record a failed attempt for a message if the block raises, and re-raise.
+
+        Args:
+            message_id: Gmail message ID
+        """
+        try:
+            yield
+        except Exception as e:
+            self.record([message_id], e)
+            raise
@@ -0,0 +1,36 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from attachments import get_attachment_data, evict_cache
+
+class TestGetAttachmentData(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.attachment = {'filename': 'invite.ics', 'mimeType': 'text/calendar', 'size': 4, 'attachment_id': 'att-1'}
+
+    def test_second_retrieval_is_served_from_cache(self):
+        with mock.patch('attachments.execute_gmail', return_value={'data': 'QUJD'}) as execute:
+            first = get_attachment_data(mock.Mock(), 'user@example.com', 'msg-1', self.attachment, cache_dir=self.cache_dir)
+            second = get_attachment_data(mock.Mock(), 'user@example.com', 'msg-1', self.attachment, cache_dir=self.cache_dir)
+        self.assertEqual(first, 'QUJD')
+        self.assertEqual(second, 'QUJD')
+        self.assertEqual(execute.call_count, 1)
+
+    def test_inline_data_is_returned_without_api_call(self):
+        with mock.patch('attachments.execute_gmail') as execute:
+            data = get_attachment_data(mock.Mock(), 'user@example.com', 'msg-1', {**self.attachment, 'data': 'REVG'}, cache_dir=self.cache_dir)
+        self.assertEqual(data, 'REVG')
+        execute.assert_not_called()
+
+    def test_oldest_entries_are_evicted(self):
+        for index, name in enumerate(['old', 'new']):
+            path = os.path.join(self.cache_dir, name)
+            with open(path, 'w') as f:
+                f.write('x' * 10)
+            os.utime(path, (index, index))
+        evict_cache(self.cache_dir, 15)
+        self.assertEqual(os.listdir(self.cache_dir), ['new'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import base64
+import tempfile
+import unittest
+from unittest import mock
+from pymongo.errors import DuplicateKeyError
+from blob_store import GridFSBlobStore, LocalBlobStore, iter_base64_chunks
+
+class TestBase64Chunks(unittest.TestCase):
+    def test_chunks_decode_to_the_original_content(self):
+        content = bytes(range(256)) * 50
+        data = base64.urlsafe_b64encode(content).decode('ascii')
+        chunks = list(iter_base64_chunks(data, chunk_size=1000))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b''.join(chunks), content)
+
+class TestLocalBlobStore(unittest.TestCase):
+    def test_identical_contents_are_stored_once(self):
+        store = LocalBlobStore(tempfile.mkdtemp(), chunk_size=4)
+        first = store.put_stream([b'same ', b'logo'])
+        second = store.put_stream([b'same logo'])
+        self.assertEqual(first, second)
+        self.assertEqual(first['size'], 9)
+        self.assertTrue(store.exists(first['sha256']))
+        self.assertEqual(b''.join(store.iter_chunks(first['sha256'])), b'same logo')
+
+class TestGridFSBlobStore(unittest.TestCase):
+    def test_concurrently_stored_content_drops_the_upload(self):
+        db = mock.MagicMock()
+        with mock.patch('blob_store.GridFSBucket') as bucket_class, mock.patch('blob_store.ensure_indexes'):
+            store = GridFSBlobStore(db)
+        bucket = bucket_class.return_value
+        store.files.find_one.return_value = None
+        # Another upload of the same content was renamed between exists() and rename()
+        bucket.rename.side_effect = DuplicateKeyError('E11000 duplicate key')
+
+        ref = store.put_stream([b'same logo'])
+
+        upload = bucket.open_upload_stream.return_value
+        bucket.delete.assert_called_once_with(upload._id)
+        self.assertEqual(ref['size'], 9)
+
+if __name__ == '__main__':
+    unittest.main()
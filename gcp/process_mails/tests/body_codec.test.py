@@ -0,0 +1,20 @@
+import unittest
+from body_codec import encode_body_fields, decode_body_fields
+
+class TestBodyCodec(unittest.TestCase):
+    def test_large_fields_round_trip(self):
+        email = {'messageId': 'm1', 'html': '<p>Newsletter</p>' * 2000, 'text': 'short'}
+        encoded = encode_body_fields(email, 'zlib', threshold=1024)
+        self.assertEqual(encoded['bodyEncoding'], {'html': 'zlib'})
+        self.assertIsInstance(encoded['html'], bytes)
+        self.assertLess(len(encoded['html']), len(email['html']))
+        self.assertEqual(encoded['text'], 'short')
+        self.assertEqual(decode_body_fields(encoded), email)
+
+    def test_disabled_codec_leaves_email_untouched(self):
+        email = {'messageId': 'm1', 'html': 'x' * 100000}
+        self.assertIs(encode_body_fields(email, None), email)
+        self.assertIs(decode_body_fields(email), email)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -44,7 +44,21 @@ class TestParseMistralResponse(unittest.TestCase):
         expected_output = {"category": "Work-Related", "text": result, "summary": "Email notifies Charlie Apcher that they passed the interview for a Software Engineer position at Melify, and the next step is a technical interview."}
         self.assertEqual(parse_mistral_response(result), expected_output)
         
-        # Test case where the category is exactly 'Promotions'
+        # Test case where the category is exactly 'Notifications/Promotions'
+        result = '''
+        {
+            "category": "Notifications/Promotions",
+            "summary": "Email notifies Charlie Apcher that they passed the interview for a Software Engineer position at Melify, and the next step is a technical interview."
+        }
+        '''
+        expected_output = {
+            "category": "Notifications/Promotions",
+            "text": result,
+            "summary": "Email notifies Charlie Apcher that they passed the interview for a Software Engineer position at Melify, and the next step is a technical interview."
+        }
+        self.assertEqual(parse_mistral_response(result), expected_output)
+
+        # Test case where the category is only part of a category name: 'Promotions'
         result = '''
         {
             "category": "Promotions",
@@ -58,7 +72,7 @@ class TestParseMistralResponse(unittest.TestCase):
         }
         self.assertEqual(parse_mistral_response(result), expected_output)
         
-       # Test case where the category is exactly 'Promotions'
+        # Test case where the category is missing
         result = '''
         {
             "summary": "Email notifies Charlie Apcher that they passed the interview for a Software Engineer position at Melify, and the next step is a technical interview."
@@ -0,0 +1,44 @@
+import unittest
+from email_schema import compact_payload, to_stored_email, EMAIL_SCHEMA_VERSION
+
+PAYLOAD = {
+    'partId': '',
+    'mimeType': 'multipart/mixed',
+    'filename': '',
+    'headers': [{'name': 'Subject', 'value': 'Invoice'}],
+    'body': {'size': 0},
+    'parts': [
+        {
+            'partId': '0',
+            'mimeType': 'text/html',
+            'filename': '',
+            'headers': [{'name': 'Content-Type', 'value': 'text/html'}],
+            'body': {'size': 12, 'data': 'PGI-aGk8L2I-'},
+        },
+        {
+            'partId': '1',
+            'mimeType': 'application/pdf',
+            'filename': 'invoice.pdf',
+            'headers': [],
+            'body': {'size': 2048, 'attachmentId': 'att-1'},
+        },
+    ],
+}
+
+class TestCompactPayload(unittest.TestCase):
+    def test_bodies_and_part_headers_are_dropped(self):
+        compact = compact_payload(PAYLOAD)
+        self.assertEqual(compact['headers'], PAYLOAD['headers'])
+        self.assertEqual(compact['parts'][0], {'partId': '0', 'mimeType': 'text/html', 'filename': '', 'body': {'size': 12}})
+        self.assertEqual(compact['parts'][1]['body'], {'size': 2048, 'attachmentId': 'att-1'})
+
+    def test_stored_email_is_tagged_with_its_version(self):
+        email = to_stored_email({'messageId': 'm1', 'payload': PAYLOAD})
+        self.assertEqual(email['schemaVersion'], EMAIL_SCHEMA_VERSION)
+        self.assertNotIn('data', email['payload']['parts'][0]['body'])
+
+        legacy = to_stored_email({'messageId': 'm1', 'payload': PAYLOAD}, version=1)
+        self.assertEqual(legacy['payload'], PAYLOAD)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+from unittest import mock
+from pymongo.errors import BulkWriteError, AutoReconnect
+import email_store
+from email_store import WriteBuffer
+
+class TestWriteBuffer(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(email_store, 'ensure_indexes')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db = mock.MagicMock()
+        self.buffer = WriteBuffer(self.db, max_size=100, max_delay=60, schema_version=1)
+
+    def test_failed_inserts_are_reported(self):
+        self.db.emails.bulk_write.side_effect = BulkWriteError({'writeErrors': [
+            {'index': 1, 'code': 2, 'errmsg': 'document too large'},
+            # Stored meanwhile by a concurrent sync
+            {'index': 2, 'code': 11000, 'errmsg': 'duplicate key'},
+        ]})
+        for message_id in ('a', 'b', 'c'):
+            self.buffer.add_email({'messageId': message_id})
+        with mock.patch.object(email_store, 'sentry_sdk'):
+            self.buffer.flush()
+
+        self.assertEqual(self.buffer.take_failed_message_ids(), ['b'])
+        self.assertEqual(self.buffer.take_failed_message_ids(), [])
+        self.assertEqual(self.buffer.flushed_emails, 2)
+
+    def test_failed_flush_keeps_the_operations(self):
+        self.db.emails.bulk_write.side_effect = [AutoReconnect('connection reset'), None]
+        self.buffer.add_email({'messageId': 'a'})
+        with self.assertRaises(AutoReconnect):
+            self.buffer.flush()
+
+        self.buffer.flush()
+        operations = self.db.emails.bulk_write.call_args[0][0]
+        self.assertEqual([operation._filter for operation in operations], [{'messageId': 'a'}])
+        self.assertEqual(self.buffer.flushed_emails, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+from unittest import mock
+from gmail_quota import TokenBucket, GmailQuotaScheduler, QUOTA_UNITS
+
+class TestTokenBucket(unittest.TestCase):
+    def test_requests_within_capacity_do_not_wait(self):
+        bucket = TokenBucket(rate=250)
+        self.assertEqual(bucket.reserve(100), 0)
+        self.assertEqual(bucket.reserve(150), 0)
+
+    def test_requests_over_capacity_wait_for_refill(self):
+        with mock.patch('gmail_quota.time.monotonic', return_value=100.0):
+            bucket = TokenBucket(rate=250)
+            # A batch of 100 messages.get costs 500 units: one second of debt
+            self.assertAlmostEqual(bucket.reserve(500), 1.0)
+            self.assertAlmostEqual(bucket.reserve(250), 2.0)
+
+    def test_pause_holds_requests(self):
+        with mock.patch('gmail_quota.time.monotonic', return_value=100.0):
+            bucket = TokenBucket(rate=250)
+            bucket.pause(4)
+            self.assertAlmostEqual(bucket.reserve(1), 4.0)
+
+class TestGmailQuotaScheduler(unittest.TestCase):
+    def test_users_have_separate_buckets(self):
+        scheduler = GmailQuotaScheduler(user_units_per_second=10)
+        with mock.patch('gmail_quota.time.sleep') as sleep:
+            scheduler.acquire('messages.get', 'a@example.com', count=2)
+            scheduler.acquire('messages.get', 'b@example.com', count=2)
+            sleep.assert_not_called()
+            scheduler.acquire('messages.get', 'a@example.com')
+            sleep.assert_called_once()
+            self.assertAlmostEqual(sleep.call_args[0][0], QUOTA_UNITS['messages.get'] / 10, places=2)
+
+if __name__ == '__main__':
+    unittest.main()
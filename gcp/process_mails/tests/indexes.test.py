@@ -0,0 +1,59 @@
+import unittest
+from unittest import mock
+from pymongo.errors import OperationFailure
+from indexes import plan_stages, verify_query_plans, ensure_collection_indexes, QueryPlanError
+
+class TestPlanStages(unittest.TestCase):
+    def test_nested_stages(self):
+        plan = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': 'messageId_1'}}
+        self.assertEqual(plan_stages(plan), ['FETCH', 'IXSCAN'])
+
+    def test_or_stages(self):
+        plan = {'stage': 'SUBPLAN', 'inputStage': {'stage': 'OR', 'inputStages': [{'stage': 'IXSCAN'}, {'stage': 'COLLSCAN'}]}}
+        self.assertIn('COLLSCAN', plan_stages(plan))
+
+    def test_slot_based_plan(self):
+        plan = {'queryPlan': {'stage': 'PROJECTION_SIMPLE', 'inputStage': {'stage': 'COLLSCAN'}}, 'slotBasedPlan': {}}
+        self.assertEqual(plan_stages(plan), ['PROJECTION_SIMPLE', 'COLLSCAN'])
+
+class TestVerifyQueryPlans(unittest.TestCase):
+    def explaining(self, winning_plan):
+        db = mock.MagicMock()
+        db.__getitem__.return_value.find.return_value.explain.return_value = {'queryPlanner': {'winningPlan': winning_plan}}
+        return db
+
+    def test_index_scans_pass(self):
+        db = self.explaining({'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}})
+        plans = verify_query_plans(db, [('thread state', 'threads', {'threadId': 'a'}, None)])
+        self.assertEqual(plans['thread state'], ['FETCH', 'IXSCAN'])
+
+    def test_collection_scan_fails(self):
+        db = self.explaining({'stage': 'COLLSCAN'})
+        with self.assertRaises(QueryPlanError):
+            verify_query_plans(db, [('thread state', 'threads', {'threadId': 'a'}, None)])
+
+class TestEnsureCollectionIndexes(unittest.TestCase):
+    def test_duplicates_fall_back_to_plain_index(self):
+        db = mock.MagicMock()
+        collection = db.__getitem__.return_value
+        collection.create_index.side_effect = [OperationFailure('duplicate key', code=11000), 'threadId_nonunique_1']
+        with mock.patch('indexes.sentry_sdk'):
+            self.assertEqual(ensure_collection_indexes(db, 'threads'), ['threadId_nonunique_1'])
+
+    def test_plain_index_is_replaced_by_the_unique_index(self):
+        db = mock.MagicMock()
+        collection = db.__getitem__.return_value
+        collection.index_information.return_value = {'_id_': {}, 'messageId_1': {'key': [('messageId', 1)]}}
+        collection.create_index.side_effect = ['messageId_unique_1', 'threadId_1']
+        self.assertEqual(ensure_collection_indexes(db, 'emails'), ['messageId_unique_1', 'threadId_1'])
+        collection.drop_index.assert_called_once_with('messageId_1')
+        collection.create_index.assert_any_call([('messageId', 1)], name='messageId_unique_1', unique=True)
+
+    def test_required_unique_index_raises(self):
+        db = mock.MagicMock()
+        db.__getitem__.return_value.create_index.side_effect = OperationFailure('duplicate key', code=11000)
+        with self.assertRaises(OperationFailure):
+            ensure_collection_indexes(db, 'sync_state')
+
+if __name__ == '__main__':
+    unittest.main()
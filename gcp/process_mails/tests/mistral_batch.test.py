@@ -0,0 +1,69 @@
+import unittest
+from unittest import mock
+import mistral_batch
+from mistral_batch import write_back_results, collect_batch_jobs, UNCOLLECTABLE_STATUS
+
+RESULT = {'category': 'Work', 'summary': 'Old summary', 'text': '{}'}
+
+class TestWriteBackResults(unittest.TestCase):
+    def setUp(self):
+        self.db = mock.MagicMock()
+        self.db.emails.find.return_value = [
+            {'messageId': 'old', 'threadId': 'thread-1', 'date': '2024-01-01T00:00:00+00:00'},
+        ]
+
+    def thread_operations(self):
+        self.db.threads.bulk_write.assert_called_once()
+        return self.db.threads.bulk_write.call_args[0][0]
+
+    def test_latest_email_summarizes_the_thread(self):
+        self.db.emails.aggregate.return_value = [{'_id': 'thread-1', 'date': '2023-12-01T00:00:00+00:00'}]
+        write_back_results(self.db, {'old': RESULT}, ['Work'])
+        operations = self.thread_operations()
+        self.assertEqual(operations[0]._doc['$set']['summary'], 'Old summary')
+
+    def test_newer_summarized_email_keeps_the_thread_summary(self):
+        # A delta sync summarized a newer email of the thread meanwhile
+        self.db.emails.aggregate.return_value = [{'_id': 'thread-1', 'date': '2024-02-01T00:00:00+00:00'}]
+        write_back_results(self.db, {'old': RESULT}, ['Work'])
+        self.db.threads.bulk_write.assert_not_called()
+        self.db.emails.bulk_write.assert_called_once()
+
+class TestCollectBatchJobs(unittest.TestCase):
+    def setUp(self):
+        self.db = mock.MagicMock()
+        self.client = mock.MagicMock()
+        self.client.batch.jobs.get.side_effect = Exception('job not found')
+        patcher = mock.patch.object(mistral_batch, 'get_batch_client', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(mistral_batch, 'sentry_sdk')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def collect(self, attempts):
+        self.db.mistral_batch_jobs.find.return_value.sort.return_value = [
+            {'_id': 1, 'jobId': 'job-1', 'messageIds': ['a'], 'categories': None, 'collectAttempts': attempts},
+        ]
+        with mock.patch.object(mistral_batch, 'write_back_results', return_value=1) as write_back:
+            updated = collect_batch_jobs(self.db, 'user@example.com', 'key', max_attempts=3)
+        return updated, write_back
+
+    def test_failed_collection_is_counted(self):
+        updated, write_back = self.collect(attempts=0)
+        self.assertEqual(updated, 0)
+        write_back.assert_not_called()
+        update = self.db.mistral_batch_jobs.update_one.call_args[0][1]['$set']
+        self.assertEqual(update['collectAttempts'], 1)
+        self.assertNotIn('collectedAt', update)
+
+    def test_job_is_given_up_after_max_attempts(self):
+        updated, write_back = self.collect(attempts=2)
+        self.assertEqual(updated, 1)
+        self.assertEqual(list(write_back.call_args[0][1]), ['a'])
+        update = self.db.mistral_batch_jobs.update_one.call_args[0][1]['$set']
+        self.assertEqual(update['status'], UNCOLLECTABLE_STATUS)
+        self.assertIn('collectedAt', update)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import threading
+import time
+import unittest
+from pipeline import Pipeline, Stage
+
+class TestPipeline(unittest.TestCase):
+    def test_items_flow_through_every_stage(self):
+        results = []
+        lock = threading.Lock()
+
+        def store(item):
+            with lock:
+                results.append(item)
+            return item
+
+        pipeline = Pipeline([
+            Stage('split', lambda chunk: chunk, expand=True),
+            Stage('double', lambda item: item * 2, workers=4),
+            Stage('store', store, workers=2),
+        ], queue_size=1)
+        stats = pipeline.run([[1, 2, 3], [4, 5]])
+
+        self.assertEqual(stats['completed'], 5)
+        self.assertEqual(sorted(results), [2, 4, 6, 8, 10])
+        self.assertEqual(stats['stages']['split']['processed'], 2)
+        self.assertEqual(stats['stages']['double']['processed'], 5)
+
+    def test_dropped_and_failed_items_are_counted(self):
+        def handler(item):
+            if item == 0:
+                raise ValueError("boom")
+            return item if item % 2 else None
+
+        stats = Pipeline([Stage('filter', handler, workers=3)]).run(range(6))
+
+        self.assertEqual(stats['completed'], 3)
+        self.assertEqual(stats['stages']['filter']['failed'], 1)
+        self.assertEqual(stats['stages']['filter']['dropped'], 2)
+
+    def test_workers_of_a_stage_run_concurrently(self):
+        # Both items must be in the handler at the same time for the barrier to pass
+        barrier = threading.Barrier(2, timeout=5)
+
+        def handler(item):
+            barrier.wait()
+            return item
+
+        stats = Pipeline([Stage('wait', handler, workers=2)]).run([1, 2])
+        self.assertEqual(stats['completed'], 2)
+
+    def run_limited(self, stage_factory):
+        # Without the limiter, the sleeping workers would overlap
+        limiter = threading.Semaphore(1)
+        active = {'current': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def work():
+            with lock:
+                active['current'] += 1
+                active['max'] = max(active['max'], active['current'])
+            time.sleep(0.01)
+            with lock:
+                active['current'] -= 1
+
+        stats = Pipeline([stage_factory(work, limiter)]).run(range(8))
+        return stats, active['max']
+
+    def test_limiter_caps_concurrent_calls(self):
+        def stage(work, limiter):
+            def handler(item):
+                work()
+                return item
+            return Stage('limited', handler, workers=4, limiter=limiter)
+
+        stats, max_active = self.run_limited(stage)
+        self.assertEqual(stats['completed'], 8)
+        self.assertEqual(max_active, 1)
+
+    def test_limiter_caps_expand_iteration(self):
+        def stage(work, limiter):
+            def handler(item):
+                for output in range(2):
+                    work()
+                    yield output
+            return Stage('limited', handler, workers=4, limiter=limiter, expand=True)
+
+        stats, max_active = self.run_limited(stage)
+        self.assertEqual(stats['completed'], 16)
+        self.assertEqual(max_active, 1)
+
+    def test_source_errors_are_raised_after_draining(self):
+        def source():
+            yield 1
+            raise RuntimeError("listing failed")
+
+        with self.assertRaises(RuntimeError):
+            Pipeline([Stage('noop', lambda item: item)]).run(source())
+
+if __name__ == '__main__':
+    unittest.main()
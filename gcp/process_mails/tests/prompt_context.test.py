@@ -0,0 +1,43 @@
+import unittest
+from prompt_context import PromptContext, get_prompt_context, categories_prompt_context, default_prompt_context
+
+PROFILE_TYPE = {
+    '_id': 'profile-1',
+    'updatedAt': 1,
+    'categories': [
+        {'name': 'Work', 'description': 'Job related', 'disable': False},
+        {'name': 'Games', 'disable': True},
+        {'name': 'Legal and Administrative', 'disable': False},
+    ],
+}
+
+class TestPromptContext(unittest.TestCase):
+    def test_match_follows_category_order(self):
+        context = PromptContext.build('', ['Work', 'Travel'])
+        self.assertEqual(context.match('Travel for work'), 'Work')
+        self.assertEqual(context.match('TRAVEL.'), 'Travel')
+        self.assertIsNone(context.match('Workshop'))
+
+    def test_match_part_of_a_category(self):
+        context = PromptContext.build('', ['Personal', 'Notifications/Promotions'])
+        self.assertEqual(context.match('Promotions'), 'Notifications/Promotions')
+        self.assertEqual(context.match('Personal notifications'), 'Personal')
+        self.assertIsNone(context.match('Promo'))
+
+    def test_profile_type_context(self):
+        context = get_prompt_context(PROFILE_TYPE)
+        self.assertEqual(context.categories, ('Work', 'Legal and Administrative'))
+        self.assertEqual(context.prompt_categories, "\nWork: Job related\nLegal and Administrative: \n")
+
+    def test_memoized_by_profile_type_version(self):
+        self.assertIs(get_prompt_context(dict(PROFILE_TYPE)), get_prompt_context(dict(PROFILE_TYPE)))
+        updated = dict(PROFILE_TYPE, updatedAt=2, categories=PROFILE_TYPE['categories'][:1])
+        self.assertEqual(get_prompt_context(updated).categories, ('Work',))
+
+    def test_contexts_are_immutable(self):
+        with self.assertRaises(AttributeError):
+            default_prompt_context().categories = ()
+        self.assertIs(categories_prompt_context(['Other']), categories_prompt_context(['Other']))
+
+if __name__ == '__main__':
+    unittest.main()
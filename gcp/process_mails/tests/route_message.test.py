@@ -0,0 +1,31 @@
+import unittest
+from email_processor import route_message, ROUTE_SKIP, ROUTE_METADATA, ROUTE_FULL
+
+def metadata_message(labels, mime_type='multipart/alternative', subject='Newsletter'):
+    # As returned with METADATA_FIELDS: no parts, only the top-level mimeType and headers
+    return {
+        'labelIds': labels,
+        'payload': {
+            'mimeType': mime_type,
+            'headers': [{'name': 'Subject', 'value': subject}, {'name': 'Content-Type', 'value': mime_type}],
+        },
+    }
+
+class TestRouteMessage(unittest.TestCase):
+    def route(self, message):
+        return route_message(message, skip_labels=['SPAM'], metadata_only_labels=['CATEGORY_PROMOTIONS'])
+
+    def test_skip_labels(self):
+        self.assertEqual(self.route(metadata_message(['SPAM', 'CATEGORY_PROMOTIONS'])), ROUTE_SKIP)
+
+    def test_metadata_only_labels(self):
+        self.assertEqual(self.route(metadata_message(['CATEGORY_PROMOTIONS'])), ROUTE_METADATA)
+
+    def test_multipart_mixed_may_hold_an_ics_part(self):
+        self.assertEqual(self.route(metadata_message(['CATEGORY_PROMOTIONS'], mime_type='multipart/mixed')), ROUTE_FULL)
+
+    def test_invitation_subject(self):
+        self.assertEqual(self.route(metadata_message(['CATEGORY_PROMOTIONS'], subject='Invitation: Standup')), ROUTE_FULL)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+from unittest import mock
+import batch_last_30
+import sync_state
+from sync_state import MessageFailures
+
+class TestSyncEmails(unittest.TestCase):
+    def sync(self, emails_lost):
+        with mock.patch.multiple(
+            batch_last_30,
+            get_backfill_checkpoint=mock.Mock(return_value=None),
+            get_history_id=mock.Mock(return_value='100'),
+            sync_new_emails=mock.Mock(return_value=(3, '200', emails_lost)),
+            save_history_id=mock.DEFAULT,
+        ) as mocks:
+            result = batch_last_30.sync_emails(None, 'user@example.com', None, {}, {})
+        return result, mocks['save_history_id']
+
+    def test_delta_advances_history(self):
+        result, save_history_id = self.sync(emails_lost=0)
+        self.assertEqual(result, (3, 'delta'))
+        save_history_id.assert_called_once_with(None, 'user@example.com', '200')
+
+    def test_lost_emails_keep_previous_history(self):
+        result, save_history_id = self.sync(emails_lost=1)
+        self.assertEqual(result, (3, 'delta'))
+        save_history_id.assert_not_called()
+
+class TestMessageFailures(unittest.TestCase):
+    def failures(self, attempts):
+        db = mock.MagicMock()
+        db.message_failures.find_one_and_update.return_value = {'messageId': 'a', 'attempts': attempts}
+        return db, MessageFailures(db, 'user@example.com', max_attempts=3)
+
+    def test_failing_message_is_lost_until_given_up(self):
+        with mock.patch.object(sync_state, 'ensure_indexes'):
+            _, failures = self.failures(attempts=2)
+            self.assertEqual(failures.record(['a'], 'Mistral timeout'), 1)
+            _, given_up = self.failures(attempts=3)
+            self.assertEqual(given_up.record(['a'], 'Mistral timeout'), 0)
+        self.assertEqual((failures.lost, given_up.lost), (1, 0))
+
+    def test_permanent_failure_is_given_up_at_once(self):
+        with mock.patch.object(sync_state, 'ensure_indexes'):
+            db, failures = self.failures(attempts=3)
+            failures.record(['a'], 'Invalid id', permanent=True)
+        update = db.message_failures.find_one_and_update.call_args[0][1]
+        self.assertEqual(update['$set']['attempts'], 3)
+        self.assertNotIn('$inc', update)
+
+    def test_given_up_messages_are_skipped(self):
+        with mock.patch.object(sync_state, 'ensure_indexes'):
+            db, failures = self.failures(attempts=3)
+            db.message_failures.find.return_value = [{'messageId': 'b'}]
+            self.assertEqual(failures.without_given_up(['a', 'b', 'c']), ['a', 'c'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+from unittest import mock
+import sync_scheduler
+
+class TestRunAccountSync(unittest.TestCase):
+    def test_failed_sync_records_attempt(self):
+        with mock.patch.multiple(
+            sync_scheduler,
+            acquire_sync_lease=mock.Mock(return_value=True),
+            release_sync_lease=mock.DEFAULT,
+            record_sync_attempt=mock.DEFAULT,
+            sync_account=mock.Mock(side_effect=RuntimeError("no tokens")),
+            sentry_sdk=mock.DEFAULT,
+        ) as mocks:
+            result = sync_scheduler.run_account_sync(None, {'email': 'user@example.com'}, {'sync_lease_seconds': 60}, 'run')
+
+        self.assertEqual(result['status'], 'error')
+        mocks['record_sync_attempt'].assert_called_once_with(None, 'user@example.com')
+        mocks['release_sync_lease'].assert_called_once_with(None, 'user@example.com', 'run')
+
+    def test_lease_release_error_keeps_the_result(self):
+        with mock.patch.multiple(
+            sync_scheduler,
+            acquire_sync_lease=mock.Mock(return_value=True),
+            release_sync_lease=mock.Mock(side_effect=RuntimeError("connection reset")),
+            record_sync_attempt=mock.DEFAULT,
+            sync_account=mock.Mock(return_value={'status': 'success', 'emailsProcessed': 2, 'syncMode': 'delta'}),
+            sentry_sdk=mock.DEFAULT,
+        ):
+            result = sync_scheduler.run_account_sync(None, {'email': 'user@example.com'}, {'sync_lease_seconds': 60}, 'run')
+
+        self.assertEqual(result['status'], 'success')
+        self.assertEqual(result['emailsProcessed'], 2)
+
+class TestFindDueAccounts(unittest.TestCase):
+    def test_selection_runs_in_the_database(self):
+        db = mock.MagicMock()
+        db.accounts.aggregate.return_value = iter([{'email': 'user@example.com'}])
+        accounts = sync_scheduler.find_due_accounts(db, 15, 10)
+
+        self.assertEqual(accounts, [{'email': 'user@example.com'}])
+        pipeline = db.accounts.aggregate.call_args[0][0]
+        self.assertEqual(pipeline[-2], {'$limit': 10})
+        self.assertIn({'$sort': {'lastAttemptAt': 1, '_id': 1}}, pipeline)
+        db.sync_state.find.assert_not_called()
+
+if __name__ == '__main__':
+    unittest.main()
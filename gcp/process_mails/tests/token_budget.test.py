@@ -0,0 +1,64 @@
+import unittest
+import token_budget
+from token_budget import estimate_tokens, count_tokens, truncate_tokens, budget_prompt, ESTIMATE_ERROR
+
+# Email text in several languages and formats the token estimate is checked against
+CORPUS = [
+    "日本語のメールです。明日の会議は午後3時からです。資料は共有フォルダにあります。",
+    "Привет! Завтра встреча в 10:00, не забудь ноутбук и отчёт за квартал.",
+    "Hi Marie, thanks for sending the slides over. I had a quick look and they look great overall. Could you move the pricing table to the appendix and add a short summary of the Q3 numbers on slide 4? Let's sync tomorrow at 10am if that works for you. Best, Tom",
+    "Your order #112-4589321-7765012 has shipped! Estimated delivery: Thursday, March 14. Items: 2 x USB-C cable (2m), 1 x Wireless charger 15W. Track your package on our website. Questions? Reply to this email or call 1-800-555-0199.",
+    "Bonjour Julien, je te confirme notre rendez-vous de jeudi à 14h30 dans nos locaux, 12 rue de la République. Pense à apporter le devis signé et l'attestation d'assurance. N'hésite pas à m'appeler si tu as un empêchement. Bonne journée, Élodie",
+    "Hallo Frau Schmidt, anbei erhalten Sie die Rechnung für den Monat Februar. Bitte überweisen Sie den Betrag von 1.249,00 EUR bis zum 15. März auf das angegebene Konto. Mit freundlichen Grüßen, Ihr Kundenservice",
+    "Hola Carlos, ¿podrías revisar el contrato antes del viernes? Hay algunas cláusulas sobre la confidencialidad que no me quedan claras. Gracias de antemano y un saludo.",
+    "Meeting notes - Project Atlas kickoff. Attendees: Sarah, Ben, Priya, Lucas. Decisions: 1) launch date moved to June 3; 2) budget approved at $48,500; 3) Priya owns the vendor shortlist. Action items: Ben to send the RACI matrix by Friday, Lucas to book the workshop room for the week of April 8.",
+    "Your verification code is 482913. It expires in 10 minutes. If you did not request this code, you can safely ignore this email. Someone else might have typed your email address by mistake.",
+    "Weekly digest: 5 new comments on your pull request 'Refactor the ingestion pipeline to use bounded queues'. @devon: LGTM once the retries are capped. @mia: can we add a test for the backoff path? @ci-bot: Build #2291 passed in 4m 12s.",
+    "Dear customer, we are writing to inform you about changes to our Terms of Service, effective from 1 May 2024. The main changes concern data retention periods, the handling of disputed transactions, and the way we notify you about account activity. You can read the full terms in your account settings. No action is needed on your part.",
+    "Re: Re: Fwd: apartment viewing > Sure, Saturday 11am works. > > Is the flat still available? I'd love to see it this weekend. > > > The 2-bedroom on Baker Street is listed at £1,650 pcm, bills excluded, available from 1 July.",
+    "Ciao Luca, ti mando in allegato il preventivo aggiornato con le modifiche che abbiamo discusso al telefono. Fammi sapere se va bene così, altrimenti possiamo sentirci lunedì mattina. A presto, Giulia",
+    "Invoice INV-2024-00317 | Amount due: 3,120.00 USD | Due date: 2024-04-30 | Payment terms: Net 30 | Reference: PO-77812 | Bank: IBAN DE89 3704 0044 0532 0130 00, BIC COBADEFFXXX",
+    "Reminder: your subscription to Cloud Storage Pro (2 TB) renews on 12/05/2024 for $9.99/month. To change your plan or cancel, visit Settings > Billing before the renewal date.",
+    "Olá Ana, obrigado pelo convite! Infelizmente não poderei participar da reunião de quarta-feira, mas a Beatriz vai me representar. Envio os comentários sobre o relatório até amanhã. Abraços, Pedro",
+    "Hey team - quick heads up: the staging database will be down for maintenance tonight between 11pm and 1am UTC. Deploys are frozen during that window. Ping #infra if anything looks off afterwards.",
+    "Thank you for applying to the Senior Data Engineer position. We have reviewed your application and would like to invite you to a 45-minute technical interview with our team. Please pick a slot that suits you from the calendar link in your candidate portal.",
+]
+
+class TestTokenEstimate(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The estimate is calibrated against the tokenizer of the model the prompts are sent to:
+        # a tiktoken fallback would check it against another tokenizer
+        if not isinstance(token_budget.get_tokenizer(), token_budget._MistralEncoder):
+            raise AssertionError("mistral_common is required to check the token estimate (see requirements.txt)")
+        cls.actual_tokens = [count_tokens(text) for text in CORPUS]
+
+    def test_estimate_error_bound(self):
+        errors = []
+        for text, actual in zip(CORPUS, self.actual_tokens):
+            estimate = estimate_tokens(text)
+            # Skipping encoding is only safe if the estimate never under-estimates by more than the bound
+            self.assertLessEqual(actual, estimate * (1 + ESTIMATE_ERROR), text)
+            errors.append(abs(estimate - actual) / actual)
+        self.assertLess(sum(errors) / len(errors), 0.2)
+
+class TestTokenBudget(unittest.TestCase):
+    def test_truncate_encodes_long_texts_only(self):
+        short = CORPUS[0]
+        self.assertEqual(truncate_tokens(short, 5000)[0], short)
+
+        long_text = " ".join(CORPUS) * 20
+        truncated, tokens = truncate_tokens(long_text, 500)
+        self.assertEqual(tokens, 500)
+        self.assertLessEqual(count_tokens(truncated), 510)
+        self.assertTrue(long_text.startswith(truncated[:100]))
+
+    def test_budget_prompt_count(self):
+        template = "Summarize this email.\nsender: {sender}\nsubject: {subject}\nemail text: {text}\n"
+        prompt, tokens = budget_prompt(template, CORPUS[5], 5000, sender="Sarah <sarah@example.com>", subject="Project Atlas kickoff")
+        self.assertIn(CORPUS[5], prompt)
+        self.assertGreaterEqual(tokens, count_tokens(prompt) * 0.9)
+        self.assertLessEqual(tokens, count_tokens(prompt) * (1 + ESTIMATE_ERROR))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+from unittest import mock
+from user_utils import UserCache
+
+ACCOUNT = {'_id': 'account-1', 'email': 'user@example.com', 'userId': 'user-1'}
+USER = {
+    '_id': 'user-1',
+    'updatedAt': 1,
+    'profileTypeInfo': {
+        '_id': 'profile-1',
+        'updatedAt': 1,
+        'categories': [
+            {'name': 'Work', 'description': 'Job related', 'disable': False},
+            {'name': 'Games', 'disable': True},
+        ],
+    },
+}
+
+def make_db():
+    db = mock.MagicMock()
+    db.name = 'test'
+    db.accounts.find_one.return_value = ACCOUNT
+    db.users.aggregate.side_effect = lambda pipeline: iter([USER])
+    return db
+
+class TestUserCache(unittest.TestCase):
+    def test_user_is_read_once_until_it_expires(self):
+        db = make_db()
+        cache = UserCache(ttl=60, invalidation='ttl')
+        with mock.patch('user_utils.time.monotonic', return_value=100.0):
+            entry = cache.get(db, 'user@example.com')
+            cache.get(db, 'user@example.com')
+        self.assertEqual(entry.prompt_context.prompt_categories, "\nWork: Job related\n")
+        self.assertEqual(entry.prompt_context.categories, ('Work',))
+        self.assertEqual(db.users.aggregate.call_count, 1)
+
+        with mock.patch('user_utils.time.monotonic', return_value=161.0):
+            cache.get(db, 'user@example.com')
+        self.assertEqual(db.users.aggregate.call_count, 2)
+
+    def test_profile_type_change_invalidates(self):
+        db = make_db()
+        cache = UserCache(ttl=60, invalidation='ttl')
+        cache.get(db, 'user@example.com')
+        cache._apply_change('test', 'profiletypes', 'profile-2')
+        cache.get(db, 'user@example.com')
+        self.assertEqual(db.users.aggregate.call_count, 1)
+
+        cache._apply_change('test', 'profiletypes', 'profile-1')
+        cache.get(db, 'user@example.com')
+        self.assertEqual(db.users.aggregate.call_count, 2)
+
+    def test_poll_invalidates_updated_users(self):
+        db = make_db()
+        cache = UserCache(ttl=60, invalidation='ttl')
+        cache.get(db, 'user@example.com')
+        collections = {
+            'users': mock.MagicMock(**{'find.return_value': [{'_id': 'user-1', 'updatedAt': 2}]}),
+            'profiletypes': mock.MagicMock(**{'find.return_value': [{'_id': 'profile-1', 'updatedAt': 1}]}),
+        }
+        db.__getitem__.side_effect = collections.__getitem__
+        cache.poll(db)
+        cache.get(db, 'user@example.com')
+        self.assertEqual(db.users.aggregate.call_count, 2)
+
+    def test_missing_account_is_not_cached(self):
+        db = make_db()
+        db.accounts.find_one.return_value = None
+        cache = UserCache(ttl=60, invalidation='ttl')
+        self.assertIsNone(cache.get(db, 'user@example.com'))
+        self.assertEqual(cache._entries, {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import math
+import string
+import threading
+from functools import lru_cache
+
+# Character-based estimate of the number of tokens of a text, calibrated on
+# email text against the tokenizer of open-mistral-7b: ASCII letters average
+# about 3.5 per token, while digits and punctuation are mostly one token each.
+LETTERS_PER_TOKEN = 3.5
+NON_ASCII_TOKENS = 1.2
+# The estimate does not under-estimate email text by more than this ratio
+# (see tests/token_budget.test.py)
+ESTIMATE_ERROR = 0.35
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+class _MistralEncoder:
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def encode(self, text):
+        return self.tokenizer.encode(text, bos=False, eos=False)
+
+    def decode(self, tokens):
+        return self.tokenizer.decode(tokens)
+
+
+def get_tokenizer():
+    """
+    Get the process-wide tokenizer, loaded on first use.
+    The Mistral tokenizer needs the optional mistral_common package: without it,
+    tiktoken's cl100k_base encoding is used as an approximation.
+
+    Returns:
+        Tokenizer with encode(text) and decode(tokens) methods
+    """
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            # Loaded here rather than at import: tokenizers are slow to load
+            try:
+                from mistral_common.tokens.tokenizers.mistral import MistralTokenizer
+                _tokenizer = _MistralEncoder(MistralTokenizer.v1().instruct_tokenizer.tokenizer)
+            except ImportError:
+                import tiktoken
+                print("mistral_common is not installed, counting tokens with tiktoken")
+                _tokenizer = tiktoken.get_encoding("cl100k_base")
+        return _tokenizer
+
+
+def count_tokens(text):
+    """Count the tokens of a text with the tokenizer."""
+    return len(get_tokenizer().encode(text))
+
+
+def estimate_tokens(text):
+    """
+    Estimate the number of tokens of a text from its characters, without encoding it.
+
+    Args:
+        text: Text to estimate
+
+    Returns:
+        Estimated number of tokens
+    """
+    letters = digits_and_punctuation = non_ascii = 0
+    for char in text:
+        if not char.isascii():
+            non_ascii += 1
+        elif char.isalpha():
+            letters += 1
+        elif not char.isspace():
+            digits_and_punctuation += 1
+    return math.ceil(letters / LETTERS_PER_TOKEN + digits_and_punctuation + non_ascii * NON_ASCII_TOKENS)
+
+
+def upper_bound_tokens(text):
+    """Number of tokens a text is assumed to have when it is not encoded."""
+    return math.ceil(estimate_tokens(text) * (1 + ESTIMATE_ERROR))
+
+
+def truncate_tokens(text, max_tokens):
+    """
+    Truncate a text to max_tokens tokens, encoding it at most once.
+    Texts whose estimate is safely within max_tokens are not encoded at all.
+
+    Args:
+        text: Text to truncate
+        max_tokens: Maximum number of tokens
+
+    Returns:
+        Tuple of (truncated text, number of tokens); the number of tokens is an
+        upper bound when the text was not encoded
+    """
+    bound = upper_bound_tokens(text)
+    if bound <= max_tokens:
+        return text, bound
+
+    tokenizer = get_tokenizer()
+    tokens = tokenizer.encode(text)
+    if len(tokens) > max_tokens:
+        return tokenizer.decode(tokens[:max_tokens]), max_tokens
+    return text, len(tokens)
+
+
+@lru_cache(maxsize=64)
+def template_tokens(template):
+    """
+    Count the tokens of the static part of a str.format template, once per template.
+
+    Args:
+        template: Prompt template
+
+    Returns:
+        Number of tokens of the template without its replacement fields
+    """
+    static = ''.join(literal for literal, _, _, _ in string.Formatter().parse(template))
+    return count_tokens(static)
+
+
+@lru_cache(maxsize=1024)
+def _cached_count_tokens(text):
+    return count_tokens(text)
+
+
+def field_tokens(value):
+    """
+    Tokens of a prompt field: short fields are estimated, long ones (such as
+    the category list, identical for every email of a user) are counted once.
+    """
+    value = str(value)
+    if len(value) < 512:
+        return upper_bound_tokens(value)
+    return _cached_count_tokens(value)
+
+
+def budget_prompt(template, text, max_text_tokens, **fields):
+    """
+    Build a prompt whose text field is truncated to max_text_tokens, and count
+    its tokens without encoding the prompt again: the count adds the cached
+    count of the template, the tokens of the text and those of the other fields.
+
+    Args:
+        template: Prompt template, with a {text} replacement field
+        text: Email text
+        max_text_tokens: Maximum number of tokens of the email text
+        **fields: Other replacement fields of the template
+
+    Returns:
+        Tuple of (prompt, number of tokens of the prompt)
+    """
+    text, text_tokens = truncate_tokens(text, max_text_tokens)
+    token_count = template_tokens(template) + text_tokens + sum(field_tokens(value) for value in fields.values())
+    return template.format(text=text, **fields), token_count
@@ -2,23 +2,15 @@ import os
 import functions_framework
 import sentry_sdk
 
-from constants import CATEGORIES, PROMPT_CATEGORIES, INSTRUCTIONS_TEMPLATE, INSTRUCTIONS_WITH_CONTEXT_TEMPLATE
-from config import load_config
-from user_utils import get_user_by_email
+from constants import INSTRUCTIONS_TEMPLATE, INSTRUCTIONS_WITH_CONTEXT_TEMPLATE
+from config import load_config, init_sentry
+from user_utils import get_user_profile
+from prompt_context import default_prompt_context
 from google_utils import setup_gmail_service
 from db_manager import MongoDBConnectionManager
 from email_processor import fetch_email
 
-sentry_sdk.init(
-    dsn=os.environ.get('SENTRY_SDK'),
-    # Set traces_sample_rate to 1.0 to capture 100%
-    # of transactions for tracing.
-    traces_sample_rate=1.0,
-    # Set profiles_sample_rate to 1.0 to profile 100%
-    # of sampled transactions.
-    # We recommend adjusting this value in production.
-    profiles_sample_rate=1.0,
-)
+init_sentry()
 
 API_KEY_MISTRAL = os.environ.get('API_KEY_MISTRAL')
 
@@ -45,7 +37,12 @@ def transform_email(request):
             
             gmail_service = setup_gmail_service(db, existing_account, config)
             
-            email_data = fetch_email(gmail_service, user_email, messageId, db, INSTRUCTIONS_WITH_CONTEXT_TEMPLATE, INSTRUCTIONS_TEMPLATE, PROMPT_CATEGORIES, API_KEY_MISTRAL, CATEGORIES)
+            # Categorized with the user's categories, like the sync does
+            profile = get_user_profile(user_email, db)
+            prompt_context = profile.prompt_context if profile else default_prompt_context()
+
+            email_data = fetch_email(gmail_service, user_email, messageId, db, INSTRUCTIONS_WITH_CONTEXT_TEMPLATE, INSTRUCTIONS_TEMPLATE, prompt_context, API_KEY_MISTRAL,
+                                     metadata_only_attachments=config['attachment_metadata_only'])
             
             return email_data
     
@@ -1,20 +1,50 @@
-def get_user_by_email(email, db):
+import os
+import time
+import threading
+from collections import namedtuple
+import sentry_sdk
+from pymongo.errors import PyMongoError
+
+from prompt_context import get_prompt_context
+
+# Collections whose changes invalidate cached users
+WATCHED_COLLECTIONS = ['accounts', 'users', 'profiletypes']
+
+# User joined with its profile type, and the PromptContext of its categories.
+# Cached users are shared between callers and must not be modified.
+CachedUser = namedtuple('CachedUser', ['user', 'prompt_context', 'account_id', 'expires_at'])
+
+_user_cache = None
+_user_cache_lock = threading.Lock()
+
+
+def load_user_by_email(email, db):
+    """
+    Read the user of an account from the database, joined with its profile type.
+
+    Args:
+        email: Email address of the account
+        db: Database connection
+
+    Returns:
+        Tuple of (account, user with its profileTypeInfo), the user being None if not found
+    """
     accounts_collection = db.accounts
     users_collection = db.users
-    
+
     # Use find_one() instead of find() to get a single document
     existing_account = accounts_collection.find_one({'email': email})
-    
+
     # Check if account exists
     if not existing_account:
         print(f"No account found for email: {email}")
-        return None
-        
+        return None, None
+
     # Make sure the account has a userId field
     if 'userId' not in existing_account:
         print(f"Account doesn't have userId field: {existing_account}")
-        return None
-    
+        return existing_account, None
+
     pipeline = [
         {"$match": {"_id": existing_account['userId']}},  # Access userId as a dictionary key
         {"$lookup": {
@@ -25,9 +55,215 @@ def get_user_by_email(email, db):
         }},
         {"$unwind": "$profileTypeInfo"},  # Optional: Deconstructs the array field from the output to promote its objects to the top level
     ]
-    
+
     result = users_collection.aggregate(pipeline)
-    
+
     # Convert the result to a list and return
     user_info = list(result)
-    return user_info[0] if user_info else None
\ No newline at end of file
+    return existing_account, user_info[0] if user_info else None
+
+
+class UserCache:
+    """
+    Per-process cache of the users of accounts, joined with their profile type
+    and with the prompt context of their categories.
+
+    Cached users expire after ttl seconds. They are also invalidated as soon
+    as their account, user or profile type changes: from a change stream of
+    the database, or, on deployments without a replica set where change
+    streams are not available, by polling the updatedAt of the cached users
+    and profile types every poll_interval seconds.
+    """
+    def __init__(self, ttl=300, invalidation='change_stream', poll_interval=30):
+        """
+        Args:
+            ttl: Seconds a user stays cached
+            invalidation: 'change_stream' to watch changes (polling if change streams are
+                not supported), 'poll' to always poll, 'ttl' to rely on expiry only
+            poll_interval: Seconds between two polls
+        """
+        self.ttl = ttl
+        self.invalidation = invalidation
+        self.poll_interval = poll_interval
+        self._entries = {}
+        self._watched = set()
+        self._lock = threading.Lock()
+
+    def get(self, db, email):
+        """
+        Get the cached user of an account, reading it from the database if needed.
+        Accounts without a user are not cached, so that they are found once created.
+
+        Args:
+            db: Database connection
+            email: Email address of the account
+
+        Returns:
+            CachedUser, or None if the account or its user does not exist
+        """
+        # Watched before reading, so that changes made after the read are not missed
+        self._watch(db)
+
+        key = (db.name, email)
+        entry = self._entries.get(key)
+        if entry and entry.expires_at > time.monotonic():
+            return entry
+
+        account, user = load_user_by_email(email, db)
+        if not user:
+            with self._lock:
+                self._entries.pop(key, None)
+            return None
+
+        entry = CachedUser(user, get_prompt_context(user['profileTypeInfo']), account['_id'], time.monotonic() + self.ttl)
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    def invalidate(self, db_name=None, email=None, account_id=None, user_id=None, profile_type_id=None):
+        """
+        Remove cached users. Without criteria, the whole cache is cleared.
+
+        Args:
+            db_name: Only remove users of this database
+            email: Remove the user of this account email
+            account_id: Remove the user of this account
+            user_id: Remove this user
+            profile_type_id: Remove the users of this profile type
+        """
+        criteria = (email, account_id, user_id, profile_type_id)
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if db_name and key[0] != db_name:
+                    continue
+                if all(criterion is None for criterion in criteria) or (
+                    key[1] == email
+                    or entry.account_id == account_id
+                    or entry.user['_id'] == user_id
+                    or entry.user['profileTypeInfo']['_id'] == profile_type_id
+                ):
+                    del self._entries[key]
+
+    def _watch(self, db):
+        if self.invalidation not in ('change_stream', 'poll'):
+            return
+        with self._lock:
+            if db.name in self._watched:
+                return
+            self._watched.add(db.name)
+
+        target = self._watch_changes if self.invalidation == 'change_stream' else self._poll_changes
+        threading.Thread(target=target, args=(db,), name=f"user-cache-{db.name}", daemon=True).start()
+
+    def _watch_changes(self, db):
+        pipeline = [{'$match': {'ns.coll': {'$in': WATCHED_COLLECTIONS}}}]
+        try:
+            with db.watch(pipeline) as stream:
+                for change in stream:
+                    self._apply_change(db.name, change['ns']['coll'], change.get('documentKey', {}).get('_id'))
+        except PyMongoError as e:
+            # Standalone servers do not support change streams; other errors end the stream
+            print(f"Watching user changes of {db.name} failed, polling instead: {e}")
+            if getattr(e, 'code', None) != 40573:
+                sentry_sdk.capture_exception(e)
+
+        # Changes may have been missed while the stream was down
+        self.invalidate(db_name=db.name)
+        self._poll_changes(db)
+
+    def _apply_change(self, db_name, collection, document_id):
+        if document_id is None:
+            self.invalidate(db_name=db_name)
+        elif collection == 'accounts':
+            self.invalidate(db_name=db_name, account_id=document_id)
+        elif collection == 'users':
+            self.invalidate(db_name=db_name, user_id=document_id)
+        elif collection == 'profiletypes':
+            self.invalidate(db_name=db_name, profile_type_id=document_id)
+
+    def _poll_changes(self, db):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.poll(db)
+            except PyMongoError as e:
+                sentry_sdk.capture_exception(e)
+                print(f"Polling user changes of {db.name} failed: {e}")
+
+    def poll(self, db):
+        """
+        Invalidate the cached users of a database whose user or profile type
+        was updated or deleted since it was cached.
+
+        Args:
+            db: Database connection
+        """
+        with self._lock:
+            entries = [entry for key, entry in self._entries.items() if key[0] == db.name]
+        if not entries:
+            return
+
+        for collection, field, cached in (
+            ('users', 'user_id', {entry.user['_id']: entry.user.get('updatedAt') for entry in entries}),
+            ('profiletypes', 'profile_type_id', {entry.user['profileTypeInfo']['_id']: entry.user['profileTypeInfo'].get('updatedAt') for entry in entries}),
+        ):
+            current = {document['_id']: document.get('updatedAt') for document in db[collection].find({'_id': {'$in': list(cached)}}, {'updatedAt': 1})}
+            for document_id, updated_at in cached.items():
+                if document_id not in current or current[document_id] != updated_at:
+                    self.invalidate(db_name=db.name, **{field: document_id})
+
+
+def get_user_cache():
+    """
+    Get the process-wide UserCache, configured from environment variables:
+    USER_CACHE_TTL, USER_CACHE_INVALIDATION and USER_CACHE_POLL_INTERVAL.
+    """
+    global _user_cache
+    with _user_cache_lock:
+        if _user_cache is None:
+            _user_cache = UserCache(
+                ttl=float(os.environ.get('USER_CACHE_TTL', 300)),
+                invalidation=os.environ.get('USER_CACHE_INVALIDATION', 'change_stream'),
+                poll_interval=float(os.environ.get('USER_CACHE_POLL_INTERVAL', 30)),
+            )
+        return _user_cache
+
+
+def _forget_user_cache_after_fork():
+    # Watcher threads do not survive a fork: the child starts its own cache
+    global _user_cache, _user_cache_lock
+    _user_cache_lock = threading.Lock()
+    _user_cache = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_user_cache_after_fork)
+
+
+def get_user_profile(email, db):
+    """
+    Get the cached user of an account with its prompt context.
+
+    Args:
+        email: Email address of the account
+        db: Database connection
+
+    Returns:
+        CachedUser, or None if the account or its user does not exist
+    """
+    return get_user_cache().get(db, email)
+
+
+def get_user_by_email(email, db):
+    """
+    Get the user of an account joined with its profile type, from the cache.
+
+    Args:
+        email: Email address of the account
+        db: Database connection
+
+    Returns:
+        User document with its profileTypeInfo, or None if not found
+    """
+    profile = get_user_profile(email, db)
+    return profile.user if profile else None
@@ -2,27 +2,20 @@ from email.utils import parsedate_tz, mktime_tz
 import base64
 import pytz
 from datetime import datetime
-import string
 import re
 import json
 from typing import Dict, Any, List
-import requests
 import sentry_sdk
-import tiktoken
-
-encoder = tiktoken.encoding_for_model("gpt-3.5-turbo")
+from gmail_utils import DraftResolver
+from email_store import upsert_thread
+from token_budget import budget_prompt
+from gmail_quota import execute_gmail
+from prompt_context import categories_prompt_context, default_prompt_context
 
 TOKEN_LIMIT = 30000
 
-def count_tokens(text):
-    return len(encoder.encode(text))
-
-def truncate_text(text, max_tokens):
-    """Truncate text to fit within the max token limit."""
-    tokens = encoder.encode(text)
-    if len(tokens) > max_tokens:
-        return encoder.decode(tokens[:max_tokens])  # Truncate to max_tokens
-    return text
+# Stored on emails whose summary is computed by a Mistral batch job not collected yet
+AI_STATUS_PENDING = "pending"
 
 def convert_to_iso8601_utc(date_str):
     """
@@ -63,40 +56,13 @@ def convert_to_iso8601_utc(date_str):
         print(f"Error parsing date: {e}")
         return None
     
-def contains_category(text, categories):
-    """
-    Checks if the given text contains any of the specified categories.
-
-    This function searches for categories within the provided text using a 
-    case-insensitive and word-boundary-sensitive approach. It normalizes the
-    text and category names by converting them to lowercase and stripping 
-    whitespace before checking for matches.
-
-    Parameters:
-    text (str): The text to be searched for category names.
-    categories (list of str): A list of category names to search for within the text.
-
-    Returns:
-    str: The first matching category found in the text. If no category is found, returns None.
-    """
-    # Normalize the input text
-    normalized_text = normalize_string(text)
-    
-    # Check if any category is a substring of the text using regex for accurate boundary checks
-    for category in categories:
-        # Prepare the regex pattern to match whole words/phrases, case-insensitive
-        pattern = r'\b' + re.escape(normalize_string(category)) + r'\b'
-        if re.search(pattern, normalized_text, re.IGNORECASE):
-            return category  # Return the found category
-
-    return None  # No category was found in the text
-    
-def parse_mistral_response(result, CATEGORIES):
+def parse_mistral_response(result, prompt_context=None):
     """
     Parses a JSON string and returns a structured object with category, text, and summary fields.
     
     Parameters:
     result (str): A JSON string containing 'category' and 'summary'.
+    prompt_context (PromptContext): Context of the valid categories, the standard categories by default.
     
     Returns:
     dict: A dictionary with 'category', 'text', and 'summary' fields.
@@ -109,7 +75,7 @@ def parse_mistral_response(result, CATEGORIES):
         raw_category = data.get('category', 'Other')
         
         # Find a known category in the text
-        category_found = contains_category(raw_category, CATEGORIES)
+        category_found = (prompt_context or default_prompt_context()).match(raw_category)
         category = category_found if category_found else 'Other'
         
         # Extract summary
@@ -127,38 +93,17 @@ def parse_mistral_response(result, CATEGORIES):
         print(f"Error parsing JSON: {e}")
         return {"category": "Other", "text": result, "summary": ""}
 
-def normalize_string(s):
-    """
-    Normalizes a given string for consistent comparison.
-
-    This function transforms the input string into a standardized format by:
-    - Converting all characters to lowercase.
-    - Removing punctuation marks.
-    - Stripping leading and trailing whitespace.
+def pending_categorization():
+    """Placeholder category object for an email whose prompt was deferred to a Mistral batch job."""
+    return {"category": "Other", "summary": "", "text": "", "pending": True}
 
-    These normalization steps help in achieving uniformity in text data, which is 
-    particularly useful for comparison or searching tasks where case and punctuation 
-    variations might otherwise lead to mismatches.
-
-    Parameters:
-    s (str): The input string to be normalized.
-
-    Returns:
-    str: The normalized string, ready for consistent comparison or analysis.
-    """
-    # Lowercase the string
-    s = s.lower()
-    # Remove punctuation
-    s = s.translate(str.maketrans('', '', string.punctuation))
-    # Strip leading and trailing whitespace
-    s = s.strip()
-    return s
-
-def decode_email_body(payload: Dict[str, Any], service, user_email, message_id) -> Dict[str, Any]:
+def decode_email_body(payload: Dict[str, Any], service, user_email, message_id, metadata_only_attachments=False) -> Dict[str, Any]:
     """
     Decodes the email body from the message payload.
     Returns a dictionary containing both the plain text, HTML parts (if available),
-    and any attachments.
+    and any attachments, with their base64 encoded data.
+    With metadata_only_attachments, attachment contents are not fetched and only
+    their metadata is kept: use attachments.get_attachment_data to retrieve them.
     """
     decoded_body = {"text": "", "html": "", "attachments": []}
     
@@ -176,11 +121,22 @@ def decode_email_body(payload: Dict[str, Any], service, user_email, message_id)
             return None
         
     def fetch_attachment(attachment_id: str) -> str:
-        attachment = service.users().messages().attachments().get(
-            userId=user_email, messageId=message_id, id=attachment_id).execute()
+        attachment = execute_gmail(
+            service.users().messages().attachments().get(userId=user_email, messageId=message_id, id=attachment_id),
+            'messages.attachments.get',
+            user_email
+        )
         attachment_data = attachment.get('data')
         return attachment_data
-    
+
+    def add_attachment(part: Dict[str, Any], data: str = None):
+        attachment = attachment_metadata(part)
+        if not metadata_only_attachments:
+            attachment['data'] = data or fetch_attachment(attachment['attachment_id'])
+            if not attachment['data']:
+                return
+        decoded_body['attachments'].append(attachment)
+
     def process_parts(parts: List[Dict[str, Any]]):
         for part in parts:
             mime_type = part.get('mimeType', '')
@@ -198,27 +154,12 @@ def decode_email_body(payload: Dict[str, Any], service, user_email, message_id)
                             decoded_body['text'] += decoded_part
                         elif mime_type == 'text/html':
                             decoded_body['html'] += decoded_part
-                elif filename:
-                    # Handle attachments
-                    attachment = {
-                        'filename': filename,
-                        'mimeType': mime_type,
-                        'data': part_data,  # Store base64 encoded data
-                        'attachment_id': body['attachmentId'],
-                    }
-                    decoded_body['attachments'].append(attachment)
+                elif filename and 'attachmentId' in body:
+                    # Store base64 encoded data
+                    add_attachment(part, part_data)
             elif filename and 'attachmentId' in body:
                 # Handle attachments with attachmentId
-                attachment_id = body['attachmentId']
-                attachment_data = fetch_attachment(attachment_id)
-                if attachment_data:
-                    attachment = {
-                        'filename': filename,
-                        'mimeType': mime_type,
-                        'data': attachment_data,
-                        'attachment_id': attachment_id,
-                    }
-                    decoded_body['attachments'].append(attachment)
+                add_attachment(part)
     
     # Check the main mimeType
     mime_type = payload.get('mimeType', '')
@@ -237,6 +178,30 @@ def decode_email_body(payload: Dict[str, Any], service, user_email, message_id)
 
     return decoded_body
 
+def attachment_metadata(part: Dict[str, Any]) -> Dict[str, Any]:
+    """Metadata stored for an attachment part of a message."""
+    body = part.get('body', {})
+    return {
+        'filename': part.get('filename'),
+        'mimeType': part.get('mimeType', ''),
+        'size': body.get('size', 0),
+        'attachment_id': body['attachmentId'],
+    }
+
+def strip_attachment_data(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Copy a message payload without the content of its attachment parts,
+    which is kept in the attachment blob store instead.
+    """
+    if not payload:
+        return payload
+    stripped = dict(payload)
+    if stripped.get('filename') and 'data' in stripped.get('body', {}):
+        stripped['body'] = {key: value for key, value in stripped['body'].items() if key != 'data'}
+    if 'parts' in stripped:
+        stripped['parts'] = [strip_attachment_data(part) for part in stripped['parts']]
+    return stripped
+
 def clean_email_text(email_text):
     # Remove web links
     cleaned_text = re.sub(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', '', email_text)
@@ -252,14 +217,20 @@ def clean_email_text(email_text):
     
     return cleaned_text.strip()
 
-def fetch_email_without_category(service, user_email, message_id, message, db, INSTRUCTIONS_WITH_CONTEXT_TEMPLATE, INSTRUCTIONS_TEMPLATE, API_KEY_MISTRAL, category):
-    """Fetch an email's details using the Gmail API."""
+def fetch_email_without_category(service, user_email, message_id, message, db, INSTRUCTIONS_WITH_CONTEXT_TEMPLATE, INSTRUCTIONS_TEMPLATE, API_KEY_MISTRAL, category, write_buffer=None, batch=None, draft_resolver=None, thread_cache=None):
+    """
+    Fetch an email's details using the Gmail API. Thread writes go to write_buffer when given.
+    When a MistralBatch is given, the summary is deferred to it and the thread is updated on write-back.
+    Draft IDs are resolved with draft_resolver, shared by the sync run, when given.
+    The thread context comes from thread_cache, the ThreadStateCache of the run, when given.
+    """
     try:
-        threads_collection = db.threads
-                
         decoded_body = decode_email_body(message['payload'], service, user_email, message_id)
         
-        existing_thread = threads_collection.find_one({'threadId': message["threadId"]})
+        if thread_cache is not None:
+            existing_thread = thread_cache.get(message["threadId"])
+        else:
+            existing_thread = db.threads.find_one({'threadId': message["threadId"]})
         
         # Initialize default category and summary
         default_category = "Draft"
@@ -283,37 +254,34 @@ def fetch_email_without_category(service, user_email, message_id, message, db, I
         if email_text and 'DRAFT' not in message.get('labelIds', []):
             # Prepare Mistral API prompt
             if existing_thread:
-                prompt = INSTRUCTIONS_WITH_CONTEXT_TEMPLATE.format(
+                prompt, token_count = budget_prompt(
+                    INSTRUCTIONS_WITH_CONTEXT_TEMPLATE,
+                    clean_email_text(email_text),
+                    5000,
                     sender=next(header['value'] for header in message['payload']['headers'] if header['name'] == 'From'), 
                     subject=next(header['value'] for header in message['payload']['headers'] if header['name'] == 'Subject'),
                     past_thread_summary=existing_thread['summary'],
-                    text=truncate_text(clean_email_text(email_text), 5000), 
                 )
             else:        
-                prompt = INSTRUCTIONS_TEMPLATE.format(
+                prompt, token_count = budget_prompt(
+                    INSTRUCTIONS_TEMPLATE,
+                    clean_email_text(email_text),
+                    5000,
                     sender=next(header['value'] for header in message['payload']['headers'] if header['name'] == 'From'), 
                     subject=next(header['value'] for header in message['payload']['headers'] if header['name'] == 'Subject'), 
-                    text=truncate_text(clean_email_text(email_text), 5000), 
                 )
             
-            token_count = count_tokens(prompt)
             print(f"Token count: {token_count}")
 
             # Make the Mistral API call if within token limit
-            if token_count <= TOKEN_LIMIT:
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {API_KEY_MISTRAL}"
-                }
-                data = {
-                    "model": "open-mistral-7b",
-                    "messages": [{"role": "user", "content": prompt}],
-                }
-                response = requests.post("https://api.mistral.ai/v1/chat/completions", json=data, headers=headers)
-                
-                # Process the response
-                mistral_response = response.json()
-                category_obj = parse_mistral_response(mistral_response["choices"][0]["message"]["content"], ['Other'])
+            if token_count <= TOKEN_LIMIT and batch is not None:
+                batch.add(message_id, prompt)
+                category_obj = pending_categorization()
+            elif token_count <= TOKEN_LIMIT:
+                # Imported here as mistral_client depends on this module
+                from mistral_client import get_mistral_client
+                content = get_mistral_client(API_KEY_MISTRAL).complete(prompt, user=user_email)
+                category_obj = parse_mistral_response(content, categories_prompt_context(['Other']))
             else:
                 print("Error: Token count exceeds the limit even after truncation.")
                 category_obj = {
@@ -328,27 +296,17 @@ def fetch_email_without_category(service, user_email, message_id, message, db, I
         delivered_cc = headers.get('Cc', None)
         delivered_bcc = headers.get('Bcc', None)
         
-        # If the thread exists, update it
-        if existing_thread:
-            threads_collection.update_one(
-                {'threadId': message["threadId"]},
-                {'$set': {
-                    'summary': category_obj['summary'],
-                    "userCategory": "",
-                    "generatedCategory": category,
-                }}
-            )
-        # If the thread doesn't exist, create a new one
+        if category_obj.get('pending'):
+            print(f"Summary of {message_id} deferred to a batch job")
         else:
-            new_thread = {
-                'threadId': message["threadId"],
-                'summary': category_obj['summary'],
-                "userCategory": "",
-                "generatedCategory": category,
-            }
-            if delivered_to:
-                new_thread['deliveredTo'] = delivered_to
-            threads_collection.insert_one(new_thread)
+            thread_update = {'summary': category_obj['summary'], "userCategory": "", "generatedCategory": category}
+            if write_buffer is not None:
+                write_buffer.upsert_thread(message["threadId"], thread_update, delivered_to)
+            else:
+                # Created with deliveredTo, or updated, in a single upsert
+                upsert_thread(db, message["threadId"], thread_update, delivered_to)
+            if thread_cache is not None:
+                thread_cache.update(message["threadId"], thread_update)
         
         # Find the Date header and convert it to a datetime object
         date_str = next(header['value'] for header in message['payload']['headers'] if header['name'] == 'Date')
@@ -373,7 +331,7 @@ def fetch_email_without_category(service, user_email, message_id, message, db, I
             "generatedCategory": category,
             "mistralOutputText": category_obj["text"],
             "attachments": decoded_body["attachments"],
-            "payload": message['payload'],
+            "payload": strip_attachment_data(message['payload']),
         }
         
         if delivered_to:
@@ -384,16 +342,15 @@ def fetch_email_without_category(service, user_email, message_id, message, db, I
         
         if delivered_bcc:
             message_details['bcc'] = delivered_bcc
+
+        if category_obj.get('pending'):
+            message_details['aiStatus'] = AI_STATUS_PENDING
             
              # Check if the message is a draft
         if 'DRAFT' in message.get('labelIds', []):
-            # Fetch drafts and find the matching draftId
-            drafts = service.users().drafts().list(userId=user_email).execute().get('drafts', [])
-            for draft in drafts:
-                draft_details = service.users().drafts().get(userId=user_email, id=draft['id']).execute()
-                if draft_details['message']['id'] == message_id:
-                    message_details['draftId'] = draft['id']
-                    break
+            draft_id = (draft_resolver or DraftResolver(user_email)).get_draft_id(service, message_id)
+            if draft_id:
+                message_details['draftId'] = draft_id
     
         return message_details
         
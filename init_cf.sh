@@ -90,6 +90,7 @@ run_function "process_mails" "last_30_days" "8082"
 run_function "process_mails" "retrieve_email_by_labels_entry_point" "8083" 
 run_function "transform_email" "transform_email_entry_point" "8084" 
 run_function "retrieve_calendar_events" "retrieve_calendar_events_entry_point" "8085" 
+run_function "process_mails" "retrieve_attachment_entry_point" "8086"
 
 echo -e "\n${GREEN}All functions are now running in the background${NC}"
 echo -e "${BLUE}Function logs are being saved to respective log files${NC}"
@@ -98,6 +99,7 @@ echo -e "  - last_30_days: ${GREEN}http://localhost:8082${NC}"
 echo -e "  - retrieve_email_by_labels_entry_point: ${GREEN}http://localhost:8083${NC}"
 echo -e "  - transform_email_entry_point: ${GREEN}http://localhost:8084${NC}"
 echo -e "  - retrieve_calendar_events_entry_point: ${GREEN}http://localhost:8085${NC}"
+echo -e "  - retrieve_attachment_entry_point: ${GREEN}http://localhost:8086${NC}"
 
 # Display active environment variables (for debugging)
 echo -e "\n${BLUE}Active environment variables:${NC}"